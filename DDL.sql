@@ -19,6 +19,8 @@ BEGIN
     DROP TABLE IF EXISTS `Statuses`;
     DROP TABLE IF EXISTS `Results`;
     DROP TABLE IF EXISTS `Tests`;
+    DROP TABLE IF EXISTS `ClinicDailyBusyness`;
+    DROP TABLE IF EXISTS `ClinicHours`;
 
     /** Disable autocommiting so that all transactions are completed at once, or rolled back if there is an error **/
     SET AUTOCOMMIT = 0;
@@ -35,6 +37,9 @@ BEGIN
         `state` char(2) NOT NULL,
         `postalCode` varchar(5) NOT NULL,
         `phoneNumber` char(12) DEFAULT NULL,
+        /** Labels of the clinic computed once per write instead of on every read (see sp_create_display_columns) **/
+        `location` varchar(100) GENERATED ALWAYS AS (CONCAT(`address`, ', ', `city`, ', ', `state`)) STORED,
+        `displayName` varchar(125) GENERATED ALWAYS AS (CONCAT('Capital Family Clinic at ', `location`)) STORED,
         PRIMARY KEY (`clinicId`),
         CONSTRAINT full_address UNIQUE (`address`,`city`,`state`, `postalCode`)
     );
@@ -61,8 +66,15 @@ BEGIN
         `dateOfBirth` DATE NOT NULL,
         `gender` ENUM('Male','Female','Unknown') NOT NULL,
         `clinicId` int,
+        /** Name shown for the patient, computed once per write instead of on every read (see sp_create_display_columns) **/
+        `fullName` varchar(91) GENERATED ALWAYS AS (CONCAT(`firstName`, ' ', `lastName`)) STORED,
         PRIMARY KEY (`patientId`),
-        FOREIGN KEY (`clinicId`) REFERENCES Clinics(clinicId) ON DELETE SET NULL
+        FOREIGN KEY (`clinicId`) REFERENCES Clinics(clinicId) ON DELETE SET NULL,
+        /** Indexes for searching patients by the start of their first and/or last name **/
+        INDEX `patient_last_first` (`lastName`, `firstName`),
+        INDEX `patient_first_last` (`firstName`, `lastName`),
+        /** Index for searching patients by the start of "first last" (see patient_name_search() in app.py) **/
+        INDEX `patient_full_name` (`fullName`)
     );
 
 
@@ -77,21 +89,21 @@ BEGIN
     'johnsmith@gmail.com',
     '1990-01-01',
     'Male',
-    (SELECT clinicId FROM Clinics WHERE CONCAT(address, ', ', city, ', ', state) = '123 Main Street, Seattle, WA')),
+    (SELECT clinicId FROM Clinics WHERE location = '123 Main Street, Seattle, WA')),
     ('Mary',
     'Smith',
     '222-555-8888',
     'marysmith@gmail.com',
     '1995-12-31',
     'Female',
-    (SELECT clinicId FROM Clinics WHERE CONCAT(address, ', ', city, ', ', state) = '789 Lincoln Avenue, Tacoma, WA')),
+    (SELECT clinicId FROM Clinics WHERE location = '789 Lincoln Avenue, Tacoma, WA')),
     ('Adam',
     'Doe',
     '111-333-9999',
     'adamdoe@gmail.com',
     '1988-07-04',
     'Male',
-    (SELECT clinicId FROM Clinics WHERE CONCAT(address, ', ', city, ', ', state) = '123 Main Street, Seattle, WA'));
+    (SELECT clinicId FROM Clinics WHERE location = '123 Main Street, Seattle, WA'));
 
 
 
@@ -125,6 +137,8 @@ BEGIN
         `patientId` int NOT NULL,
         `statusId` int NOT NULL,
         PRIMARY KEY (`appointmentId`),
+        /** Finds a clinic's appointments in a time range without reading the rows, for the availability checks **/
+        KEY `idx_appointments_clinic_datetime` (`clinicId`, `dateTime`, `statusId`),
         FOREIGN KEY (`statusId`) REFERENCES Statuses(statusId) ON DELETE RESTRICT,
         FOREIGN KEY (`clinicId`) REFERENCES Clinics(clinicId) ON DELETE CASCADE,
         FOREIGN KEY (`patientId`) REFERENCES Patients(patientId) ON DELETE RESTRICT
@@ -139,21 +153,31 @@ BEGIN
     INSERT INTO `Appointments` (`dateTime`, `clinicId`, `patientId`, `statusId`)
     VALUES (
     '2025-04-23 09:00:00',
-    (SELECT clinicId FROM Clinics WHERE CONCAT(address, ', ', city, ', ', state) = '123 Main Street, Seattle, WA'),
+    (SELECT clinicId FROM Clinics WHERE location = '123 Main Street, Seattle, WA'),
     (SELECT patientId FROM Patients WHERE firstName = 'John' AND lastName = 'Smith' AND email = 'johnsmith@gmail.com'),
     (SELECT statusId FROM Statuses WHERE status = 'Completed')),
     ('2025-05-05 11:30:00',
-    (SELECT clinicId FROM Clinics WHERE CONCAT(address, ', ', city, ', ', state) = '123 Main Street, Seattle, WA'),
+    (SELECT clinicId FROM Clinics WHERE location = '123 Main Street, Seattle, WA'),
     (SELECT patientId FROM Patients WHERE firstName = 'Adam' AND lastName = 'Doe' AND email = 'adamdoe@gmail.com'),
     (SELECT statusId FROM Statuses WHERE status = 'Scheduled')),
     ('2025-05-05 11:30:00',
-    (SELECT clinicId FROM Clinics WHERE CONCAT(address, ', ', city, ', ', state) = '789 Lincoln Avenue, Tacoma, WA'),
+    (SELECT clinicId FROM Clinics WHERE location = '789 Lincoln Avenue, Tacoma, WA'),
     (SELECT patientId FROM Patients WHERE firstName = 'John' AND lastName = 'Smith' AND email = 'johnsmith@gmail.com'),
     (SELECT statusId FROM Statuses WHERE status = 'Scheduled'));
 
 
 
 
+    /**Create the ClinicDailyBusyness rollup (defined in sp_create_busyness) and count the example appointments into it **/
+    CALL sp_create_busyness();
+    CALL sp_rebuild_busyness();
+
+    /**Create the ClinicHours table (defined in sp_create_availability) with the default hours of each clinic **/
+    CALL sp_create_availability();
+
+
+
+
     /**Create the Tests table. Represents a test that a patient may take during an appointment at a clinic. **/
     CREATE TABLE `Tests` (
         `testId` int NOT NULL UNIQUE AUTO_INCREMENT,
@@ -219,6 +243,33 @@ BEGIN
 
 
 
+    /**Create the TableVersions table if needed. Holds a version number for each table that is bumped whenever the table changes,
+    so cached copies of a table can be checked against the database. It is never dropped, so versions keep increasing across resets. **/
+    CREATE TABLE IF NOT EXISTS `TableVersions` (
+        `tableName` varchar(45) NOT NULL,
+        `version` bigint NOT NULL DEFAULT 1,
+        PRIMARY KEY (`tableName`)
+    );
+
+
+    /**Bump the version of every reloaded table **/
+    INSERT INTO `TableVersions` (`tableName`)
+    VALUES ('Clinics'),
+    ('Patients'),
+    ('Statuses'),
+    ('Appointments'),
+    ('Tests'),
+    ('Results'),
+    ('AppointmentsTests')
+    ON DUPLICATE KEY UPDATE `version` = `version` + 1;
+
+
+    /**Create the ChangeLog table if needed (defined in sp_create_changelog) and tell its readers that every table was reloaded **/
+    CALL sp_create_changelog();
+    CALL sp_log_reset();
+
+
+
     /** change foreign key checks back to 1, so database integrity is maintained. Commit the changes **/
     SET FOREIGN_KEY_CHECKS = 1;
     COMMIT;
@@ -229,3 +280,312 @@ END //
 /** Set the delimeter back to ; **/
 DELIMITER ;
 
+
+
+/** Drop the busyness sps, if they already exit **/
+DROP PROCEDURE IF EXISTS sp_create_busyness;
+DROP PROCEDURE IF EXISTS sp_rebuild_busyness;
+
+DELIMITER //
+/** Create the sp. Creates the ClinicDailyBusyness table if needed, so databases that predate it can add it
+without reloading. A rollup of the number of appointments per clinic, per day and per status, kept up to date
+by the appointment stored procedures so the busyness dashboard never scans Appointments.
+Rows are removed with their clinic, like the clinic's appointments. **/
+CREATE PROCEDURE sp_create_busyness()
+BEGIN
+
+    CREATE TABLE IF NOT EXISTS `ClinicDailyBusyness` (
+        `clinicId` int NOT NULL,
+        `day` date NOT NULL,
+        `statusId` int NOT NULL,
+        `appointments` int NOT NULL DEFAULT 0,
+        PRIMARY KEY (`clinicId`, `day`, `statusId`),
+        KEY `idx_busyness_day` (`day`),
+        FOREIGN KEY (`clinicId`) REFERENCES Clinics(clinicId) ON DELETE CASCADE
+    );
+
+END //
+
+/** Create the sp. Recounts the whole ClinicDailyBusyness rollup from Appointments. Run it when appointments
+were written without the stored procedures (e.g. a bulk load). It runs in the caller's transaction. **/
+CREATE PROCEDURE sp_rebuild_busyness()
+BEGIN
+
+    DELETE FROM `ClinicDailyBusyness`;
+
+    INSERT INTO `ClinicDailyBusyness` (`clinicId`, `day`, `statusId`, `appointments`)
+    SELECT `clinicId`, DATE(`dateTime`), `statusId`, COUNT(*)
+    FROM `Appointments`
+    GROUP BY `clinicId`, DATE(`dateTime`), `statusId`;
+
+END //
+
+DELIMITER ;
+
+
+/** Drop the availability sps, if they already exit **/
+DROP PROCEDURE IF EXISTS sp_create_availability;
+DROP PROCEDURE IF EXISTS sp_default_clinic_hours;
+
+DELIMITER //
+/** Create the sp. Creates the ClinicHours table and the (clinicId, dateTime) index of Appointments if needed,
+so databases that predate them can add them without reloading, and gives every clinic its default hours. **/
+CREATE PROCEDURE sp_create_availability()
+BEGIN
+
+    /**ClinicHours holds the opening hours of each clinic per day of the week, split into slots of slotMinutes
+    that take at most slotCapacity appointments. A clinic is closed on days without a row. **/
+    CREATE TABLE IF NOT EXISTS `ClinicHours` (
+        `clinicId` int NOT NULL,
+        `dayOfWeek` tinyint NOT NULL, /** 0 = Monday ... 6 = Sunday, as WEEKDAY() **/
+        `opensAt` time NOT NULL,
+        `closesAt` time NOT NULL,
+        `slotMinutes` smallint NOT NULL DEFAULT 15,
+        `slotCapacity` smallint NOT NULL DEFAULT 2,
+        PRIMARY KEY (`clinicId`, `dayOfWeek`),
+        FOREIGN KEY (`clinicId`) REFERENCES Clinics(clinicId) ON DELETE CASCADE
+    );
+
+    IF NOT EXISTS (SELECT 1 FROM information_schema.STATISTICS
+                   WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'Appointments'
+                   AND INDEX_NAME = 'idx_appointments_clinic_datetime') THEN
+        ALTER TABLE `Appointments` ADD KEY `idx_appointments_clinic_datetime` (`clinicId`, `dateTime`, `statusId`);
+    END IF;
+
+    CALL sp_default_clinic_hours();
+
+END //
+
+/** Create the sp. Gives every clinic without opening hours the default week: open every day from 8 AM
+to 6 PM, in 15 minute slots of 2 appointments. **/
+CREATE PROCEDURE sp_default_clinic_hours()
+BEGIN
+
+    INSERT INTO `ClinicHours` (`clinicId`, `dayOfWeek`, `opensAt`, `closesAt`, `slotMinutes`, `slotCapacity`)
+    SELECT `Clinics`.`clinicId`, `days`.`dayOfWeek`, '08:00:00', '18:00:00', 15, 2
+    FROM `Clinics`
+    CROSS JOIN (SELECT 0 AS `dayOfWeek` UNION ALL SELECT 1 UNION ALL SELECT 2 UNION ALL SELECT 3
+                UNION ALL SELECT 4 UNION ALL SELECT 5 UNION ALL SELECT 6) AS `days`
+    WHERE NOT EXISTS (SELECT 1 FROM `ClinicHours` WHERE `ClinicHours`.`clinicId` = `Clinics`.`clinicId`);
+
+END //
+
+DELIMITER ;
+
+
+/** Drop the change log sps, if they already exit **/
+DROP PROCEDURE IF EXISTS sp_create_changelog;
+DROP PROCEDURE IF EXISTS sp_log_reset;
+
+DELIMITER //
+/** Create the sp. Creates the ChangeLog table if needed, so databases that predate it can add it without reloading.
+The stored procedures (and imports) add a row for every row they insert, update or delete, which /api/changes
+returns in changeId order, so other systems can copy the changes since the last changeId they read instead of
+exporting every table. Like TableVersions it is never dropped, so changeIds keep increasing across resets. **/
+CREATE PROCEDURE sp_create_changelog()
+BEGIN
+
+    CREATE TABLE IF NOT EXISTS `ChangeLog` (
+        `changeId` bigint NOT NULL AUTO_INCREMENT,
+        `tableName` varchar(45) NOT NULL,
+        `rowId` int DEFAULT NULL, /** NULL for a reset **/
+        `operation` ENUM('insert', 'update', 'delete', 'reset') NOT NULL,
+        `changedAt` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (`changeId`),
+        /** Finds the changes old enough to be pruned **/
+        KEY `idx_changelog_changed_at` (`changedAt`)
+    );
+
+    /** The highest changeId pruned so far, so /api/changes can tell a token whose next changes were pruned from
+    one followed by a gap in the changeIds (a rolled back insert, or auto_increment_increment above 1). A log that
+    was pruned before this table existed starts from the change before its oldest one. **/
+    CREATE TABLE IF NOT EXISTS `ChangeLogPruned` (
+        `id` tinyint NOT NULL DEFAULT 1,
+        `prunedThrough` bigint NOT NULL DEFAULT 0,
+        PRIMARY KEY (`id`)
+    );
+    INSERT IGNORE INTO `ChangeLogPruned` (`id`, `prunedThrough`)
+    SELECT 1, COALESCE(MIN(`changeId`) - 1, 0) FROM `ChangeLog`;
+
+END //
+
+/** Create the sp. Logs a reset of every table, after which readers of the change log copy the tables again.
+Run it after the tables were reloaded or written without the stored procedures (e.g. a bulk load). **/
+CREATE PROCEDURE sp_log_reset()
+BEGIN
+
+    INSERT INTO `ChangeLog` (`tableName`, `operation`)
+    VALUES ('Clinics', 'reset'),
+    ('Patients', 'reset'),
+    ('Statuses', 'reset'),
+    ('Appointments', 'reset'),
+    ('Tests', 'reset'),
+    ('Results', 'reset'),
+    ('AppointmentsTests', 'reset');
+
+END //
+
+DELIMITER ;
+
+
+/** Drop the display columns sp, if it already exits **/
+DROP PROCEDURE IF EXISTS sp_create_display_columns;
+
+DELIMITER //
+/** Create the sp. Adds the generated display columns (Clinics.location, Clinics.displayName and Patients.fullName)
+and the index of the patient name search if needed, so databases that predate them can add them without reloading. The columns are
+computed by MySQL whenever a row is written, so the list pages, dropdowns and exports read them instead of
+building the same strings for every row of every request. **/
+CREATE PROCEDURE sp_create_display_columns()
+BEGIN
+
+    IF NOT EXISTS (SELECT 1 FROM information_schema.COLUMNS
+                   WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'Clinics' AND COLUMN_NAME = 'location') THEN
+        ALTER TABLE `Clinics`
+            ADD COLUMN `location` varchar(100) GENERATED ALWAYS AS (CONCAT(`address`, ', ', `city`, ', ', `state`)) STORED,
+            ADD COLUMN `displayName` varchar(125) GENERATED ALWAYS AS (CONCAT('Capital Family Clinic at ', `location`)) STORED;
+    END IF;
+
+    /** Nothing searches the few clinics by location, so an index on it only slowed down their writes **/
+    IF EXISTS (SELECT 1 FROM information_schema.STATISTICS
+               WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'Clinics' AND INDEX_NAME = 'clinic_location') THEN
+        ALTER TABLE `Clinics` DROP INDEX `clinic_location`;
+    END IF;
+
+    IF NOT EXISTS (SELECT 1 FROM information_schema.COLUMNS
+                   WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'Patients' AND COLUMN_NAME = 'fullName') THEN
+        ALTER TABLE `Patients`
+            ADD COLUMN `fullName` varchar(91) GENERATED ALWAYS AS (CONCAT(`firstName`, ' ', `lastName`)) STORED,
+            ADD INDEX `patient_full_name` (`fullName`);
+    END IF;
+
+END //
+
+DELIMITER ;
+
+
+/** Drop the snapshot sp, if it already exits **/
+DROP PROCEDURE IF EXISTS sp_snapshot_clinicdb;
+
+DELIMITER //
+/** Create the sp. Copies the current rows of every table into the Seed tables that sp_reset_clinicdb restores from.
+Run it after sp_load_clinicdb, or after loading a larger dataset for demos and tests. **/
+CREATE PROCEDURE sp_snapshot_clinicdb()
+BEGIN
+
+    DROP TABLE IF EXISTS `SeedClinics`, `SeedPatients`, `SeedStatuses`, `SeedAppointments`, `SeedTests`, `SeedResults`, `SeedAppointmentsTests`;
+
+    /** Columns are listed so the snapshot only holds the stored columns of each table **/
+    CREATE TABLE `SeedClinics` AS
+    SELECT `clinicId`, `address`, `city`, `state`, `postalCode`, `phoneNumber` FROM `Clinics`;
+
+    CREATE TABLE `SeedPatients` AS
+    SELECT `patientId`, `firstName`, `lastName`, `phoneNumber`, `email`, `dateOfBirth`, `gender`, `clinicId` FROM `Patients`;
+
+    CREATE TABLE `SeedStatuses` AS
+    SELECT `statusId`, `status` FROM `Statuses`;
+
+    CREATE TABLE `SeedAppointments` AS
+    SELECT `appointmentId`, `dateTime`, `clinicId`, `patientId`, `statusId` FROM `Appointments`;
+
+    CREATE TABLE `SeedTests` AS
+    SELECT `testId`, `name` FROM `Tests`;
+
+    CREATE TABLE `SeedResults` AS
+    SELECT `testResultId`, `result` FROM `Results`;
+
+    CREATE TABLE `SeedAppointmentsTests` AS
+    SELECT `appointmentTestId`, `appointmentId`, `testId`, `testResultId` FROM `AppointmentsTests`;
+
+END //
+
+DELIMITER ;
+
+
+/** Drop the reset sp, if it already exits **/
+DROP PROCEDURE IF EXISTS sp_reset_clinicdb;
+
+DELIMITER //
+/** Create the sp. Restores every table from the Seed tables without dropping or recreating them.
+The rows are replaced in a single transaction, so other connections keep reading the old rows
+until it commits and never wait on table metadata locks. Without a snapshot, the example data is loaded
+with sp_load_clinicdb and snapshotted first. **/
+CREATE PROCEDURE sp_reset_clinicdb()
+BEGIN
+    /** Create the exit handler to handle errors, rollback as necessary **/
+    DECLARE EXIT HANDLER FOR SQLEXCEPTION
+        BEGIN
+            ROLLBACK;
+            RESIGNAL;
+        END;
+
+    IF NOT EXISTS (SELECT 1 FROM information_schema.TABLES
+                   WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'SeedAppointmentsTests') THEN
+        CALL sp_load_clinicdb();
+        CALL sp_snapshot_clinicdb();
+    ELSE
+        /** Tables added after the snapshot was taken. Created before the transaction, as DDL commits it **/
+        CALL sp_create_busyness();
+        CALL sp_create_availability();
+        CALL sp_create_display_columns();
+        CALL sp_create_changelog();
+
+        START TRANSACTION;
+
+            /** Empty the tables, children before parents **/
+            DELETE FROM `AppointmentsTests`;
+            DELETE FROM `Appointments`;
+            DELETE FROM `Patients`;
+            DELETE FROM `Clinics`;
+            DELETE FROM `Statuses`;
+            DELETE FROM `Results`;
+            DELETE FROM `Tests`;
+
+            /** Reload the snapshot, parents before children, keeping the snapshot's ids **/
+            INSERT INTO `Clinics` (`clinicId`, `address`, `city`, `state`, `postalCode`, `phoneNumber`)
+            SELECT `clinicId`, `address`, `city`, `state`, `postalCode`, `phoneNumber` FROM `SeedClinics`;
+
+            /** Opening hours were deleted with the clinics; the restored clinics get the default hours **/
+            CALL sp_default_clinic_hours();
+
+            INSERT INTO `Statuses` (`statusId`, `status`)
+            SELECT `statusId`, `status` FROM `SeedStatuses`;
+
+            INSERT INTO `Tests` (`testId`, `name`)
+            SELECT `testId`, `name` FROM `SeedTests`;
+
+            INSERT INTO `Results` (`testResultId`, `result`)
+            SELECT `testResultId`, `result` FROM `SeedResults`;
+
+            INSERT INTO `Patients` (`patientId`, `firstName`, `lastName`, `phoneNumber`, `email`, `dateOfBirth`, `gender`, `clinicId`)
+            SELECT `patientId`, `firstName`, `lastName`, `phoneNumber`, `email`, `dateOfBirth`, `gender`, `clinicId` FROM `SeedPatients`;
+
+            INSERT INTO `Appointments` (`appointmentId`, `dateTime`, `clinicId`, `patientId`, `statusId`)
+            SELECT `appointmentId`, `dateTime`, `clinicId`, `patientId`, `statusId` FROM `SeedAppointments`;
+
+            INSERT INTO `AppointmentsTests` (`appointmentTestId`, `appointmentId`, `testId`, `testResultId`)
+            SELECT `appointmentTestId`, `appointmentId`, `testId`, `testResultId` FROM `SeedAppointmentsTests`;
+
+            /** Recount the busyness rollup from the restored appointments **/
+            CALL sp_rebuild_busyness();
+
+            /** Bump the version of every reloaded table **/
+            INSERT INTO `TableVersions` (`tableName`)
+            VALUES ('Clinics'),
+            ('Patients'),
+            ('Statuses'),
+            ('Appointments'),
+            ('Tests'),
+            ('Results'),
+            ('AppointmentsTests')
+            ON DUPLICATE KEY UPDATE `version` = `version` + 1;
+
+            /** Readers of the change log copy the reloaded tables again **/
+            CALL sp_log_reset();
+
+        COMMIT;
+    END IF;
+
+END //
+
+DELIMITER ;
@@ -34,7 +34,7 @@ Patients.phoneNumber AS `Phone Number`,
 email AS `Email`, 
 DATE_FORMAT(dateOfBirth, '%m/%d/%Y') AS `Date Of Birth`, 
 gender AS `Gender`, 
-CONCAT('Capital Family Clinic at ', Clinics.address, ',  ', Clinics.city, ', ', Clinics.state) AS `Primary Clinic`
+Clinics.displayName AS `Primary Clinic`
 FROM Patients
 LEFT JOIN Clinics ON Patients.clinicId = Clinics.clinicId;
 
@@ -107,8 +107,8 @@ WHERE resultId = @resultId_to_rename;
 /** Get all appointments **/
 SELECT appointmentId AS `Appointment ID`,
 DATE_FORMAT(dateTime, '%%m/%%d/%%Y %%h:%%i %%p') AS `Appointment Date Time`,
-CONCAT('Capital Family Clinic at ', Clinics.address, ', ', Clinics.city, ', ', Clinics.state) AS `Clinic`,
-CONCAT(Patients.firstName, ' ', Patients.lastName) AS `Patient Name`,
+Clinics.displayName AS `Clinic`,
+Patients.fullName AS `Patient Name`,
 Statuses.status AS `Appointment Status`
 FROM Appointments
 JOIN Patients ON Appointments.patientId = Patients.patientId
@@ -141,8 +141,8 @@ WHERE appointmentId=@appointmentId;
 
 /** Get AppointmentsTests information, Represented in the UI as Scheduled Tests **/
 SELECT AppointmentsTests.appointmentTestId AS `Scheduled Test ID`,
-CONCAT(Patients.firstName, ' ', Patients.lastName) AS `Patient Name`,
-CONCAT('Capital Family Clinic at ', Clinics.address, ', ', Clinics.city, ', ', Clinics.state) AS `Clinic`,
+Patients.fullName AS `Patient Name`,
+Clinics.displayName AS `Clinic`,
 DATE_FORMAT(Appointments.dateTime, '%%m/%%d/%%Y %%h:%%i %%p') AS `Appointment Date Time`,
 Tests.name AS `Test Name`,
 Results.result AS `Test Result`
@@ -1,3 +1,144 @@
+-- #############################
+-- BUMP table version
+-- #############################
+
+-- Drop the stored procedure if it already exists
+DROP PROCEDURE IF EXISTS sp_bump_table_version;
+
+
+DELIMITER / /
+-- Create the procedure with the appropriate variables
+CREATE PROCEDURE sp_bump_table_version(
+    IN p_tableName varchar(45))
+
+-- Increase the version of the given table, so cached copies of it are reloaded
+BEGIN
+    INSERT INTO `TableVersions` (`tableName`)
+    VALUES (p_tableName)
+    ON DUPLICATE KEY UPDATE `version` = `version` + 1;
+END / /
+
+DELIMITER ;
+
+
+-- #############################
+-- LOG change
+-- #############################
+
+-- Drop the stored procedure if it already exists
+DROP PROCEDURE IF EXISTS sp_log_change;
+
+
+DELIMITER / /
+-- Create the procedure with the appropriate variables
+CREATE PROCEDURE sp_log_change(
+    IN p_tableName varchar(45),
+    IN p_rowId INT,
+    IN p_operation varchar(6))
+
+-- Add an insert, update or delete of one row to the ChangeLog read by /api/changes.
+-- It changes LAST_INSERT_ID(), so callers read the id of their own insert first.
+BEGIN
+    INSERT INTO `ChangeLog` (`tableName`, `rowId`, `operation`)
+    VALUES (p_tableName, p_rowId, p_operation);
+END / /
+
+DELIMITER ;
+
+
+-- #############################
+-- COUNT busyness
+-- #############################
+
+-- Drop the stored procedure if it already exists
+DROP PROCEDURE IF EXISTS sp_count_busyness;
+
+
+DELIMITER / /
+-- Create the procedure with the appropriate variables
+CREATE PROCEDURE sp_count_busyness(
+    IN p_clinicId INT,
+    IN p_dateTime DATETIME,
+    IN p_statusId INT,
+    IN p_change INT)
+
+-- Add p_change (1 or -1) to the ClinicDailyBusyness count of an appointment's clinic, day and status
+BEGIN
+    INSERT INTO `ClinicDailyBusyness` (`clinicId`, `day`, `statusId`, `appointments`)
+    VALUES (p_clinicId, DATE(p_dateTime), p_statusId, p_change)
+    ON DUPLICATE KEY UPDATE `appointments` = `appointments` + p_change;
+
+    -- Days without appointments are left out, as in a rebuild
+    DELETE FROM `ClinicDailyBusyness`
+    WHERE `clinicId` = p_clinicId AND `day` = DATE(p_dateTime) AND `statusId` = p_statusId
+    AND `appointments` <= 0;
+END / /
+
+DELIMITER ;
+
+
+-- #############################
+-- CHECK availability
+-- #############################
+
+-- Drop the stored procedure if it already exists
+DROP PROCEDURE IF EXISTS sp_check_availability;
+
+
+DELIMITER / /
+-- Create the procedure with the appropriate variables
+CREATE PROCEDURE sp_check_availability(
+    IN p_appointmentId INT,
+    IN p_dateTime DATETIME,
+    IN p_clinicId INT,
+    IN p_statusId INT)
+
+-- Signal an error unless the clinic is open at p_dateTime and the slot holding it has room.
+-- p_appointmentId is the appointment being moved (not counted against the slot), or NULL for a new one.
+-- The clinic's ClinicHours row stays locked until the caller commits, so concurrent bookings
+-- at the same clinic are checked one after the other and cannot both take the last place.
+BEGIN
+    DECLARE v_opensAt DATETIME;
+    DECLARE v_closesAt DATETIME;
+    DECLARE v_slotMinutes INT;
+    DECLARE v_slotCapacity INT;
+    DECLARE v_slotStart DATETIME;
+    DECLARE v_booked INT;
+
+    -- Cancelled appointments do not take a place. Missing values are left for the INSERT or UPDATE to reject.
+    IF p_dateTime IS NOT NULL AND p_clinicId IS NOT NULL
+        AND NOT EXISTS (SELECT 1 FROM `Statuses` WHERE `statusId` = p_statusId AND `status` = 'Cancelled') THEN
+        SELECT TIMESTAMP(DATE(p_dateTime), `opensAt`), TIMESTAMP(DATE(p_dateTime), `closesAt`), `slotMinutes`, `slotCapacity`
+        INTO v_opensAt, v_closesAt, v_slotMinutes, v_slotCapacity
+        FROM `ClinicHours`
+        WHERE `clinicId` = p_clinicId AND `dayOfWeek` = WEEKDAY(p_dateTime)
+        FOR UPDATE;
+
+        IF v_opensAt IS NULL OR p_dateTime < v_opensAt OR p_dateTime >= v_closesAt THEN
+            SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT = 'The clinic is closed at that time';
+        END IF;
+
+        SET v_slotStart = v_opensAt
+            + INTERVAL (FLOOR(TIMESTAMPDIFF(MINUTE, v_opensAt, p_dateTime) / v_slotMinutes) * v_slotMinutes) MINUTE;
+
+        -- A range read of idx_appointments_clinic_datetime, reading the latest committed rows
+        SELECT COUNT(*) INTO v_booked
+        FROM `Appointments`
+        WHERE `clinicId` = p_clinicId
+        AND `dateTime` >= v_slotStart AND `dateTime` < v_slotStart + INTERVAL v_slotMinutes MINUTE
+        AND `appointmentId` <> COALESCE(p_appointmentId, 0)
+        AND `statusId` NOT IN (SELECT `statusId` FROM `Statuses` WHERE `status` = 'Cancelled')
+        LOCK IN SHARE MODE;
+
+        IF v_booked >= v_slotCapacity THEN
+            SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT = 'That time slot is already fully booked';
+        END IF;
+    END IF;
+END / /
+
+DELIMITER ;
+
+
 -- #############################
 -- CREATE clinic
 -- #############################
@@ -20,12 +161,18 @@ CREATE PROCEDURE sp_insert_clinic(
 BEGIN
     INSERT INTO `Clinics` (`address`, `city`, `state`, `postalCode`, `phoneNumber`)
     VALUES (p_address, p_city, p_state, p_postalCode, p_phoneNumber);
+    CALL sp_bump_table_version('Clinics');
 
 
     -- Store the ID of the last inserted row
     SELECT LAST_INSERT_ID() into p_id;
+    CALL sp_log_change('Clinics', p_id, 'insert');
+
+    -- Open the new clinic with the default hours
+    CALL sp_default_clinic_hours();
+
     -- Display the ID of the last inserted clinic
-    SELECT LAST_INSERT_ID() AS 'new_id';
+    SELECT p_id AS 'new_id';
 END / /
 
 DELIMITER ;
@@ -54,12 +201,14 @@ CREATE PROCEDURE sp_insert_patient(
 BEGIN
     INSERT INTO `Patients` (`firstName`, `lastName`, `phoneNumber`, `email`, `dateOfBirth`, `gender`, `clinicId`)
     VALUES (p_firstName, p_lastName, p_phoneNumber, p_email, p_dateOfBirth, p_gender, p_clinicId);
+    CALL sp_bump_table_version('Patients');
 
 
     -- Store the ID of the last inserted row
     SELECT LAST_INSERT_ID() into p_id;
+    CALL sp_log_change('Patients', p_id, 'insert');
     -- Display the ID of the last inserted patient
-    SELECT LAST_INSERT_ID() AS 'new_id';
+    SELECT p_id AS 'new_id';
 END / /
 
 DELIMITER ;
@@ -83,13 +232,18 @@ CREATE PROCEDURE sp_insert_appointment(
 
 -- Begin the transaction to insert the given data into Appointments
 BEGIN
+    CALL sp_check_availability(NULL, p_dateTime, p_clinicId, p_statusId);
+
     INSERT INTO `Appointments` (`dateTime`, `clinicId`,`patientId`,`statusId`)
     VALUES(p_dateTime, p_clinicId, p_patientId, p_statusId);
+    CALL sp_count_busyness(p_clinicId, p_dateTime, p_statusId, 1);
+    CALL sp_bump_table_version('Appointments');
 
     -- Store the ID of the last inserted row
     SELECT LAST_INSERT_ID() into p_id;
+    CALL sp_log_change('Appointments', p_id, 'insert');
     -- Display the ID of the last inserted appointment
-    SELECT LAST_INSERT_ID() AS 'new_id';
+    SELECT p_id AS 'new_id';
 END / /
 
 DELIMITER ;
@@ -115,11 +269,13 @@ CREATE PROCEDURE sp_insert_appointmenttest(
 BEGIN
     INSERT INTO `AppointmentsTests` (`appointmentId`, `testId`, `testResultId`)
     VALUES (p_appointmentId, p_testId, p_testResultId);
+    CALL sp_bump_table_version('AppointmentsTests');
 
     -- Store the ID of the last inserted row
     SELECT LAST_INSERT_ID() into p_id;
+    CALL sp_log_change('AppointmentsTests', p_id, 'insert');
     -- Display the ID of the last inserted appointmentTest
-    SELECT LAST_INSERT_ID() AS 'new_id';
+    SELECT p_id AS 'new_id';
 END / /
 
 DELIMITER ;
@@ -143,12 +299,14 @@ CREATE PROCEDURE sp_insert_test(
 BEGIN
     INSERT INTO `Tests` (`name`)
     VALUES (p_name);
+    CALL sp_bump_table_version('Tests');
 
 
     -- Store the ID of the last inserted row
     SELECT LAST_INSERT_ID() into p_id;
+    CALL sp_log_change('Tests', p_id, 'insert');
     -- Display the ID of the last inserted appointmentTest
-    SELECT LAST_INSERT_ID() AS 'new_id';
+    SELECT p_id AS 'new_id';
 END / /
 
 DELIMITER ;
@@ -172,11 +330,19 @@ BEGIN
         END;
     -- Start the transaction to delete from Tests at the given Id
     START TRANSACTION;
+        -- Its scheduled tests are deleted with it (ON DELETE CASCADE)
+        INSERT INTO `ChangeLog` (`tableName`, `rowId`, `operation`)
+        SELECT 'AppointmentsTests', `appointmentTestId`, 'delete' FROM `AppointmentsTests` WHERE `testId` = p_testId;
+
         DELETE FROM `Tests` WHERE `testId` = p_testId;
         IF ROW_COUNT() =0 THEN
             SET error_message = CONCAT('No matching record found in Tests for testId:', p_testId);
             SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT = error_message;
         END IF;
+        CALL sp_log_change('Tests', p_testId, 'delete');
+        CALL sp_bump_table_version('Tests');
+        -- Its scheduled tests are deleted too (ON DELETE CASCADE)
+        CALL sp_bump_table_version('AppointmentsTests');
     COMMIT;
 END / /
 
@@ -200,11 +366,31 @@ BEGIN
         END;
     -- Start the transaction to delete from clincs at the given Id
     START TRANSACTION;
+        -- Log the rows the delete cascades to (see below) while they can still be found
+        INSERT INTO `ChangeLog` (`tableName`, `rowId`, `operation`)
+        SELECT 'AppointmentsTests', `AppointmentsTests`.`appointmentTestId`, 'update'
+        FROM `AppointmentsTests`
+        JOIN `Appointments` ON `AppointmentsTests`.`appointmentId` = `Appointments`.`appointmentId`
+        WHERE `Appointments`.`clinicId` = p_clinicId;
+
+        INSERT INTO `ChangeLog` (`tableName`, `rowId`, `operation`)
+        SELECT 'Appointments', `appointmentId`, 'delete' FROM `Appointments` WHERE `clinicId` = p_clinicId;
+
+        INSERT INTO `ChangeLog` (`tableName`, `rowId`, `operation`)
+        SELECT 'Patients', `patientId`, 'update' FROM `Patients` WHERE `clinicId` = p_clinicId;
+
         DELETE FROM `Clinics` WHERE `clinicId` = p_clinicId;
         IF ROW_COUNT() =0 THEN
             SET error_message = CONCAT('No matching record found in Clinics for clinicId:', p_clinicId);
             SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT = error_message;
         END IF;
+        CALL sp_log_change('Clinics', p_clinicId, 'delete');
+        CALL sp_bump_table_version('Clinics');
+        -- Its appointments are deleted (ON DELETE CASCADE), which unlinks their scheduled tests,
+        -- and its patients lose their primary clinic (ON DELETE SET NULL)
+        CALL sp_bump_table_version('Appointments');
+        CALL sp_bump_table_version('AppointmentsTests');
+        CALL sp_bump_table_version('Patients');
     COMMIT;
 END / /
 
@@ -224,6 +410,9 @@ CREATE PROCEDURE sp_delete_appointment(IN p_appointmentId INT)
 BEGIN
 -- Create the exit handler to handle errors, rollback as necessary
     DECLARE error_message VARCHAR(255);
+    DECLARE v_clinicId INT;
+    DECLARE v_dateTime DATETIME;
+    DECLARE v_statusId INT;
     DECLARE EXIT HANDLER FOR SQLEXCEPTION
         BEGIN
             ROLLBACK;
@@ -231,11 +420,24 @@ BEGIN
         END;
     -- Start the transaction to delete from Appointments at the given Id
     START TRANSACTION;
+        -- Remember what the appointment counted towards in the busyness rollup
+        SELECT `clinicId`, `dateTime`, `statusId` INTO v_clinicId, v_dateTime, v_statusId
+        FROM `Appointments` WHERE `appointmentId` = p_appointmentId FOR UPDATE;
+
+        -- Its scheduled tests lose their appointment (see below)
+        INSERT INTO `ChangeLog` (`tableName`, `rowId`, `operation`)
+        SELECT 'AppointmentsTests', `appointmentTestId`, 'update' FROM `AppointmentsTests` WHERE `appointmentId` = p_appointmentId;
+
         DELETE FROM `Appointments` WHERE `appointmentId` = p_appointmentId;
         IF ROW_COUNT() =0 THEN
             SET error_message = CONCAT('No matching record found in Appointments for appointmentId:', p_appointmentId);
             SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT = error_message;
         END IF;
+        CALL sp_count_busyness(v_clinicId, v_dateTime, v_statusId, -1);
+        CALL sp_log_change('Appointments', p_appointmentId, 'delete');
+        -- Its scheduled tests lose their appointment (ON DELETE SET NULL)
+        CALL sp_bump_table_version('Appointments');
+        CALL sp_bump_table_version('AppointmentsTests');
     COMMIT;
 END / /
 
@@ -271,6 +473,8 @@ BEGIN
     `gender` = p_gender,
     `clinicId` = p_clinicId
     WHERE `patientId` = p_patientId;
+    CALL sp_bump_table_version('Patients');
+    CALL sp_log_change('Patients', p_patientId, 'update');
 END / /
 DELIMITER ;
 
@@ -293,6 +497,8 @@ BEGIN
     UPDATE `Tests`
     SET `name` = p_name
     WHERE `testId` = p_testId;
+    CALL sp_bump_table_version('Tests');
+    CALL sp_log_change('Tests', p_testId, 'update');
 END / /
 DELIMITER ;
 -- ###################
@@ -321,6 +527,8 @@ BEGIN
     `postalCode` = p_postalCode,
     `phoneNumber`= p_phoneNumber
     WHERE `clinicId` = p_clinicId;
+    CALL sp_bump_table_version('Clinics');
+    CALL sp_log_change('Clinics', p_clinicId, 'update');
 END / /
 DELIMITER ;
 
@@ -342,12 +550,39 @@ CREATE PROCEDURE `sp_update_appointment`(
     )
 -- Begin the transaction to update Appointments at the given Id, with the given data
 BEGIN
+    DECLARE v_clinicId INT;
+    DECLARE v_dateTime DATETIME;
+    DECLARE v_statusId INT;
+
+    -- Remember what the appointment counted towards in the busyness rollup
+    SELECT `clinicId`, `dateTime`, `statusId` INTO v_clinicId, v_dateTime, v_statusId
+    FROM `Appointments` WHERE `appointmentId` = p_appointmentId FOR UPDATE;
+
+    -- A move to another clinic or time needs a free slot, and so does a cancelled
+    -- appointment that is rebooked, since cancelled appointments do not take a place
+    IF v_clinicId IS NOT NULL AND (
+        NOT (v_clinicId <=> p_clinicId AND v_dateTime <=> p_dateTime)
+        OR (NOT v_statusId <=> p_statusId
+            AND EXISTS (SELECT 1 FROM `Statuses` WHERE `statusId` = v_statusId AND `status` = 'Cancelled'))
+    ) THEN
+        CALL sp_check_availability(p_appointmentId, p_dateTime, p_clinicId, p_statusId);
+    END IF;
+
     UPDATE `Appointments`
     SET `dateTime` = p_dateTime,
     `clinicId` = p_clinicId,
     `patientId`= p_patientId,
     `statusId` = p_statusId
     WHERE `appointmentId` = p_appointmentId;
+
+    -- Move the appointment's count when its clinic, day or status changed
+    IF v_clinicId IS NOT NULL
+        AND NOT (v_clinicId = p_clinicId AND DATE(v_dateTime) = DATE(p_dateTime) AND v_statusId = p_statusId) THEN
+        CALL sp_count_busyness(v_clinicId, v_dateTime, v_statusId, -1);
+        CALL sp_count_busyness(p_clinicId, p_dateTime, p_statusId, 1);
+    END IF;
+    CALL sp_bump_table_version('Appointments');
+    CALL sp_log_change('Appointments', p_appointmentId, 'update');
 END / /
 DELIMITER ;
 
@@ -374,6 +609,8 @@ BEGIN
     `testId` = p_testId,
     `testResultId`= p_testResultId
     WHERE `appointmentTestId` = p_appointmentTestId;
+    CALL sp_bump_table_version('AppointmentsTests');
+    CALL sp_log_change('AppointmentsTests', p_appointmentTestId, 'update');
 END / /
 DELIMITER ;
 
@@ -396,6 +633,8 @@ BEGIN
     UPDATE `Statuses`
     SET `status` = p_status
     WHERE `statusId` = p_statusid;
+    CALL sp_bump_table_version('Statuses');
+    CALL sp_log_change('Statuses', p_statusId, 'update');
 END / /
 DELIMITER ;
 
@@ -417,6 +656,8 @@ BEGIN
     UPDATE `Results`
     SET `result` = p_result
     WHERE `testResultId` = p_resultId;
+    CALL sp_bump_table_version('Results');
+    CALL sp_log_change('Results', p_resultId, 'update');
 END / /
 DELIMITER ;
 
@@ -0,0 +1,242 @@
+import bisect
+import itertools
+import math
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows, where each worker keeps to the class limits on its own
+    fcntl = None
+
+# Turn requests away when their routes are over their limits (false admits every request)
+ADMISSION_CONTROL = os.environ.get("ADMISSION_CONTROL", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+# Requests each worker handles at once across every route class, 0 for no limit. While
+# they are all taken, waiting requests are admitted in order of their class's priority.
+# Only a worker with threads (gunicorn --threads) handles more than one at once.
+ADMISSION_MAX_CONCURRENT = int(os.environ.get("ADMISSION_MAX_CONCURRENT", 6))
+
+# Directory of the lock files through which the workers on the host share the limit of
+# each route class, so it holds however many workers there are
+ADMISSION_DIR = os.environ.get(
+    "ADMISSION_DIR",
+    os.path.join(tempfile.gettempdir(), "capital-family-clinic-admission"),
+)
+
+# Seconds between a waiting request's tries for a place shared by the host's workers
+HOST_POLL_SECONDS = 0.05
+
+# Longest Retry-After sent with a turned away request, in seconds
+MAX_RETRY_AFTER = 60
+
+
+class Overloaded(Exception):
+    """
+    raised when a request is turned away because too many like it are being handled
+    retry_after: whole seconds after which the request is likely to be admitted
+    """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RouteClass:
+    """
+    limits of one class of routes
+    limit: requests of the class handled at once by all the workers on the host, 0 for no limit
+    queue: requests of the class that may wait for a place; any more are turned away at once
+    wait: seconds a request may wait for a place before it is turned away
+    priority: waiting requests of a higher priority class are admitted first
+    """
+
+    def __init__(self, name, limit, queue, wait, priority):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.wait = wait
+        self.priority = priority
+        self.running = 0
+        self.waiting = 0
+        self.duration = None  # Moving average of the seconds a request holds its place
+
+
+def route_class(name, limit, queue, wait, priority):
+    """
+    returns: a RouteClass, with each setting overridden by ADMISSION_<NAME>_<SETTING>
+    when it is set (e.g. ADMISSION_REPORTS_LIMIT)
+    """
+    prefix = f"ADMISSION_{name.upper()}_"
+    return RouteClass(
+        name,
+        limit=int(os.environ.get(prefix + "LIMIT", limit)),
+        queue=int(os.environ.get(prefix + "QUEUE", queue)),
+        wait=float(os.environ.get(prefix + "WAIT", wait)),
+        priority=int(os.environ.get(prefix + "PRIORITY", priority)),
+    )
+
+
+# The front desk's pages and writes are never limited on their own and go first when the
+# worker is full. Reports over long date ranges and the routes that start a job over every
+# table may only take a few places, so they cannot crowd out the front desk.
+ROUTE_CLASSES = (
+    route_class("interactive", limit=0, queue=20, wait=5, priority=10),
+    route_class("reports", limit=2, queue=4, wait=2, priority=5),
+    route_class("jobs", limit=1, queue=2, wait=1, priority=0),
+)
+
+
+def _take_host_place(directory, name, limit, deadline):
+    """
+    takes one of the places of a route class shared by the workers on the host: a lock
+    file held until the request is answered, which the system gives back if the worker dies
+    returns: the file descriptor of the place, to close once the request is answered,
+    or None when no place came free before the deadline
+    """
+    os.makedirs(directory, exist_ok=True)
+    while True:
+        for place in range(limit):
+            fd = os.open(
+                os.path.join(directory, f"{name}-{place}.lock"),
+                os.O_RDWR | os.O_CREAT,
+            )
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(HOST_POLL_SECONDS)
+
+
+class AdmissionController:
+    """
+    admits each request of a worker once its route class, and the worker, have a place
+    for it. A request waits for a place in a bounded queue, and is turned away with
+    Overloaded when the queue is full or it has waited too long, so an overloaded route
+    is answered at once rather than tying up every thread of the worker.
+    The threads of the worker queue in order of priority; the limit of a class is then
+    shared with the other workers on the host through lock files in directory.
+    classes: the RouteClasses, by which requests are limited
+    max_concurrent: requests admitted at once across every class, 0 for no limit
+    directory: where the places shared by the host's workers are, None to limit each
+    worker on its own
+    """
+
+    def __init__(
+        self,
+        classes=ROUTE_CLASSES,
+        max_concurrent=ADMISSION_MAX_CONCURRENT,
+        directory=ADMISSION_DIR,
+    ):
+        self.classes = {route_class.name: route_class for route_class in classes}
+        self.max_concurrent = max_concurrent
+        self.directory = directory if fcntl is not None else None
+        self._lock = threading.Condition()
+        self._running = 0
+        # Sorted list of (-priority, arrival, RouteClass), highest priority first
+        self._waiters = []
+        self._arrivals = itertools.count()
+
+    def _has_room(self, route_class):
+        return (not route_class.limit or route_class.running < route_class.limit) and (
+            not self.max_concurrent or self._running < self.max_concurrent
+        )
+
+    def _next(self):
+        # The first waiter whose class has room; waiters held back by their own class's
+        # limit do not hold back the classes behind them
+        for waiter in self._waiters:
+            if self._has_room(waiter[2]):
+                return waiter
+        return None
+
+    def _retry_after(self, route_class):
+        # Time for the requests ahead to finish, from how long the class's requests
+        # have lately taken
+        duration = route_class.duration or route_class.wait or 1
+        seconds = duration * (route_class.waiting + 1) / (route_class.limit or 1)
+        return min(MAX_RETRY_AFTER, max(1, math.ceil(seconds)))
+
+    def admit(self, name):
+        """
+        waits for a place for a request of the given class
+        returns: a function that gives the place back, to call once the request is answered
+        raises: Overloaded when the class's queue is full or the wait ran out
+        """
+        route_class = self.classes[name]
+        deadline = time.monotonic() + route_class.wait
+
+        with self._lock:
+            waiter = (-route_class.priority, next(self._arrivals), route_class)
+            bisect.insort(self._waiters, waiter)
+            try:
+                if self._next() is not waiter:
+                    if route_class.waiting >= route_class.queue:
+                        raise Overloaded(
+                            f"{name} queue is full",
+                            self._retry_after(route_class),
+                        )
+
+                    route_class.waiting += 1
+                    try:
+                        while self._next() is not waiter:
+                            remaining = deadline - time.monotonic()
+                            if remaining <= 0:
+                                raise Overloaded(
+                                    f"Waited {route_class.wait}s for a place for a {name} request",
+                                    self._retry_after(route_class),
+                                )
+                            self._lock.wait(remaining)
+                    finally:
+                        route_class.waiting -= 1
+            finally:
+                self._waiters.remove(waiter)
+                # Leaving the queue may let a waiter of another class through
+                self._lock.notify_all()
+
+            route_class.running += 1
+            self._running += 1
+
+        # The other workers' requests of the class hold the rest of its places on the host
+        host_place = None
+        if route_class.limit and self.directory:
+            host_place = _take_host_place(
+                self.directory, name, route_class.limit, deadline
+            )
+            if host_place is None:
+                self._leave(route_class)
+                raise Overloaded(
+                    f"Waited {route_class.wait}s for a place for a {name} request on this host",
+                    self._retry_after(route_class),
+                )
+
+        started = time.monotonic()
+
+        def release():
+            if host_place is not None:
+                os.close(host_place)
+            self._leave(route_class, time.monotonic() - started)
+
+        return release
+
+    def _leave(self, route_class, duration=None):
+        # Gives back a request's place in the worker, and lets the next waiter through
+        with self._lock:
+            route_class.running -= 1
+            self._running -= 1
+            if duration is not None:
+                route_class.duration = (
+                    duration
+                    if route_class.duration is None
+                    else 0.8 * route_class.duration + 0.2 * duration
+                )
+            self._lock.notify_all()
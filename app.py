@@ -1,10 +1,47 @@
 # ########################################
 # ########## SETUP
 
-from flask import Flask, render_template, request, redirect, url_for, flash
+from flask import (
+    Flask,
+    Response,
+    render_template,
+    request,
+    redirect,
+    url_for,
+    flash,
+    g,
+    get_flashed_messages,
+    get_template_attribute,
+    jsonify,
+    make_response,
+    message_flashed,
+    session,
+    stream_template,
+    send_file,
+    stream_with_context,
+)
+import pymysql
 import database.db_connector as db
-import flask_excel as excel
+from database.rows import SSRowCursor
+from database.cache import (
+    FragmentCache,
+    ReferenceCache,
+    TemplateBytecodeCache,
+    fetch_versions,
+)
+from database import profiler
+import admission
+import availability
+import batch
+import changes
+import click
+import jobs
+import functools
+import glob
+import hashlib
 import os
+from markupsafe import Markup
+from datetime import date, datetime, timedelta
 from dotenv import load_dotenv
 
 PORT = 3000
@@ -12,9 +49,791 @@ PORT = 3000
 load_dotenv()
 
 app = Flask(__name__)
-excel.init_excel(app)
 app.secret_key = os.environ.get("SECRET_KEY")
 
+# Directory of compiled templates, filled by flask compile-templates before deploying
+TEMPLATE_CACHE_DIR = os.environ.get(
+    "TEMPLATE_CACHE_DIR", os.path.join(app.root_path, ".template_cache")
+)
+app.jinja_options = {
+    **app.jinja_options,
+    "bytecode_cache": TemplateBytecodeCache(TEMPLATE_CACHE_DIR),
+}
+
+# Number of rows shown per page on the list pages, and the most a user may ask for
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", 50))
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", 500))
+
+# Patients or appointments offered at most when a form's patient or appointment field is searched
+OPTION_SEARCH_LIMIT = int(os.environ.get("OPTION_SEARCH_LIMIT", 20))
+
+# Cache of the Statuses, Results, Tests and Clinics lists used by the dropdowns
+reference_cache = ReferenceCache()
+
+# Cache of the rendered tables of the Appointments, Patients and Scheduled Tests pages
+fragment_cache = FragmentCache()
+
+# Send the Appointments and Scheduled Tests pages while they render, reading their rows as they go
+STREAM_PAGES = os.environ.get("STREAM_PAGES", "true").lower() in ("1", "true", "yes")
+
+# Bytes of a streamed page collected before they are sent
+STREAM_CHUNK_BYTES = int(os.environ.get("STREAM_CHUNK_BYTES", 16 * 1024))
+
+# Send a Server-Timing header with the database time of each request (always on in debug mode)
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "").lower() in ("1", "true", "yes")
+
+# ########################################
+# ########## ADMISSION CONTROL
+
+# Routes limited apart from the front desk's pages and writes (see admission.ROUTE_CLASSES):
+# the routes that start a job over every table, and the reports over long date ranges
+ROUTE_CLASSES = {
+    "reset": "jobs",
+    "export": "jobs",
+    "import_data": "jobs",
+    "download_job": "reports",
+    "busyness": "reports",
+    "scheduledtests_chart": "reports",
+    "api_changes": "reports",
+}
+
+# Places of the requests this worker is handling, by route class
+admission_control = admission.AdmissionController()
+
+
+def overloaded(error):
+    """
+    answers a request that was turned away with 503 and when to try again, as JSON for
+    API clients
+    error: the admission.Overloaded it was turned away with
+    """
+    print(f"Turned away {request.method} {request.path}: {error}")
+    headers = {"Retry-After": str(error.retry_after)}
+    message = f"The server is busy. Try again in {error.retry_after} seconds."
+    if (
+        request.path.startswith("/api/")
+        or request.accept_mimetypes.best == "application/json"
+    ):
+        return jsonify(error=message), 503, headers
+    return message, 503, headers
+
+
+# Registered before the other request hooks, so a request that is turned away does no
+# other work
+@app.before_request
+def admit_request():
+    if not admission.ADMISSION_CONTROL or request.endpoint in (None, "static"):
+        return None
+    try:
+        g.release_admission = admission_control.admit(
+            ROUTE_CLASSES.get(request.endpoint, "interactive")
+        )
+    except admission.Overloaded as e:
+        return overloaded(e)
+
+
+@app.after_request
+def release_admission_on_close(response):
+    release = g.pop("release_admission", None)
+    if release:
+        # A streamed page keeps its place until it has been sent
+        response.call_on_close(release)
+    return response
+
+
+@app.teardown_request
+def release_admission(exception=None):
+    # A request that failed before it had a response
+    release = g.pop("release_admission", None)
+    if release:
+        release()
+
+
+# ########################################
+# ########## QUERY PROFILING
+
+
+@app.before_request
+def start_query_profile():
+    profiler.start(f"{request.method} {request.path}")
+
+
+def log_query_profile(profile):
+    print(
+        f"{profile.label}: {profile.count} queries, "
+        f"{profile.total * 1000:.1f} ms in the database"
+    )
+
+
+@app.after_request
+def report_query_profile(response):
+    # A streamed page has taken its profile and reports it once it has been sent
+    profile = profiler.stop()
+    if profile is None:
+        return response
+
+    log_query_profile(profile)
+    if SERVER_TIMING or app.debug:
+        response.headers.add("Server-Timing", profile.server_timing())
+    return response
+
+
+# ########################################
+# ########## READ REPLICAS
+
+# Cookie that sends a client's reads to the primary for a while after it wrote
+READ_PRIMARY_COOKIE = "read_primary"
+
+
+@app.before_request
+def route_reads():
+    # Writes, and the pages a client loads right after writing, read from the primary
+    db.read_from_primary(
+        request.method not in ("GET", "HEAD") or READ_PRIMARY_COOKIE in request.cookies
+    )
+
+
+@app.after_request
+def stick_to_primary(response):
+    if db.replicas and request.method not in ("GET", "HEAD"):
+        response.set_cookie(
+            READ_PRIMARY_COOKIE,
+            "1",
+            max_age=int(db.read_your_writes_seconds),
+            httponly=True,
+            samesite="Lax",
+        )
+    return response
+
+
+# ########################################
+# ########## REFERENCE DATA
+
+
+def table_versions(dbConnection):
+    """
+    returns the current table versions, looked up once per request
+    """
+    if "table_versions" not in g:
+        g.table_versions = fetch_versions(dbConnection)
+    return g.table_versions
+
+
+def get_reference(dbConnection, table, query):
+    """
+    returns the rows of a query on a reference table, from the cache while the table is unchanged
+    """
+    return reference_cache.get(dbConnection, table, query, table_versions(dbConnection))
+
+
+# ########################################
+# ########## CONDITIONAL GETS
+
+# Changes whenever the code or templates that render the pages change, so a new
+# deploy never answers 304 for a page rendered by the old one
+PAGE_SOURCE_HASH = hashlib.sha1()
+for source_file in [__file__] + sorted(
+    glob.glob(os.path.join(os.path.dirname(__file__), "templates", "*.j2"))
+):
+    with open(source_file, "rb") as source:
+        PAGE_SOURCE_HASH.update(source.read())
+PAGE_SOURCE_HASH = PAGE_SOURCE_HASH.hexdigest()
+
+
+@message_flashed.connect_via(app)
+def remember_flash(sender, message, category, **extra):
+    # The page renders (and so consumes) its flashed messages before versioned() sees it
+    g.flashed = True
+
+
+def versioned(*tables):
+    """
+    decorator for GET routes whose response only depends on the URL and the given tables.
+    The ETag of the response is built from the versions of those tables in TableVersions,
+    so a request whose If-None-Match still matches gets a 304 after one version lookup,
+    without the page's queries or rendering.
+    tables: every table the page reads, including the ones it joins
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            # A pending flash message has to be rendered, so the page cannot be skipped
+            if request.method != "GET" or "_flashes" in session:
+                return view(*args, **kwargs)
+
+            try:
+                dbConnection = db.connectDB()
+                versions = table_versions(dbConnection)
+            except Exception as e:
+                print(f"Error executing queries: {e}")
+                versions = {}
+            finally:
+                if "dbConnection" in locals() and dbConnection:
+                    dbConnection.close()
+
+            if any(table not in versions for table in tables):
+                return view(*args, **kwargs)
+
+            etag = hashlib.sha1(
+                repr(
+                    (
+                        PAGE_SOURCE_HASH,
+                        request.full_path,
+                        [versions[table] for table in tables],
+                    )
+                ).encode()
+            ).hexdigest()
+            if request.if_none_match.contains(etag):
+                response = make_response("", 304)
+                response.set_etag(etag)
+                return response
+
+            response = make_response(view(*args, **kwargs))
+            # Pages that flashed an error are not tagged, so they are never reused. Nor are
+            # streamed pages, whose headers are sent before it is known whether they render
+            # to the end.
+            if (
+                response.status_code == 200
+                and not g.get("flashed")
+                and not response.is_streamed
+            ):
+                response.set_etag(etag)
+                # Let browsers keep the page, but check its ETag before every reuse
+                response.cache_control.no_cache = True
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+# ########################################
+# ########## CONCURRENT QUERIES
+
+
+def fetch_all(query, query_params=()):
+    """
+    returns a db.gather() task that runs query and fetches all of its rows
+    """
+    return lambda dbConnection: db.query(dbConnection, query, query_params).fetchall()
+
+
+def reference_lists(*lists, versions=None):
+    """
+    returns a db.gather() task that reads (table, query) reference lists through the cache.
+    versions: the table versions, when the request already looked them up. Otherwise the
+    task looks them up itself, since it cannot use the request's g from a worker thread.
+    returns (from the task): the rows of each list, in the same order as lists
+    """
+
+    def task(dbConnection):
+        nonlocal versions
+        if versions is None:
+            versions = fetch_versions(dbConnection)
+        return [
+            reference_cache.get(dbConnection, table, query, versions)
+            for table, query in lists
+        ]
+
+    return task
+
+
+# ########################################
+# ########## FRAGMENT CACHE
+
+
+def fragment_key(dbConnection, template, *tables):
+    """
+    returns the fragment cache key of a list table rendered from template for the current
+    request, or None when a table's version is unknown (the table is then never cached)
+    tables: every table the rendered rows are read from, including the ones joined
+    """
+    versions = table_versions(dbConnection)
+    if any(table not in versions for table in tables):
+        return None
+
+    # The id parameter only opens the update form, which is not part of the table
+    args = sorted((k, v) for k, v in request.args.items(multi=True) if k != "id")
+    return (
+        template,
+        PAGE_SOURCE_HASH,
+        tuple(versions[table] for table in tables),
+        tuple(args),
+    )
+
+
+def render_fragment(key, template, **context):
+    """
+    renders a list table and stores it in the fragment cache under key (unless key is None)
+    returns: the HTML, marked safe to include in the page
+    """
+    html = render_template(template, **context)
+    if key is not None:
+        fragment_cache.put(key, html)
+    return Markup(html)
+
+
+# ########################################
+# ########## PAGINATION
+
+
+def get_page_args():
+    """
+    reads the keyset pagination query parameters of the current request
+    returns: (after, before, limit). after/before are the id cursors (or None)
+    """
+    try:
+        limit = int(request.args.get("limit", PAGE_SIZE))
+    except ValueError:
+        limit = PAGE_SIZE
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    after = request.args.get("after", type=int)
+    before = request.args.get("before", type=int) if after is None else None
+    return after, before, limit
+
+
+def page_url(**cursor):
+    """
+    builds the url of another page of the current list, keeping the other query parameters
+    """
+    args = request.args.to_dict(flat=False)
+    for key in ("after", "before", "id"):
+        args.pop(key, None)
+    args.update(cursor)
+    return url_for(request.endpoint, **args)
+
+
+def build_page_query(select_query, key_column, conditions=(), query_params=()):
+    """
+    builds the query for one page of the current list, plus one row to know whether there
+    is another page in that direction. Pages before a cursor are read in descending order.
+    returns: (page_query, query_params)
+    """
+    after, before, limit = get_page_args()
+    conditions = list(conditions)
+    query_params = list(query_params)
+
+    if before is not None:
+        conditions.append(f"{key_column} < %s")
+        query_params.append(before)
+        order = "DESC"
+    else:
+        if after is not None:
+            conditions.append(f"{key_column} > %s")
+            query_params.append(after)
+        order = "ASC"
+
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    page_query = f"{select_query}{where} ORDER BY {key_column} {order} LIMIT %s;"
+    return page_query, (*query_params, limit + 1)
+
+
+def fetch_page(
+    dbConnection, select_query, key_column, key_name, conditions=(), query_params=()
+):
+    """
+    runs select_query for one page of rows, using the key column as a keyset cursor
+    select_query: SELECT ... FROM ... JOIN ... with no WHERE, ORDER BY or LIMIT
+    key_column: the unique, indexed column to page on (e.g. Appointments.appointmentId)
+    key_name: the name of that column in the result rows (e.g. Appointment ID)
+    conditions: extra WHERE conditions, using %s placeholders filled from query_params
+    returns: (rows, page) where page holds the prev/next/first urls for the template
+    """
+    after, before, limit = get_page_args()
+    page_query, query_params = build_page_query(
+        select_query, key_column, conditions, query_params
+    )
+    rows = db.query(dbConnection, page_query, query_params).fetchall()
+
+    # One extra row is fetched to know whether there is another page in that direction
+    has_more = len(rows) > limit
+    rows = list(rows[:limit])
+    if before is not None:
+        # Walking backwards from the cursor, so flip the rows back into ascending order
+        rows.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = after is not None, has_more
+
+    page = {
+        "prev_url": page_url(before=rows[0][key_name], limit=limit)
+        if rows and has_prev
+        else None,
+        "next_url": page_url(after=rows[-1][key_name], limit=limit)
+        if rows and has_next
+        else None,
+        "first_url": page_url(limit=limit)
+        if after is not None or before is not None
+        else None,
+    }
+    return rows, page
+
+
+def stream_page(
+    dbConnection, select_query, key_column, key_name, conditions=(), query_params=()
+):
+    """
+    streaming version of fetch_page(): the rows are read with an unbuffered cursor as the
+    table is rendered, rather than fetched before it.
+    returns: (rows, page) where rows is a generator. page's next_url is only known once rows
+    has been read to the end, so the template must render the links after the rows.
+    """
+    after, before, limit = get_page_args()
+    if before is not None:
+        # Read in descending order, so the rows have to be flipped before they are shown
+        return fetch_page(
+            dbConnection, select_query, key_column, key_name, conditions, query_params
+        )
+
+    page_query, query_params = build_page_query(
+        select_query, key_column, conditions, query_params
+    )
+    page = {
+        "prev_url": None,
+        "next_url": None,
+        "first_url": page_url(limit=limit) if after is not None else None,
+    }
+
+    def rows():
+        last = None
+        # Read every row, the extra one included, so the cursor is finished with
+        for count, row in enumerate(
+            stream_rows(dbConnection, page_query, query_params)
+        ):
+            if count == limit:
+                page["next_url"] = page_url(after=last[key_name], limit=limit)
+                continue
+            if count == 0 and after is not None:
+                page["prev_url"] = page_url(before=row[key_name], limit=limit)
+            last = row
+            yield row
+
+    return rows(), page
+
+
+# ########################################
+# ########## STREAMED PAGES
+
+
+@app.template_global()
+def flush():
+    """
+    marks where a streamed page sends what it has rendered so far, e.g. before a table
+    whose rows are read while it renders. Does nothing on pages that are not streamed.
+    """
+    return ""
+
+
+def stream_rows(dbConnection, query, query_params=()):
+    """
+    generator of the rows of query, read with an unbuffered cursor.
+    The query only runs once the generator is first iterated, so the rows of a page can be
+    passed to its template and read as it renders. Generators on the same connection must
+    be read one after the other.
+    """
+    cursor = db.stream(dbConnection, query, query_params, cursor=SSRowCursor)
+    try:
+        yield from cursor
+    finally:
+        cursor.close()
+
+
+def stream_fragment(key, template, **context):
+    """
+    streaming version of render_fragment(): generator that yields a list table as it
+    renders, then stores it in the fragment cache (unless key is None)
+    """
+    chunks = []
+    for chunk in stream_template(template, **context):
+        chunks.append(chunk)
+        yield chunk
+    if key is not None:
+        fragment_cache.put(key, "".join(chunks))
+
+
+def stream_page_response(dbConnection, template, **context):
+    """
+    renders template into a response that is sent while it renders: every
+    STREAM_CHUNK_BYTES, and wherever the template calls flush().
+    The template may still read from dbConnection (see stream_rows()), so the response
+    closes it once it has been sent, and the caller must not close it.
+    """
+    # The session is saved before the page renders, so take the flashed messages out of it now
+    get_flashed_messages()
+    flushing = False
+
+    # The page's queries run as it is sent, after the request's hooks, so the profile
+    # is carried on by the generator. Its totals are logged but have no Server-Timing
+    # header, which is sent before them.
+    profile = profiler.stop()
+
+    def flush():
+        nonlocal flushing
+        flushing = True
+        return ""
+
+    def generate():
+        nonlocal flushing
+        chunk, size = [], 0
+        profiler.resume(profile)
+        try:
+            for piece in stream_template(template, flush=flush, **context):
+                chunk.append(piece)
+                size += len(piece)
+                if flushing or size >= STREAM_CHUNK_BYTES:
+                    yield "".join(chunk)
+                    chunk, size, flushing = [], 0, False
+            yield "".join(chunk)
+        except Exception as e:
+            # The start of the page has already been sent with a 200, so the error is
+            # raised to the server, which drops the connection rather than ending the
+            # response: the client sees a failed load, not a complete page it may reuse
+            print(f"Error executing queries: {e}")
+            yield "".join(chunk)
+            raise
+        finally:
+            profiler.stop()
+            if profile is not None:
+                log_query_profile(profile)
+
+    response = Response(stream_with_context(generate()), mimetype="text/html")
+    response.call_on_close(dbConnection.close)
+    return response
+
+
+# ########################################
+# ########## ROW FRAGMENTS
+
+# Rows of the table of each list page, with no WHERE, ORDER BY or LIMIT
+CLINICS_ROWS_QUERY = "SELECT clinicId AS 'Clinic ID', \
+                    address AS 'Address', \
+                    city AS `City`, \
+                    state AS `State`, \
+                    postalCode AS `Postal Code`, \
+                    phoneNumber AS `Phone Number` \
+                    FROM Clinics"
+
+APPOINTMENTS_ROWS_QUERY = "SELECT appointmentId AS `Appointment ID`, \
+                        DATE_FORMAT(dateTime, '%%m/%%d/%%Y %%h:%%i %%p') AS `Appointment Date Time`, \
+                        Clinics.displayName AS `Clinic`, \
+                        Patients.fullName AS `Patient Name`, \
+                        Statuses.status AS `Appointment Status` \
+                        FROM Appointments \
+                        JOIN Patients ON Appointments.patientId = Patients.patientId \
+                        JOIN Statuses ON Appointments.statusId = Statuses.statusId \
+                        JOIN Clinics ON Appointments.clinicId = Clinics.clinicId"
+
+PATIENTS_ROWS_QUERY = "SELECT patientId AS `Patient ID`, \
+                    firstName AS `First Name`, \
+                    lastName AS `Last Name`, \
+                    Patients.phoneNumber AS `Phone Number`, \
+                    email AS `Email`, \
+                    DATE_FORMAT(dateOfBirth, '%%m/%%d/%%Y') AS `Date Of Birth`, \
+                    gender AS `Gender`, \
+                    Clinics.displayName AS `Primary Clinic` \
+                    FROM Patients \
+                    LEFT JOIN Clinics ON Patients.clinicId = Clinics.clinicId"
+
+STATUSES_ROWS_QUERY = "SELECT statusId AS `Status ID`, \
+                    status AS `Status` \
+                    FROM Statuses"
+
+TESTS_ROWS_QUERY = "SELECT testId AS `Test ID`, name AS `Name` FROM Tests"
+
+RESULTS_ROWS_QUERY = "SELECT Results.testResultId AS `Test Result ID`, Results.result AS `Result` FROM Results"
+
+SCHEDULED_TESTS_ROWS_QUERY = "SELECT AppointmentsTests.appointmentTestId AS `Scheduled Test ID`, \
+                            Patients.fullName AS `Patient Name`, \
+                            Clinics.displayName AS `Clinic`,\
+                            DATE_FORMAT(Appointments.dateTime, '%%m/%%d/%%Y %%h:%%i %%p') AS `Appointment Date Time`, \
+                            Tests.name AS `Test Name`, \
+                            Results.result AS `Test Result` \
+                            FROM AppointmentsTests \
+                            LEFT JOIN Appointments on AppointmentsTests.appointmentId = Appointments.appointmentId \
+                            LEFT JOIN Patients on Appointments.patientId = Patients.patientId \
+                            JOIN Tests on AppointmentsTests.testId = Tests.testId \
+                            LEFT JOIN Results on AppointmentsTests.testResultId = Results.testResultId \
+                            LEFT JOIN Clinics ON Appointments.clinicId = Clinics.clinicId"
+
+# For each list page: (query of its rows, the column a row is found by, template of its row macro)
+ROW_FRAGMENTS = {
+    "clinics": (CLINICS_ROWS_QUERY, "Clinics.clinicId", "clinics_row.j2"),
+    "appointments": (
+        APPOINTMENTS_ROWS_QUERY,
+        "Appointments.appointmentId",
+        "appointments_row.j2",
+    ),
+    "patients": (PATIENTS_ROWS_QUERY, "Patients.patientId", "patients_row.j2"),
+    "statuses": (STATUSES_ROWS_QUERY, "Statuses.statusId", "statuses_row.j2"),
+    "tests": (TESTS_ROWS_QUERY, "Tests.testId", "tests_row.j2"),
+    "results": (RESULTS_ROWS_QUERY, "Results.testResultId", "results_row.j2"),
+    "scheduledtests": (
+        SCHEDULED_TESTS_ROWS_QUERY,
+        "AppointmentsTests.appointmentTestId",
+        "scheduledtests_row.j2",
+    ),
+}
+
+
+def wants_fragment():
+    """
+    returns whether a write was sent by script.js, which patches the list page's table
+    with the changed row instead of following a redirect and reloading the whole page
+    """
+    return request.headers.get("X-Fragment") == "row"
+
+
+def write_response(dbConnection, page, row_id, deleted=False):
+    """
+    answers a successful write from a list page: with a redirect back to the page, or for
+    script.js (see wants_fragment()) with only the <tr> of the created or updated row, read
+    with one query, or an empty <tr data-deleted> marker for a deleted row
+    page: endpoint of the list page, a key of ROW_FRAGMENTS
+    row_id: id of the created, updated or deleted row
+    """
+    if not wants_fragment():
+        return redirect(url_for(page))
+
+    rows_query, key_column, template = ROW_FRAGMENTS[page]
+    row = None
+    if not deleted:
+        row = db.query(
+            dbConnection, f"{rows_query} WHERE {key_column} = %s;", (row_id,)
+        ).fetchone()
+    if row is None:
+        return Markup('<tr data-id="%s" data-deleted></tr>') % row_id
+    return get_template_attribute(template, "row")(row)
+
+
+def write_failed(page):
+    """
+    answers a write that failed and flashed its error: with a redirect back to the list
+    page, or for script.js with a 500, after which it reloads the page to show the message
+    """
+    if wants_fragment():
+        return "", 500
+    return redirect(url_for(page))
+
+
+# ########################################
+# ########## SEARCH
+
+
+def escape_like(value):
+    """
+    escapes the LIKE wildcards in user input so it is matched literally
+    """
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def patient_name_search(search):
+    """
+    builds WHERE conditions matching patients whose names start with the search words.
+    Every condition is a prefix match on an index of Patients: fullName, (lastName, firstName)
+    or (firstName, lastName).
+    returns: (conditions, query_params) for fetch_page()
+    """
+    words = search.split()
+    if not words:
+        return [], []
+
+    first = escape_like(words[0]) + "%"
+    if len(words) == 1:
+        # One word may be the start of either name
+        return ["(Patients.firstName LIKE %s OR Patients.lastName LIKE %s)"], [
+            first,
+            first,
+        ]
+
+    # More words are the start of the full name, "first last" (which also finds first
+    # names of two words), or the starts of the first and last names in either order
+    # (e.g. "Jo Smi" finds John Smith)
+    full_name = escape_like(" ".join(words)) + "%"
+    rest = escape_like(" ".join(words[1:])) + "%"
+    return [
+        "(Patients.fullName LIKE %s \
+        OR (Patients.firstName LIKE %s AND Patients.lastName LIKE %s) \
+        OR (Patients.lastName LIKE %s AND Patients.firstName LIKE %s))"
+    ], [full_name, first, rest, first, rest]
+
+
+def appointment_label(row):
+    """
+    returns: the label of an appointment in the appointment field of the scheduled test
+    form, from a row with its patient's fullName, its formatted dateTime and its clinic's location
+    """
+    return f"{row['fullName']} - {row['dateTime']} at {row['location']}"
+
+
+# ########################################
+# ########## BACKGROUND JOBS
+
+
+def job_started(job_id):
+    """
+    answers a request that started (or joined) a background job: API clients that ask for
+    JSON get 202 with the URL to poll, browsers are sent to the job's page.
+    A job run inline (JOB_WORKERS=0) has finished by now, and its result is answered at
+    once, since the next request may reach a serverless instance that has no record of it.
+    """
+    if jobs.JOB_WORKERS == 0:
+        job = jobs.get(job_id)
+        if job is not None and job["status"] not in jobs.ACTIVE:
+            return job_finished(job)
+
+    if request.accept_mimetypes.best == "application/json":
+        status_url = url_for("api_job", job_id=job_id)
+        return (
+            jsonify(jobId=job_id, status=status_url),
+            202,
+            {"Location": status_url},
+        )
+    return redirect(url_for("job", job_id=job_id))
+
+
+def job_finished(job):
+    """
+    answers with the result of a finished job, as the routes did before they ran in jobs:
+    an export's file, an import's report, or back to the page a reset was started from
+    """
+    if job["status"] == "done" and job["kind"] == "export":
+        return send_file(
+            job["file"], as_attachment=True, download_name=job["result"]["fileName"]
+        )
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify(job_json(job))
+
+    if job["status"] == "failed":
+        flash(job["message"], "danger")
+        return redirect(url_for("home"))
+    if job["kind"] == "import":
+        return render_template(
+            "import.j2",
+            report=job["result"]["report"],
+            file_name=job["result"]["fileName"],
+        )
+    return redirect(request.referrer or url_for("home"))
+
+
+def job_json(job):
+    """
+    returns: what /api/jobs/<id> reports about a job
+    """
+    return {
+        "jobId": job["id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "progress": job["progress"],
+        "message": job["message"],
+        "result": job["result"],
+        "download": url_for("download_job", job_id=job["id"])
+        if job["status"] == "done" and job["file"]
+        else None,
+    }
+
+
 # ########################################
 # ########## ROUTE HANDLERS
 
@@ -31,106 +850,45 @@ def home():
         return "An error occurred while rendering the page.", 500
 
 
-# Reset database
+# Reset database, in a background job
 @app.route("/reset")
 def reset():
     try:
-        dbConnection = db.connectDB()  # Open our database connection
-        cursor = dbConnection.cursor()
+        # A reset that is already waiting or running is not started again
+        job_id = jobs.submit("reset", jobs.reset, key="reset")
+        return job_started(job_id)
 
-        # Create and execute our reset query to reset the database
-        reset_query = "CALL sp_load_clinicdb();"
-        cursor.execute(reset_query)
-
-        # Redirect user to same page they were on or to the home page
-        return redirect(request.referrer or url_for("home"))
+    except admission.Overloaded as e:
+        return overloaded(e)
 
     except Exception as e:
-        print(f"Error executing queries: {e}")
+        print(f"Error starting job: {e}")
         flash("Error resetting database", "danger")
         return redirect(url_for("home"))
 
-    finally:
-        # Close the DB connection, if it exists
-        if "dbConnection" in locals() and dbConnection:
-            dbConnection.close()
-
 
-# Reset database
+# Export database, in a background job
 @app.route("/export")
 def export():
+    # A zip of per-sheet CSV files, or a workbook
+    file_format = "zip" if request.args.get("format") == "zip" else "xlsx"
+
     try:
         dbConnection = db.connectDB()  # Open our database connection
 
-        # Query to display all clinics
-        get_clinics_query = "SELECT clinicId AS 'Clinic ID', \
-                            address AS 'Address', \
-                            city AS `City`, \
-                            state AS `State`, \
-                            postalCode AS `Postal Code`, \
-                            phoneNumber AS `Phone Number` \
-                            FROM Clinics;"
-        clinics = db.query(dbConnection, get_clinics_query).fetchall()
-
-        # Query to get all patients
-        get_patients_query = "SELECT patientId AS `Patient ID`, \
-                            firstName AS `First Name`, \
-                            lastName AS `Last Name`, \
-                            Patients.phoneNumber AS `Phone Number`, \
-                            email AS `Email`, \
-                            DATE_FORMAT(dateOfBirth, '%%m/%%d/%%Y') AS `Date Of Birth`, \
-                            gender AS `Gender`, \
-                            CONCAT('Capital Family Clinic at ', Clinics.address, ', ', Clinics.city, ', ', Clinics.state) AS `Primary Clinic` \
-                            FROM Patients \
-                            LEFT JOIN Clinics ON Patients.clinicId = Clinics.clinicId;"
-        patients = db.query(dbConnection, get_patients_query).fetchall()
-
-        # Query to display all appointments
-        get_appointments_query = "SELECT appointmentId AS `Appointment ID`, \
-                                DATE_FORMAT(dateTime, '%%m/%%d/%%Y %%h:%%i %%p') AS `Appointment Date Time`, \
-                                CONCAT('Capital Family Clinic at ', Clinics.address, ', ', Clinics.city, ', ', Clinics.state) AS `Clinic`, \
-                                CONCAT(Patients.firstName, ' ', Patients.lastName) AS `Patient Name`, \
-                                Statuses.status AS `Appointment Status` \
-                                FROM Appointments \
-                                JOIN Patients ON Appointments.patientId = Patients.patientId \
-                                JOIN Statuses ON Appointments.statusId = Statuses.statusId \
-                                JOIN Clinics ON Appointments.clinicId = Clinics.clinicId \
-                                ORDER BY appointmentId;"
-        appointments = db.query(dbConnection, get_appointments_query).fetchall()
-
-        # Query to get all appointmentstests
-        get_appointmentstests_info_query = (
-            "SELECT AppointmentsTests.appointmentTestId AS `Scheduled Test ID`, \
-                                            CONCAT(Patients.firstName, ' ', Patients.lastName) AS `Patient Name`, \
-                                            CONCAT('Capital Family Clinic at ', Clinics.address, ', ', Clinics.city, ', ', Clinics.state) AS `Clinic`,\
-                                            DATE_FORMAT(Appointments.dateTime, '%%m/%%d/%%Y %%h:%%i %%p') AS `Appointment Date Time`, \
-                                            Tests.name AS `Test Name`, \
-                                            Results.result AS `Test Result` \
-                                            FROM AppointmentsTests \
-                                            LEFT JOIN Appointments on AppointmentsTests.appointmentId = Appointments.appointmentId \
-                                            LEFT JOIN Patients on Appointments.patientId = Patients.patientId \
-                                            JOIN Tests on AppointmentsTests.testId = Tests.testId \
-                                            LEFT JOIN Results on AppointmentsTests.testResultId = Results.testResultId \
-                                            LEFT JOIN Clinics ON Appointments.clinicId = Clinics.clinicId \
-                                            ORDER BY appointmentTestId;"
+        # The file of an export is reused until one of the tables changes
+        key = jobs.export_key(file_format, table_versions(dbConnection))
+        job_id = jobs.submit(
+            "export", jobs.export, file_format, key=key, reuse_finished=True
         )
-        appointmentstests_info = db.query(
-            dbConnection, get_appointmentstests_info_query
-        ).fetchall()
-
-        data = {
-            "Clinics": convert_data(clinics),
-            "Patients": convert_data(patients),
-            "Appointments": convert_data(appointments),
-            "Scheduled Tests": convert_data(appointmentstests_info),
-        }
+        return job_started(job_id)
 
-        return excel.make_response_from_book_dict(
-            data, file_type="xlsx", file_name="exported_data.xlsx"
-        )
+    except admission.Overloaded as e:
+        return overloaded(e)
 
     except Exception as e:
-        print(f"Error executing queries: {e}")
+        print(f"Error starting job: {e}")
+        flash("Error exporting data", "danger")
         return redirect(url_for("home"))
 
     finally:
@@ -139,29 +897,89 @@ def export():
             dbConnection.close()
 
 
-def convert_data(data):
-    list_data = []
-    headers = list(data[0].keys())
-    list_data += [headers]
-    list_data += [[value for value in row.values()] for row in data]
-    return list_data
+# Import patients and appointments from a spreadsheet in the export layout, in a background job
+@app.route("/import", methods=["POST"])
+def import_data():
+    try:
+        upload = request.files.get("file")
+        if upload is None or not upload.filename:
+            flash("Choose a file to import", "danger")
+            return redirect(url_for("home"))
+
+        # The job reads the file once this request has finished
+        path = jobs.save_upload(upload)
+        try:
+            job_id = jobs.submit(
+                "import",
+                jobs.import_file,
+                path,
+                upload.filename,
+                request.form.get("sheet"),
+            )
+        except Exception:
+            # No job will read the file and delete it
+            os.remove(path)
+            raise
+        return job_started(job_id)
+
+    except admission.Overloaded as e:
+        return overloaded(e)
+
+    except Exception as e:
+        print(f"Error starting job: {e}")
+        flash("Error importing data", "danger")
+        return redirect(url_for("home"))
+
+
+# Display the progress of a background job, and its result once it has finished
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        flash("This job has finished too long ago, or does not exist", "danger")
+        return redirect(url_for("home"))
+
+    # A finished import shows its report, as the import did before it ran in a job
+    if job["kind"] == "import" and job["status"] == "done":
+        return render_template(
+            "import.j2",
+            report=job["result"]["report"],
+            file_name=job["result"]["fileName"],
+        )
+    return render_template("job.j2", job=job)
+
+
+# Progress of a background job, polled by the job page
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def api_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify(error="No such job"), 404
+    return jsonify(job_json(job))
+
+
+# Download the file written by a finished export job
+@app.route("/jobs/<job_id>/download", methods=["GET"])
+def download_job(job_id):
+    job = jobs.get(job_id)
+    if job is None or job["status"] != "done" or not job["file"]:
+        flash("This export is no longer available; export the data again", "danger")
+        return redirect(url_for("home"))
+    return send_file(
+        job["file"], as_attachment=True, download_name=job["result"]["fileName"]
+    )
 
 
 # Display clinics
 @app.route("/clinics", methods=["GET", "POST"])
+@versioned("Clinics")
 def clinics():
     try:
         dbConnection = db.connectDB()  # Open our database connection
 
         # Create and execute our queries
         # Query to display all clinics
-        get_clinics_query = "SELECT clinicId AS 'Clinic ID', \
-                            address AS 'Address', \
-                            city AS `City`, \
-                            state AS `State`, \
-                            postalCode AS `Postal Code`, \
-                            phoneNumber AS `Phone Number` \
-                            FROM Clinics;"
+        get_clinics_query = f"{CLINICS_ROWS_QUERY};"
         clinics = db.query(dbConnection, get_clinics_query).fetchall()
 
         # Use id query parameter to determine if user is updating or adding a clinic
@@ -232,15 +1050,18 @@ def create_clinic():
 
         dbConnection.commit()  # commit the transaction
 
+        # Drop this worker's cached copy of Clinics
+        reference_cache.invalidate("Clinics")
+
         print(f"CREATE clinic. ID: {new_id}")
 
-        # Redirect the user to the updated webpage
-        return redirect("/clinics")
+        # Redirect the user to the updated webpage, or send script.js the changed row
+        return write_response(dbConnection, "clinics", new_id)
 
     except Exception as e:
         print(f"Error executing queries: {e}")
         flash("Error creating clinic", "danger")
-        return redirect(url_for("clinics"))
+        return write_failed("clinics")
 
     finally:
         # Close the DB connection, if it exists
@@ -265,15 +1086,18 @@ def delete_clinic():
 
         dbConnection.commit()  # commit the transaction
 
+        # Drop this worker's cached copy of Clinics
+        reference_cache.invalidate("Clinics")
+
         print(f"DELETE clinic. ID: {clinic_id}")
 
-        # Redirect the user to the updated webpage
-        return redirect("/clinics")
+        # Redirect the user to the updated webpage, or send script.js the changed row
+        return write_response(dbConnection, "clinics", clinic_id, deleted=True)
 
     except Exception as e:
         print(f"Error executing queries: {e}")
         flash("Error deleting clinic", "danger")
-        return redirect(url_for("clinics"))
+        return write_failed("clinics")
 
     finally:
         # Close the DB connection, if it exists
@@ -346,17 +1170,20 @@ def update_clinic():
 
         dbConnection.commit()
 
+        # Drop this worker's cached copy of Clinics
+        reference_cache.invalidate("Clinics")
+
         print(
             f"Updated clinic. clinicid: {clinic_id} Address: {clinic_address}, {clinic_city}, {clinic_state}"
         )
 
-        # redirect back to the updated page
-        return redirect("/clinics")
+        # redirect back to the updated page, or send script.js the changed row
+        return write_response(dbConnection, "clinics", clinic_id)
 
     except Exception as e:
         print(f"Error executing queries: {e}")
         flash("Error updating clinic", "danger")
-        return redirect(url_for("clinics"))
+        return write_failed("clinics")
 
     finally:
         # Close the db connection, if it exists
@@ -366,77 +1193,134 @@ def update_clinic():
 
 # Display appointments
 @app.route("/appointments", methods=["GET", "POST"])
+@versioned("Appointments", "Clinics", "Patients", "Statuses")
 def appointments():
     try:
         dbConnection = db.connectDB()  # Open our database connection
 
-        # Query to display all appointments
-        get_appointments_query = "SELECT appointmentId AS `Appointment ID`, \
-                                DATE_FORMAT(dateTime, '%%m/%%d/%%Y %%h:%%i %%p') AS `Appointment Date Time`, \
-                                CONCAT('Capital Family Clinic at ', Clinics.address, ', ', Clinics.city, ', ', Clinics.state) AS `Clinic`, \
-                                CONCAT(Patients.firstName, ' ', Patients.lastName) AS `Patient Name`, \
-                                Statuses.status AS `Appointment Status` \
-                                FROM Appointments \
-                                JOIN Patients ON Appointments.patientId = Patients.patientId \
-                                JOIN Statuses ON Appointments.statusId = Statuses.statusId \
-                                JOIN Clinics ON Appointments.clinicId = Clinics.clinicId \
-                                ORDER BY appointmentId;"
-        appointments = db.query(dbConnection, get_appointments_query).fetchall()
+        # Query to display one page of appointments
+        get_appointments_query = APPOINTMENTS_ROWS_QUERY
+        search = request.args.get("q", "").strip()
+        conditions, query_params = patient_name_search(search)
 
         # Query to get clinics for the dropdown
         get_clinics_query = (
-            "SELECT address, clinicId, city, state FROM Clinics ORDER BY clinicId;"
-        )
-        clinics = db.query(dbConnection, get_clinics_query).fetchall()
-
-        # Query to get patients for the dropdown
-        get_patients_query = (
-            "SELECT patientId, firstName, lastName, phoneNumber, email, dateOfBirth, gender, clinicId \
-             FROM Patients \
-             ORDER BY patientId;"
+            "SELECT clinicId, displayName FROM Clinics ORDER BY clinicId;"
         )
-        patients = db.query(dbConnection, get_patients_query).fetchall()
 
         # Query to get statuses for the dropdown
         get_statuses_query = "SELECT statusId, status FROM Statuses ORDER BY statusId;"
-        statuses = db.query(dbConnection, get_statuses_query).fetchall()
 
         # Use id query parameter to determine if user is updating or adding an appointment
         appointment_id = request.args.get("id")
-        if appointment_id:
-            action = "Update"
 
-            # Use appointment id to get that appointment's information to populate form
-            select_appointment_query = (
-                f"SELECT appointmentId, dateTime, clinicId, patientId, statusId \
-                FROM Appointments \
-                WHERE appointmentId = {appointment_id};"
+        # Use appointment id to get that appointment's information to populate form
+        select_appointment_query = (
+            "SELECT appointmentId, dateTime, Appointments.clinicId, Appointments.patientId, statusId, \
+            Patients.fullName \
+            FROM Appointments \
+            JOIN Patients ON Appointments.patientId = Patients.patientId \
+            WHERE appointmentId = %s;"
+        )
+
+        # Reuse the rendered table while none of its tables have changed
+        table_key = fragment_key(
+            dbConnection,
+            "appointments_table.j2",
+            "Appointments",
+            "Clinics",
+            "Patients",
+            "Statuses",
+        )
+        table_html = fragment_cache.get(table_key)
+        table_chunks = None
+
+        # Only a page whose table has to be read is streamed. A page built from the
+        # cached table is rendered whole, so versioned() can tag it for a 304 next time.
+        stream = STREAM_PAGES and table_html is None
+
+        # Run the page's queries at the same time, each on its own connection.
+        # A streamed page reads its table while it renders.
+        table, (clinics, statuses), appointment = db.gather(
+            dbConnection,
+            lambda conn: fetch_page(
+                conn,
+                get_appointments_query,
+                "Appointments.appointmentId",
+                "Appointment ID",
+                conditions,
+                query_params,
             )
-            appointment = db.query(dbConnection, select_appointment_query).fetchall()[0]
+            if table_html is None and not stream
+            else None,
+            reference_lists(
+                ("Clinics", get_clinics_query),
+                ("Statuses", get_statuses_query),
+                versions=g.get("table_versions"),
+            ),
+            fetch_all(select_appointment_query, (appointment_id,))
+            if appointment_id
+            else None,
+        )
+
+        if table_html is not None:
+            table_html = Markup(table_html)
+        elif stream:
+            appointments, page = stream_page(
+                dbConnection,
+                get_appointments_query,
+                "Appointments.appointmentId",
+                "Appointment ID",
+                conditions,
+                query_params,
+            )
+            table_chunks = stream_fragment(
+                table_key,
+                "appointments_table.j2",
+                appointments=appointments,
+                page=page,
+            )
+        else:
+            appointments, page = table
+            table_html = render_fragment(
+                table_key,
+                "appointments_table.j2",
+                appointments=appointments,
+                page=page,
+            )
+
+        if appointment_id:
+            action = "Update"
+            appointment = appointment[0]
         else:
             action = "Add"
             appointment = ()
 
         # Render the appointments.j2 file, and also send the renderer appointments information
-        return render_template(
-            "appointments.j2",
-            appointments=appointments,
+        page_context = dict(
+            table_html=table_html,
+            table_chunks=table_chunks,
+            search=search,
             clinics=clinics,
-            patients=patients,
             statuses=statuses,
             appointment=appointment,
             action=action,
             error=False,
         )
+        if stream:
+            response = stream_page_response(
+                dbConnection, "appointments.j2", **page_context
+            )
+            dbConnection = None  # Closed by the response once it has been sent
+            return response
+        return render_template("appointments.j2", **page_context)
 
     except Exception as e:
         print(f"Error executing queries: {e}")
         flash("Error getting appointments", "danger")
         return render_template(
             "appointments.j2",
-            appointments=(),
             clinics=(),
-            patients=(),
             statuses=(),
             appointment=(),
             action="",
@@ -481,13 +1365,14 @@ def create_appointment():
 
         print(f"CREATE appointment. ID: {new_id}")
 
-        # Redirect the user to the updated webpage
-        return redirect("/appointments")
+        # Redirect the user to the updated webpage, or send script.js the changed row
+        return write_response(dbConnection, "appointments", new_id)
 
     except Exception as e:
         print(f"Error executing queries: {e}")
-        flash("Error adding appointment", "danger")
-        return redirect(url_for("appointments"))
+        # A full slot or a closed clinic is reported as such
+        flash(availability.rejection(e) or "Error adding appointment", "danger")
+        return write_failed("appointments")
 
     finally:
         # Close the DB connection, if it exists
@@ -514,13 +1399,15 @@ def delete_appointment():
 
         print(f"DELETE appointment. ID: {appointment_id}")
 
-        # Redirect the user to the updated webpage
-        return redirect("/appointments")
+        # Redirect the user to the updated webpage, or send script.js the changed row
+        return write_response(
+            dbConnection, "appointments", appointment_id, deleted=True
+        )
 
     except Exception as e:
         print(f"Error executing queries: {e}")
         flash("Error deleting appointment", "danger")
-        return redirect(url_for("appointments"))
+        return write_failed("appointments")
 
     finally:
         # Close the DB connection, if it exists
@@ -575,13 +1462,14 @@ def update_appointments():
             f"Updated appointment. appointmentId: {appointment_Id} dateTime: {appointment_date_time}"
         )
 
-        # redirect back to the updated page
-        return redirect("/appointments")
+        # redirect back to the updated page, or send script.js the changed row
+        return write_response(dbConnection, "appointments", appointment_Id)
 
     except Exception as e:
         print(f"Error executing queries: {e}")
-        flash("Error updating appointment", "danger")
-        return redirect(url_for("appointments"))
+        # A full slot or a closed clinic is reported as such
+        flash(availability.rejection(e) or "Error updating appointment", "danger")
+        return write_failed("appointments")
 
     finally:
         # Close the db connection, if it exists
@@ -591,29 +1479,42 @@ def update_appointments():
 
 # Display patients
 @app.route("/patients", methods=["GET", "POST"])
+@versioned("Patients", "Clinics")
 def patients():
     try:
         dbConnection = db.connectDB()  # Open our database connection
 
         # Create and execute our queries
-        # Query to get all patients
-        get_patients_query = "SELECT patientId AS `Patient ID`, \
-                            firstName AS `First Name`, \
-                            lastName AS `Last Name`, \
-                            Patients.phoneNumber AS `Phone Number`, \
-                            email AS `Email`, \
-                            DATE_FORMAT(dateOfBirth, '%%m/%%d/%%Y') AS `Date Of Birth`, \
-                            gender AS `Gender`, \
-                            CONCAT('Capital Family Clinic at ', Clinics.address, ', ', Clinics.city, ', ', Clinics.state) AS `Primary Clinic` \
-                            FROM Patients \
-                            LEFT JOIN Clinics ON Patients.clinicId = Clinics.clinicId;"
-        patients = db.query(dbConnection, get_patients_query).fetchall()
+        # Query to get one page of patients
+        get_patients_query = PATIENTS_ROWS_QUERY
+        search = request.args.get("q", "").strip()
+        conditions, query_params = patient_name_search(search)
+
+        # Reuse the rendered table while neither of its tables has changed
+        table_key = fragment_key(
+            dbConnection, "patients_table.j2", "Patients", "Clinics"
+        )
+        table_html = fragment_cache.get(table_key)
+        if table_html is None:
+            patients, page = fetch_page(
+                dbConnection,
+                get_patients_query,
+                "Patients.patientId",
+                "Patient ID",
+                conditions,
+                query_params,
+            )
+            table_html = render_fragment(
+                table_key, "patients_table.j2", patients=patients, page=page
+            )
+        else:
+            table_html = Markup(table_html)
 
         # Query to get clinics for the dropdown
         get_clinics_query = "SELECT clinicId, \
-                            CONCAT('Capital Family Clinic at ', Clinics.address, ', ', Clinics.city, ', ', Clinics.state) AS primaryClinic \
+                            Clinics.displayName AS primaryClinic \
                             FROM Clinics;"
-        clinics = db.query(dbConnection, get_clinics_query).fetchall()
+        clinics = get_reference(dbConnection, "Clinics", get_clinics_query)
 
         # Use id query parameter to determine if user is updating or adding a patient
         patient_id = request.args.get("id")
@@ -634,7 +1535,8 @@ def patients():
         # Render the patients.j2 file, and also send the renderer patients information
         return render_template(
             "patients.j2",
-            patients=patients,
+            table_html=table_html,
+            search=search,
             clinics=clinics,
             patient=patient,
             action=action,
@@ -708,13 +1610,13 @@ def create_patient():
 
         print(f"CREATE patient. ID: {new_id}")
 
-        # Redirect the user to the updated webpage
-        return redirect("/patients")
+        # Redirect the user to the updated webpage, or send script.js the changed row
+        return write_response(dbConnection, "patients", new_id)
 
     except Exception as e:
         print(f"Error executing queries: {e}")
         flash("Error adding patient", "danger")
-        return redirect(url_for("patients"))
+        return write_failed("patients")
 
     finally:
         # Close the DB connection, if it exists
@@ -802,13 +1704,13 @@ def update_patient():
             f"Updated patient. testId: {patient_id} name: {patient_first_name} {patient_last_name}"
         )
 
-        # redirect back to the updated page
-        return redirect("/patients")
+        # redirect back to the updated page, or send script.js the changed row
+        return write_response(dbConnection, "patients", patient_id)
 
     except Exception as e:
         print(f"Error executing queries: {e}")
         flash("Error updating patient", "danger")
-        return redirect(url_for("patients"))
+        return write_failed("patients")
 
     finally:
         # Close the db connection, if it exists
@@ -818,16 +1720,14 @@ def update_patient():
 
 # Display statuses
 @app.route("/statuses", methods=["GET", "POST"])
+@versioned("Statuses")
 def statuses():
     try:
         dbConnection = db.connectDB()  # Open our database connection
 
         # Create and execute our queries
         # Query to get all statuses
-        get_status_query = "SELECT statusId AS `Status ID`, \
-                        status AS `Status` \
-                        FROM Statuses \
-                        ORDER BY statusId;"
+        get_status_query = f"{STATUSES_ROWS_QUERY} ORDER BY statusId;"
         statuses = db.query(dbConnection, get_status_query).fetchall()
 
         # Use id query parameter to determine if user is updating a status
@@ -888,15 +1788,18 @@ def update_status():
 
         dbConnection.commit()
 
+        # Drop this worker's cached copy of Statuses
+        reference_cache.invalidate("Statuses")
+
         print(f"Updated status statusId: {status_id} status: {status}")
 
-        # redirect back to the updated page
-        return redirect("/statuses")
+        # redirect back to the updated page, or send script.js the changed row
+        return write_response(dbConnection, "statuses", status_id)
 
     except Exception as e:
         print(f"Error executing queries: {e}")
         flash("Error updating status", "danger")
-        return redirect(url_for("statuses"))
+        return write_failed("statuses")
 
     finally:
         # Close the db connection, if it exists
@@ -906,15 +1809,14 @@ def update_status():
 
 # Display tests
 @app.route("/tests", methods=["GET", "POST"])
+@versioned("Tests")
 def tests():
     try:
         dbConnection = db.connectDB()  # Open our database connection
 
         # Create and execute our queries
         # Query to get all tests
-        get_tests_query = (
-            "SELECT testId AS `Test ID`, name AS `Name` FROM Tests ORDER BY testId;"
-        )
+        get_tests_query = f"{TESTS_ROWS_QUERY} ORDER BY testId;"
         tests = db.query(dbConnection, get_tests_query).fetchall()
 
         # Use id query parameter to determine if user is updating or adding a test
@@ -970,15 +1872,18 @@ def create_test():
 
         dbConnection.commit()  # commit the transaction
 
+        # Drop this worker's cached copy of Tests
+        reference_cache.invalidate("Tests")
+
         print(f"CREATE test. ID: {new_id}")
 
-        # Redirect the user to the updated webpage
-        return redirect("/tests")
+        # Redirect the user to the updated webpage, or send script.js the changed row
+        return write_response(dbConnection, "tests", new_id)
 
     except Exception as e:
         print(f"Error executing queries: {e}")
         flash("Error adding test", "danger")
-        return redirect(url_for("tests"))
+        return write_failed("tests")
 
     finally:
         # Close the DB connection, if it exists
@@ -1012,15 +1917,18 @@ def update_test():
 
         dbConnection.commit()
 
+        # Drop this worker's cached copy of Tests
+        reference_cache.invalidate("Tests")
+
         print(f"Updated test. testId: {test_id} name: {test_name}")
 
-        # redirect back to the updated page
-        return redirect("/tests")
+        # redirect back to the updated page, or send script.js the changed row
+        return write_response(dbConnection, "tests", test_id)
 
     except Exception as e:
         print(f"Error executing queries: {e}")
         flash("Error updating test", "danger")
-        return redirect(url_for("tests"))
+        return write_failed("tests")
 
     finally:
         # Close the db connection, if it exists
@@ -1045,15 +1953,18 @@ def delete_test():
 
         dbConnection.commit()  # commit the transaction
 
+        # Drop this worker's cached copy of Tests
+        reference_cache.invalidate("Tests")
+
         print(f"DELETE test. ID: {test_id}")
 
-        # Redirect the user to the updated webpage
-        return redirect("/tests")
+        # Redirect the user to the updated webpage, or send script.js the changed row
+        return write_response(dbConnection, "tests", test_id, deleted=True)
 
     except Exception as e:
         print(f"Error executing queries: {e}")
         flash("Error deleting test", "danger")
-        return redirect(url_for("tests"))
+        return write_failed("tests")
 
     finally:
         # Close the DB connection, if it exists
@@ -1063,13 +1974,14 @@ def delete_test():
 
 # Display results
 @app.route("/results", methods=["GET", "POST"])
+@versioned("Results")
 def results():
     try:
         dbConnection = db.connectDB()  # Open our database connection
 
         # Create and execute our queries
         # Query to get all results
-        get_results_query = "SELECT Results.testResultId AS `Test Result ID`, Results.result AS `Result` FROM Results ORDER BY testResultId;"
+        get_results_query = f"{RESULTS_ROWS_QUERY} ORDER BY testResultId;"
         results = db.query(dbConnection, get_results_query).fetchall()
 
         # Use id query parameter to determine if user is updating a result
@@ -1130,15 +2042,18 @@ def update_result():
 
         dbConnection.commit()
 
+        # Drop this worker's cached copy of Results
+        reference_cache.invalidate("Results")
+
         print(f"Updated result testResultId: {test_result_id} result: {result}")
 
-        # redirect back to the updated page
-        return redirect("/results")
+        # redirect back to the updated page, or send script.js the changed row
+        return write_response(dbConnection, "results", test_result_id)
 
     except Exception as e:
         print(f"Error executing queries: {e}")
         flash("Error updating result", "danger")
-        return redirect(url_for("results"))
+        return write_failed("results")
 
     finally:
         # Close the db connection, if it exists
@@ -1148,106 +2063,163 @@ def update_result():
 
 # Display scheduled tests (data from AppointmentsTests)
 @app.route("/scheduledtests", methods=["GET", "POST"])
+@versioned(
+    "AppointmentsTests",
+    "Appointments",
+    "Patients",
+    "Clinics",
+    "Statuses",
+    "Tests",
+    "Results",
+)
 def scheduledtests():
     try:
         dbConnection = db.connectDB()  # Open our database connection
 
         # Create and execute our queries
-        # Query to get all appointmentstests
-        get_appointmentstests_info_query = (
-            "SELECT AppointmentsTests.appointmentTestId AS `Scheduled Test ID`, \
-                                            CONCAT(Patients.firstName, ' ', Patients.lastName) AS `Patient Name`, \
-                                            CONCAT('Capital Family Clinic at ', Clinics.address, ', ', Clinics.city, ', ', Clinics.state) AS `Clinic`,\
-                                            DATE_FORMAT(Appointments.dateTime, '%%m/%%d/%%Y %%h:%%i %%p') AS `Appointment Date Time`, \
-                                            Tests.name AS `Test Name`, \
-                                            Results.result AS `Test Result` \
-                                            FROM AppointmentsTests \
-                                            LEFT JOIN Appointments on AppointmentsTests.appointmentId = Appointments.appointmentId \
-                                            LEFT JOIN Patients on Appointments.patientId = Patients.patientId \
-                                            JOIN Tests on AppointmentsTests.testId = Tests.testId \
-                                            LEFT JOIN Results on AppointmentsTests.testResultId = Results.testResultId \
-                                            LEFT JOIN Clinics ON Appointments.clinicId = Clinics.clinicId \
-                                            ORDER BY appointmentTestId;"
-        )
-        appointmentstests_info = db.query(
-            dbConnection, get_appointmentstests_info_query
-        ).fetchall()
+        # Query to get one page of appointmentstests
+        get_appointmentstests_info_query = SCHEDULED_TESTS_ROWS_QUERY
+        # Filter by patient name and by the selected tests
+        search = request.args.get("q", "").strip()
+        conditions, query_params = patient_name_search(search)
+        selected_tests = request.args.getlist("test", type=int)
+        if selected_tests:
+            conditions.append(
+                "AppointmentsTests.testId IN (%s)"
+                % ", ".join(["%s"] * len(selected_tests))
+            )
+            query_params += selected_tests
 
         # Query to get tests for dropdown
         get_tests_query = "SELECT testId, name FROM Tests ORDER BY testId;"
-        tests = db.query(dbConnection, get_tests_query).fetchall()
-
-        # Query to get appointments for dropdown
-        get_appointments_query = (
-            "SELECT appointmentId, DATE_FORMAT(dateTime, '%%m/%%d/%%Y %%h:%%i %%p') AS dateTime, \
-                                Appointments.clinicId, Patients.firstName, Patients.lastName, Statuses.status, \
-                                CONCAT(Patients.firstName,' ', Patients.lastName,' - ', DATE_FORMAT(Appointments.dateTime, '%%m/%%d/%%Y %%h:%%i %%p'), ' at ', Clinics.address,', ', Clinics.city, ', ', Clinics.state) AS `dropDownInfo` \
-                                FROM Appointments \
-                                JOIN Patients ON Appointments.patientId = Patients.patientId \
-                                JOIN Statuses ON Appointments.statusId = Statuses.statusId \
-                                JOIN Clinics ON Appointments.clinicId = Clinics.clinicId \
-                                ORDER BY appointmentId;"
-        )
-        appointments = db.query(dbConnection, get_appointments_query).fetchall()
 
         # Query to get results for dropdown
         get_results_query = (
             "SELECT testResultId, result FROM Results ORDER BY testResultId;"
         )
-        results = db.query(dbConnection, get_results_query).fetchall()
 
         # Use id query parameter to determine if user is updating or adding an appointmenttest
         appointmenttest_id = request.args.get("id")
-        if appointmenttest_id:
-            action = "Update"
 
-            # Use appointmenttest id to get the appointmenttest information to populate form
-            select_appointmenttest_query = (
-                f"SELECT appointmentTestId, appointmentId, testId, testResultId \
-                FROM AppointmentsTests \
-                WHERE appointmentTestId = {appointmenttest_id};"
-            )
-            appointmenttest = db.query(
-                dbConnection, select_appointmenttest_query
-            ).fetchall()[0]
-        else:
-            action = "Add"
-            appointmenttest = ()
+        # Use appointmenttest id to get the appointmenttest information to populate form
+        select_appointmenttest_query = (
+            "SELECT appointmentTestId, AppointmentsTests.appointmentId, testId, testResultId, \
+            DATE_FORMAT(Appointments.dateTime, '%%m/%%d/%%Y %%h:%%i %%p') AS dateTime, \
+            Patients.fullName, Clinics.location \
+            FROM AppointmentsTests \
+            LEFT JOIN Appointments ON AppointmentsTests.appointmentId = Appointments.appointmentId \
+            LEFT JOIN Patients ON Appointments.patientId = Patients.patientId \
+            LEFT JOIN Clinics ON Appointments.clinicId = Clinics.clinicId \
+            WHERE appointmentTestId = %s;"
+        )
 
-        requested_tests_count = {}
-        labels = [item["name"] for item in tests]
-        for test in labels:
-            requested_tests_count[test] = 0
+        # Reuse the rendered table while none of its tables have changed
+        table_key = fragment_key(
+            dbConnection,
+            "scheduledtests_table.j2",
+            "AppointmentsTests",
+            "Appointments",
+            "Patients",
+            "Clinics",
+            "Tests",
+            "Results",
+        )
+        table_html = fragment_cache.get(table_key)
+        table_chunks = None
+
+        # Only a page whose table has to be read is streamed. A page built from the
+        # cached table is rendered whole, so versioned() can tag it for a 304 next time.
+        stream = STREAM_PAGES and table_html is None
+
+        # Run the page's queries at the same time, each on its own connection.
+        # A streamed page reads its table while it renders.
+        table, (tests, results), appointmenttest = db.gather(
+            dbConnection,
+            lambda conn: fetch_page(
+                conn,
+                get_appointmentstests_info_query,
+                "AppointmentsTests.appointmentTestId",
+                "Scheduled Test ID",
+                conditions,
+                query_params,
+            )
+            if table_html is None and not stream
+            else None,
+            reference_lists(
+                ("Tests", get_tests_query),
+                ("Results", get_results_query),
+                versions=g.get("table_versions"),
+            ),
+            fetch_all(select_appointmenttest_query, (appointmenttest_id,))
+            if appointmenttest_id
+            else None,
+        )
 
-        for data in appointmentstests_info:
-            requested_tests_count[data["Test Name"]] = (
-                requested_tests_count[data["Test Name"]] + 1
+        if table_html is not None:
+            table_html = Markup(table_html)
+        elif stream:
+            appointmentstests_info, page = stream_page(
+                dbConnection,
+                get_appointmentstests_info_query,
+                "AppointmentsTests.appointmentTestId",
+                "Scheduled Test ID",
+                conditions,
+                query_params,
+            )
+            table_chunks = stream_fragment(
+                table_key,
+                "scheduledtests_table.j2",
+                appointmentstests_info=appointmentstests_info,
+                page=page,
+            )
+        else:
+            appointmentstests_info, page = table
+            table_html = render_fragment(
+                table_key,
+                "scheduledtests_table.j2",
+                appointmentstests_info=appointmentstests_info,
+                page=page,
             )
 
-        data = list(requested_tests_count.values())
+        # The form only offers the appointment the test is scheduled for; the others
+        # are found by searching (see api_appointment_options())
+        appointment_option = None
+        if appointmenttest_id:
+            action = "Update"
+            appointmenttest = appointmenttest[0]
+            if appointmenttest["appointmentId"]:
+                appointment_option = appointment_label(appointmenttest)
+        else:
+            action = "Add"
+            appointmenttest = ()
 
         # Render the scheduledtests.j2 file, and also send the renderer appointmentstests information
-        return render_template(
-            "scheduledtests.j2",
-            appointmentstests_info=appointmentstests_info,
+        page_context = dict(
+            table_html=table_html,
+            table_chunks=table_chunks,
+            search=search,
+            selected_tests=selected_tests,
             tests=tests,
-            appointments=appointments,
+            appointment_option=appointment_option,
             results=results,
             appointmenttest=appointmenttest,
             action=action,
-            labels=labels,
-            data=data,
             error=False,
         )
+        if stream:
+            response = stream_page_response(
+                dbConnection, "scheduledtests.j2", **page_context
+            )
+            dbConnection = None  # Closed by the response once it has been sent
+            return response
+        return render_template("scheduledtests.j2", **page_context)
 
     except Exception as e:
         print(f"Error executing queries: {e}")
         flash("Error getting scheduled tests", "danger")
         return render_template(
             "scheduledtests.j2",
-            appointmentstests_info=(),
             tests=(),
-            appointments=(),
             results=(),
             appointmenttest=(),
             action="",
@@ -1260,6 +2232,71 @@ def scheduledtests():
             dbConnection.close()
 
 
+# Requested tests chart data, fetched by the chart popup on the scheduled tests page
+@app.route("/scheduledtests/chart", methods=["GET"])
+@versioned("AppointmentsTests", "Appointments", "Tests")
+def scheduledtests_chart():
+    try:
+        # Optional filters: clinic, and a date range of appointments (inclusive)
+        conditions = []
+        query_params = []
+        try:
+            clinic_id = request.args.get("clinicId", type=int)
+            start = request.args.get("start")
+            end = request.args.get("end")
+            if clinic_id is not None:
+                conditions.append("Appointments.clinicId = %s")
+                query_params.append(clinic_id)
+            if start:
+                conditions.append("Appointments.dateTime >= %s")
+                query_params.append(date.fromisoformat(start))
+            if end:
+                conditions.append("Appointments.dateTime < %s")
+                query_params.append(date.fromisoformat(end) + timedelta(days=1))
+        except ValueError:
+            return jsonify(error="Dates must be given as YYYY-MM-DD"), 400
+
+        # Only join Appointments when a filter needs it
+        filter_join = ""
+        if conditions:
+            filter_join = (
+                "JOIN Appointments ON AppointmentsTests.appointmentId = Appointments.appointmentId \
+                          WHERE "
+                + " AND ".join(conditions)
+            )
+
+        dbConnection = db.connectDB()  # Open our database connection
+
+        # Count scheduled tests per test in the database, keeping tests with no requests
+        get_requested_tests_query = (
+            f"SELECT Tests.name, COALESCE(requested.total, 0) AS total \
+                                    FROM Tests \
+                                    LEFT JOIN (SELECT AppointmentsTests.testId, COUNT(*) AS total \
+                                        FROM AppointmentsTests \
+                                        {filter_join} \
+                                        GROUP BY AppointmentsTests.testId) AS requested \
+                                    ON requested.testId = Tests.testId \
+                                    ORDER BY Tests.testId;"
+        )
+        requested_tests = db.query(
+            dbConnection, get_requested_tests_query, query_params
+        ).fetchall()
+
+        return jsonify(
+            labels=[row["name"] for row in requested_tests],
+            data=[row["total"] for row in requested_tests],
+        )
+
+    except Exception as e:
+        print(f"Error executing queries: {e}")
+        return jsonify(error="Error getting requested tests"), 500
+
+    finally:
+        # Close the DB connection, if it exists
+        if "dbConnection" in locals() and dbConnection:
+            dbConnection.close()
+
+
 # Create scheduled test / appointmentstests
 @app.route("/scheduledtests/create", methods=["POST"])
 def create_scheduledtest():
@@ -1295,13 +2332,13 @@ def create_scheduledtest():
 
         print(f"CREATE appointmenttest. ID: {new_id}")
 
-        # Redirect the user to the updated webpage
-        return redirect("/scheduledtests")
+        # Redirect the user to the updated webpage, or send script.js the changed row
+        return write_response(dbConnection, "scheduledtests", new_id)
 
     except Exception as e:
         print(f"Error executing queries: {e}")
         flash("Error adding scheduled test", "danger")
-        return redirect(url_for("scheduledtests"))
+        return write_failed("scheduledtests")
 
     finally:
         # Close the DB connection, if it exists
@@ -1352,13 +2389,13 @@ def update_scheduledtest():
             f"Updated appointmenttest. appointmentTestId: {appointmenttest_id} appointmentId: {appointment_id}"
         )
 
-        # redirect back to the updated page
-        return redirect("/scheduledtests")
+        # redirect back to the updated page, or send script.js the changed row
+        return write_response(dbConnection, "scheduledtests", appointmenttest_id)
 
     except Exception as e:
         print(f"Error executing queries: {e}")
         flash("Error updating scheduled test", "danger")
-        return redirect(url_for("scheduledtests"))
+        return write_failed("scheduledtests")
 
     finally:
         # Close the db connection, if it exists
@@ -1366,6 +2403,368 @@ def update_scheduledtest():
             dbConnection.close()
 
 
+# Create an appointment together with its scheduled tests from a JSON body, in one transaction
+@app.route("/api/appointments", methods=["POST"])
+def api_create_appointment():
+    try:
+        appointment, tests = batch.appointment_values(request.get_json(silent=True))
+
+        dbConnection = db.connectDB()  # Open our database connection
+        appointment_id, test_ids = batch.create_appointment(
+            dbConnection, appointment, tests
+        )
+
+        print(f"CREATE appointment. ID: {appointment_id} Tests: {test_ids}")
+
+        return jsonify(appointmentId=appointment_id, appointmentTestIds=test_ids), 201
+
+    except batch.BatchError as e:
+        return jsonify(error=str(e)), 400
+
+    except pymysql.err.IntegrityError as e:
+        print(f"Error executing queries: {e}")
+        return jsonify(
+            error="The clinic, patient, status, test or result does not exist"
+        ), 400
+
+    except Exception as e:
+        print(f"Error executing queries: {e}")
+        reason = availability.rejection(e)
+        if reason:
+            return jsonify(error=reason), 409
+        return jsonify(error="Error adding appointment"), 500
+
+    finally:
+        # Close the DB connection, if it exists
+        if "dbConnection" in locals() and dbConnection:
+            dbConnection.close()
+
+
+# Create many scheduled tests from a JSON body, with one multi-row insert in one transaction
+@app.route("/api/scheduledtests", methods=["POST"])
+def api_create_scheduledtests():
+    try:
+        rows = batch.scheduled_test_values(request.get_json(silent=True))
+
+        dbConnection = db.connectDB()  # Open our database connection
+        test_ids = batch.create_scheduled_tests(dbConnection, rows)
+
+        print(f"CREATE appointmenttests. IDs: {test_ids}")
+
+        return jsonify(appointmentTestIds=test_ids), 201
+
+    except batch.BatchError as e:
+        return jsonify(error=str(e)), 400
+
+    except pymysql.err.IntegrityError as e:
+        print(f"Error executing queries: {e}")
+        return jsonify(error="The appointment, test or result does not exist"), 400
+
+    except Exception as e:
+        print(f"Error executing queries: {e}")
+        return jsonify(error="Error adding scheduled tests"), 500
+
+    finally:
+        # Close the DB connection, if it exists
+        if "dbConnection" in locals() and dbConnection:
+            dbConnection.close()
+
+
+# Next free appointment slots of a clinic
+@app.route("/api/availability", methods=["GET"])
+def api_availability():
+    try:
+        clinic_id = request.args.get("clinicId", type=int)
+        if clinic_id is None:
+            return jsonify(error="clinicId is required"), 400
+        count = request.args.get("count", 5, type=int)
+        count = max(1, min(count, availability.MAX_SLOTS))
+        try:
+            after = request.args.get("after")
+            after = datetime.fromisoformat(after) if after else None
+        except ValueError:
+            return jsonify(error="after must be an ISO 8601 date and time"), 400
+
+        dbConnection = db.connectDB()  # Open our database connection
+        slots = availability.next_free_slots(dbConnection, clinic_id, count, after)
+
+        return jsonify(
+            clinicId=clinic_id,
+            slots=[
+                {
+                    "start": slot["start"].isoformat(timespec="minutes"),
+                    "end": slot["end"].isoformat(timespec="minutes"),
+                    "free": slot["free"],
+                }
+                for slot in slots
+            ],
+        )
+
+    except Exception as e:
+        print(f"Error executing queries: {e}")
+        return jsonify(error="Error getting available slots"), 500
+
+    finally:
+        # Close the DB connection, if it exists
+        if "dbConnection" in locals() and dbConnection:
+            dbConnection.close()
+
+
+# Patients whose names start with the search words, for the patient field of the
+# appointment form, which no longer lists every patient
+@app.route("/api/patients", methods=["GET"])
+def api_patient_options():
+    try:
+        conditions, query_params = patient_name_search(
+            request.args.get("q", "").strip()
+        )
+        if not conditions:
+            return jsonify(options=[])
+
+        dbConnection = db.connectDB()  # Open our database connection
+        rows = db.query(
+            dbConnection,
+            f"SELECT patientId, fullName FROM Patients \
+            WHERE {' AND '.join(conditions)} \
+            ORDER BY Patients.fullName, Patients.patientId LIMIT %s;",
+            (*query_params, OPTION_SEARCH_LIMIT),
+        ).fetchall()
+
+        return jsonify(
+            options=[{"id": row["patientId"], "label": row["fullName"]} for row in rows]
+        )
+
+    except Exception as e:
+        print(f"Error executing queries: {e}")
+        return jsonify(error="Error searching patients"), 500
+
+    finally:
+        # Close the DB connection, if it exists
+        if "dbConnection" in locals() and dbConnection:
+            dbConnection.close()
+
+
+# Latest appointments of the patients whose names start with the search words, for the
+# appointment field of the scheduled test form, which no longer lists every appointment
+@app.route("/api/appointments", methods=["GET"])
+def api_appointment_options():
+    try:
+        conditions, query_params = patient_name_search(
+            request.args.get("q", "").strip()
+        )
+        if not conditions:
+            return jsonify(options=[])
+
+        dbConnection = db.connectDB()  # Open our database connection
+        rows = db.query(
+            dbConnection,
+            f"SELECT appointmentId, DATE_FORMAT(Appointments.dateTime, '%%m/%%d/%%Y %%h:%%i %%p') AS dateTime, \
+            Patients.fullName, Clinics.location \
+            FROM Appointments \
+            JOIN Patients ON Appointments.patientId = Patients.patientId \
+            JOIN Clinics ON Appointments.clinicId = Clinics.clinicId \
+            WHERE {' AND '.join(conditions)} \
+            ORDER BY Appointments.dateTime DESC, appointmentId DESC LIMIT %s;",
+            (*query_params, OPTION_SEARCH_LIMIT),
+        ).fetchall()
+
+        return jsonify(
+            options=[
+                {"id": row["appointmentId"], "label": appointment_label(row)}
+                for row in rows
+            ]
+        )
+
+    except Exception as e:
+        print(f"Error executing queries: {e}")
+        return jsonify(error="Error searching appointments"), 500
+
+    finally:
+        # Close the DB connection, if it exists
+        if "dbConnection" in locals() and dbConnection:
+            dbConnection.close()
+
+
+# Changes to the tables after a token, in pages, for systems that copy the data
+@app.route("/api/changes", methods=["GET"])
+def api_changes():
+    try:
+        # A token that cannot be read must not restart the feed from the beginning
+        since = request.args.get("since", "0")
+        if not since.isdigit():
+            return jsonify(error="since must be a token returned as next"), 400
+        since = int(since)
+        limit = request.args.get("limit", changes.CHANGES_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, changes.MAX_CHANGES_PAGE_SIZE))
+
+        dbConnection = db.connectDB()  # Open our database connection
+        return jsonify(changes.read_changes(dbConnection, since, limit))
+
+    except changes.ExpiredTokenError as e:
+        return jsonify(error=str(e)), 410
+
+    except Exception as e:
+        print(f"Error executing queries: {e}")
+        return jsonify(error="Error getting changes"), 500
+
+    finally:
+        # Close the DB connection, if it exists
+        if "dbConnection" in locals() and dbConnection:
+            dbConnection.close()
+
+
+# Display how busy each clinic is, read only from the ClinicDailyBusyness rollup
+@app.route("/busyness", methods=["GET"])
+def busyness():
+    # Date range of appointment days (inclusive), the last 30 days by default.
+    # The default moves with the date, so unlike the list pages this page is not versioned().
+    end = date.today()
+    start = end - timedelta(days=29)
+    try:
+        if request.args.get("end"):
+            end = date.fromisoformat(request.args["end"])
+        if request.args.get("start"):
+            start = date.fromisoformat(request.args["start"])
+    except ValueError:
+        flash("Dates must be given as YYYY-MM-DD", "danger")
+    if start > end:
+        start, end = end, start
+
+    try:
+        dbConnection = db.connectDB()  # Open our database connection
+
+        # Same lists as the appointments page dropdowns, so they share cached copies
+        get_clinics_query = (
+            "SELECT clinicId, displayName FROM Clinics ORDER BY clinicId;"
+        )
+        get_statuses_query = "SELECT statusId, status FROM Statuses ORDER BY statusId;"
+        clinics = get_reference(dbConnection, "Clinics", get_clinics_query)
+        statuses = get_reference(dbConnection, "Statuses", get_statuses_query)
+
+        # At most one row per clinic, day and status, however many appointments there are
+        get_busyness_query = (
+            "SELECT clinicId, statusId, SUM(appointments) AS appointments \
+                            FROM ClinicDailyBusyness \
+                            WHERE day BETWEEN %s AND %s \
+                            GROUP BY clinicId, statusId;"
+        )
+        counts = {}
+        for row in db.query(dbConnection, get_busyness_query, (start, end)):
+            counts[(row["clinicId"], row["statusId"])] = int(row["appointments"])
+
+        days = (end - start).days + 1
+        busyness = []
+        for clinic in clinics:
+            clinic_counts = [
+                counts.get((clinic["clinicId"], status["statusId"]), 0)
+                for status in statuses
+            ]
+            busyness.append(
+                {
+                    "clinic": clinic["displayName"],
+                    "counts": clinic_counts,
+                    "total": sum(clinic_counts),
+                    "per_day": sum(clinic_counts) / days,
+                }
+            )
+
+        return render_template(
+            "busyness.j2",
+            busyness=busyness,
+            statuses=statuses,
+            start=start.isoformat(),
+            end=end.isoformat(),
+            error=False,
+        )
+
+    except Exception as e:
+        print(f"Error executing queries: {e}")
+        flash("Error getting clinic busyness", "danger")
+        return render_template(
+            "busyness.j2",
+            busyness=(),
+            statuses=(),
+            start=start.isoformat(),
+            end=end.isoformat(),
+            error=True,
+        )
+
+    finally:
+        # Close the DB connection, if it exists
+        if "dbConnection" in locals() and dbConnection:
+            dbConnection.close()
+
+
+# ########################################
+# ########## COMMANDS
+
+
+@app.cli.command("rebuild-busyness")
+def rebuild_busyness():
+    """
+    recounts the ClinicDailyBusyness rollup from Appointments, creating it if needed.
+    Run with: flask rebuild-busyness
+    """
+    try:
+        dbConnection = db.connectDB()
+        cursor = dbConnection.cursor()
+
+        cursor.execute("CALL sp_create_busyness();")
+        cursor.execute("CALL sp_rebuild_busyness();")
+        dbConnection.commit()
+
+        rows = db.query(
+            dbConnection, "SELECT COUNT(*) AS total FROM ClinicDailyBusyness;"
+        ).fetchone()["total"]
+        print(f"Rebuilt ClinicDailyBusyness: {rows} rows")
+
+    finally:
+        # Close the DB connection, if it exists
+        if "dbConnection" in locals() and dbConnection:
+            dbConnection.close()
+
+
+@app.cli.command("prune-changes")
+@click.option(
+    "--days",
+    type=int,
+    default=changes.CHANGES_RETENTION_DAYS,
+    show_default=True,
+    help="Days of changes to keep",
+)
+def prune_changes(days):
+    """
+    deletes the ChangeLog entries older than the given number of days. Readers whose
+    token is older than that are told to copy the tables again.
+    Run with: flask prune-changes
+    """
+    try:
+        dbConnection = db.connectDB()
+
+        pruned = changes.prune_changes(dbConnection, days)
+        dbConnection.commit()
+        print(f"Pruned {pruned} changes older than {days} days")
+
+    finally:
+        # Close the DB connection, if it exists
+        if "dbConnection" in locals() and dbConnection:
+            dbConnection.close()
+
+
+@app.cli.command("compile-templates")
+def compile_templates():
+    """
+    compiles every template into TEMPLATE_CACHE_DIR, so workers started from this tree
+    skip compiling them. Templates are only recompiled once their source changes.
+    Run with: flask compile-templates
+    """
+    os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+    names = app.jinja_env.list_templates(extensions=["j2"])
+    for name in names:
+        app.jinja_env.get_template(name)
+    print(f"Compiled {len(names)} templates into {TEMPLATE_CACHE_DIR}")
+
+
 # ########################################
 # ########## LISTENER
 
@@ -0,0 +1,111 @@
+import os
+from bisect import bisect_left
+from datetime import datetime, time, timedelta
+import pymysql
+import database.db_connector as db
+
+# errno of the SIGNAL raised by sp_check_availability() when it rejects a booking
+BOOKING_REJECTED = 1644
+
+# Furthest ahead next_free_slots() looks for free slots, in days
+AVAILABILITY_SEARCH_DAYS = int(os.environ.get("AVAILABILITY_SEARCH_DAYS", 90))
+
+# Days of appointments read by each query while searching
+WINDOW_DAYS = 7
+
+# Most slots one request may ask for
+MAX_SLOTS = 100
+
+# The same rows sp_check_availability() counts, read from idx_appointments_clinic_datetime alone
+BOOKED_QUERY = "SELECT dateTime FROM Appointments \
+                WHERE clinicId = %s AND dateTime >= %s AND dateTime < %s \
+                AND statusId NOT IN (SELECT statusId FROM Statuses WHERE status = 'Cancelled') \
+                ORDER BY dateTime;"
+
+
+def rejection(error):
+    """
+    returns the reason sp_check_availability() gave for rejecting a booking, or None when
+    error is anything else
+    """
+    if isinstance(error, pymysql.err.MySQLError) and error.args[0] == BOOKING_REJECTED:
+        return error.args[1]
+    return None
+
+
+def clinic_hours(dbConnection, clinic_id):
+    """
+    returns: {day of the week (0 = Monday): ClinicHours row} of a clinic
+    """
+    rows = db.query(
+        dbConnection,
+        "SELECT dayOfWeek, opensAt, closesAt, slotMinutes, slotCapacity \
+        FROM ClinicHours \
+        WHERE clinicId = %s;",
+        (clinic_id,),
+    ).fetchall()
+    return {row["dayOfWeek"]: row for row in rows}
+
+
+def day_slots(day, hours):
+    """
+    yields (start, end, capacity) of each slot of a day, from opening to closing time
+    hours: as returned by clinic_hours()
+    """
+    row = hours.get(day.weekday())
+    if row is None:
+        return  # Closed all day
+
+    # TIME columns are read as timedeltas from midnight
+    midnight = datetime.combine(day, time())
+    start = midnight + row["opensAt"]
+    closes_at = midnight + row["closesAt"]
+    length = timedelta(minutes=row["slotMinutes"])
+    while start < closes_at:
+        yield start, start + length, row["slotCapacity"]
+        start += length
+
+
+def next_free_slots(dbConnection, clinic_id, count, after=None):
+    """
+    finds the first slots of a clinic that can take another appointment.
+    Appointments are read a week at a time, so each query is one short index range scan.
+    count: most slots returned
+    after: only slots starting at or after this datetime are returned (default now)
+    returns: a list of {"start", "end", "free"} dicts, with free the places left in the slot
+    """
+    after = after or datetime.now()
+    hours = clinic_hours(dbConnection, clinic_id)
+    slots = []
+    if not hours:
+        return slots
+
+    day = after.date()
+    last_day = day + timedelta(days=AVAILABILITY_SEARCH_DAYS)
+    while day < last_day and len(slots) < count:
+        window_end = min(day + timedelta(days=WINDOW_DAYS), last_day)
+        booked = [
+            row["dateTime"]
+            for row in db.query(
+                dbConnection,
+                BOOKED_QUERY,
+                (
+                    clinic_id,
+                    datetime.combine(day, time()),
+                    datetime.combine(window_end, time()),
+                ),
+            )
+        ]
+
+        while day < window_end:
+            for start, end, capacity in day_slots(day, hours):
+                if start < after:
+                    continue
+                taken = bisect_left(booked, end) - bisect_left(booked, start)
+                if taken < capacity:
+                    slots.append({"start": start, "end": end, "free": capacity - taken})
+                    if len(slots) == count:
+                        return slots
+            day += timedelta(days=1)
+
+    return slots
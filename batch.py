@@ -0,0 +1,168 @@
+from datetime import datetime
+import changes
+
+# Most scheduled tests accepted in one request, so a request is one bounded INSERT
+MAX_BATCH_ROWS = 1000
+
+
+class BatchError(Exception):
+    """
+    raised when the JSON body of a batch request is not valid
+    """
+
+
+# ########################################
+# ########## VALIDATING REQUESTS
+
+
+def _id(item, key, required=True):
+    value = item.get(key)
+    if value is None or value == "":
+        if required:
+            raise BatchError(f"{key} is required")
+        return None
+    # bool is an int, but true/false is never a valid id
+    if isinstance(value, bool):
+        raise BatchError(f"{key} must be a number")
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise BatchError(f"{key} must be a number")
+
+
+def _datetime(item, key):
+    value = item.get(key)
+    if not isinstance(value, str) or not value:
+        raise BatchError(f"{key} is required")
+    try:
+        # e.g. 2025-05-05T11:30, as sent by the add appointment form
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise BatchError(f"{key} '{value}' is not an ISO 8601 date and time")
+
+
+def _objects(value, name):
+    if not isinstance(value, list):
+        raise BatchError(f"{name} must be a list")
+    if len(value) > MAX_BATCH_ROWS:
+        raise BatchError(f"{name} has more than {MAX_BATCH_ROWS} entries")
+    return value
+
+
+def appointment_values(body):
+    """
+    validates the body of a request to create one appointment with its tests
+    e.g. {"dateTime": "2025-05-05T11:30", "clinicId": 1, "patientId": 2, "statusId": 1,
+          "tests": [3, {"testId": 4, "testResultId": 2}]}
+    returns: ((dateTime, clinicId, patientId, statusId), [(testId, testResultId), ...])
+    """
+    if not isinstance(body, dict):
+        raise BatchError("The request body must be a JSON object")
+
+    appointment = (
+        _datetime(body, "dateTime"),
+        _id(body, "clinicId"),
+        _id(body, "patientId"),
+        _id(body, "statusId"),
+    )
+
+    tests = []
+    for test in _objects(body.get("tests", []), "tests"):
+        # A test is either its id or an object with an optional result
+        if not isinstance(test, dict):
+            test = {"testId": test}
+        tests.append((_id(test, "testId"), _id(test, "testResultId", required=False)))
+    return appointment, tests
+
+
+def scheduled_test_values(body):
+    """
+    validates the body of a request to create many scheduled tests
+    e.g. {"scheduledTests": [{"appointmentId": 1, "testId": 3, "testResultId": null}, ...]}
+    or just the list
+    returns: [(appointmentId, testId, testResultId), ...]
+    """
+    if isinstance(body, dict):
+        body = body.get("scheduledTests")
+    rows = []
+    for row in _objects(body, "scheduledTests"):
+        if not isinstance(row, dict):
+            raise BatchError("Each scheduled test must be a JSON object")
+        rows.append(
+            (
+                _id(row, "appointmentId"),
+                _id(row, "testId"),
+                _id(row, "testResultId", required=False),
+            )
+        )
+    if not rows:
+        raise BatchError("scheduledTests is empty")
+    return rows
+
+
+# ########################################
+# ########## INSERTING
+
+
+def _insert_scheduled_tests(cursor, rows):
+    """
+    inserts rows into AppointmentsTests with one multi-row INSERT
+    returns: the new appointmentTestIds, in the order of rows
+    """
+    if not rows:
+        return []
+
+    cursor.execute(
+        "INSERT INTO AppointmentsTests (appointmentId, testId, testResultId) VALUES "
+        + ", ".join(["(%s, %s, %s)"] * len(rows)),
+        [value for row in rows for value in row],
+    )
+    ids = changes.inserted_ids(cursor, len(rows))
+    changes.log_changes(cursor, "AppointmentsTests", ids, "insert")
+    cursor.execute("CALL sp_bump_table_version('AppointmentsTests');")
+    return ids
+
+
+def create_appointment(dbConnection, appointment, tests):
+    """
+    creates an appointment and its scheduled tests in one transaction
+    appointment, tests: as returned by appointment_values()
+    returns: (new appointmentId, [new appointmentTestIds])
+    """
+    cursor = dbConnection.cursor()
+    dbConnection.begin()
+    try:
+        # The stored procedure also counts the appointment in the busyness rollup
+        cursor.execute(
+            "CALL sp_insert_appointment(%s, %s, %s, %s, @new_id);", appointment
+        )
+        appointment_id = cursor.fetchone()[0]
+        cursor.nextset()
+
+        test_ids = _insert_scheduled_tests(
+            cursor, [(appointment_id,) + test for test in tests]
+        )
+        dbConnection.commit()
+        return appointment_id, test_ids
+
+    except Exception:
+        dbConnection.rollback()
+        raise
+
+
+def create_scheduled_tests(dbConnection, rows):
+    """
+    creates many scheduled tests in one transaction
+    rows: as returned by scheduled_test_values()
+    returns: [new appointmentTestIds], in the order of rows
+    """
+    cursor = dbConnection.cursor()
+    dbConnection.begin()
+    try:
+        test_ids = _insert_scheduled_tests(cursor, rows)
+        dbConnection.commit()
+        return test_ids
+
+    except Exception:
+        dbConnection.rollback()
+        raise
@@ -0,0 +1,127 @@
+"""
+Measures the cold start of app.py: importing it and loading its templates in a new process.
+
+    python benchmarks/coldstart.py
+
+This is the work a new serverless instance or gunicorn worker does before it answers its
+first request. Prints the median time of each step and the import time of each top-level
+package (from python -X importtime), then fails when the cold start is over the budget or
+when a package that the app loads on first use was imported at startup.
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Packages only workbook exports and imports need, which jobs.py and importer.py import
+# when they read or write a workbook
+LAZY_PACKAGES = ("pyexcel", "pyexcel_io", "lml")
+
+# Written to stderr right before the app is imported, so the imports done by the
+# interpreter's own startup are left out of the report
+MARKER = "-- cold start --"
+
+# Run in the new process; prints the milliseconds taken by each step
+PROBE = f"""
+import sys, time
+sys.stderr.write({MARKER!r} + "\\n")
+sys.stderr.flush()
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+for name in app.app.jinja_env.list_templates(extensions=["j2"]):
+    app.app.jinja_env.get_template(name)
+print((imported - start) * 1000, (time.perf_counter() - imported) * 1000)
+"""
+
+# e.g. "import time:       592 |      11799 |   pymysql"
+IMPORT_TIME = re.compile(r"^import time:\s*(\d+) \|\s*\d+ \|\s*(\S+)$")
+
+
+def measure():
+    """
+    starts a new Python process that imports the app and loads its templates
+    returns: ({top-level package: ms spent importing its modules}, import ms, template ms)
+    """
+    env = {"SECRET_KEY": "coldstart", **os.environ}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode:
+        raise RuntimeError(f"The app failed to start:\n{result.stderr[-2000:]}")
+
+    packages = {}
+    lines = result.stderr.splitlines()
+    for line in lines[lines.index(MARKER) + 1 :]:
+        match = IMPORT_TIME.match(line)
+        if match:
+            package = match.group(2).split(".")[0]
+            packages[package] = packages.get(package, 0) + int(match.group(1)) / 1000
+
+    import_ms, template_ms = (float(value) for value in result.stdout.split()[-2:])
+    return packages, import_ms, template_ms
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=float(os.environ.get("COLD_START_BUDGET_MS", 500)),
+        help="most milliseconds the median cold start may take",
+    )
+    parser.add_argument("--top", type=int, default=15, help="packages listed")
+    args = parser.parse_args(argv)
+
+    runs = [measure() for _ in range(args.runs)]
+    import_ms = statistics.median(run[1] for run in runs)
+    template_ms = statistics.median(run[2] for run in runs)
+    total_ms = statistics.median(run[1] + run[2] for run in runs)
+
+    packages = {}
+    for run_packages, _, _ in runs:
+        for package, ms in run_packages.items():
+            packages.setdefault(package, []).append(ms)
+    package_ms = {
+        # A package missing from a run was not imported in it
+        package: statistics.median(times + [0] * (len(runs) - len(times)))
+        for package, times in packages.items()
+    }
+
+    print(f"{'step':32}{'median ms':>12}")
+    print(f"{'import app':32}{import_ms:12.1f}")
+    print(f"{'load templates':32}{template_ms:12.1f}")
+    print(f"{'cold start':32}{total_ms:12.1f}  (budget {args.budget_ms:.0f})")
+    print()
+    print(f"{'package':32}{'median ms':>12}")
+    for package, ms in sorted(package_ms.items(), key=lambda item: -item[1])[
+        : args.top
+    ]:
+        print(f"{package:32}{ms:12.1f}")
+
+    failures = [
+        f"{package} was imported at startup; it should only be imported on first use"
+        for package in LAZY_PACKAGES
+        if package in packages
+    ]
+    if total_ms > args.budget_ms:
+        failures.append(
+            f"The cold start took {total_ms:.1f} ms, over the budget of {args.budget_ms:.0f} ms"
+        )
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
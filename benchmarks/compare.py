@@ -0,0 +1,51 @@
+"""
+Compares two benchmark result files written by benchmarks/run.py.
+
+    python benchmarks/compare.py benchmarks/results/before.json benchmarks/results/after.json
+
+Prints the change in throughput and latency percentiles of every route in both files.
+Negative latency changes and positive throughput changes are improvements.
+"""
+
+import argparse
+import json
+import sys
+
+COLUMNS = ("throughput_rps", "p50_ms", "p95_ms", "p99_ms", "ttfb_p95_ms")
+
+
+def change(before, after):
+    if not before:
+        return "n/a"
+    return "%+.1f%%" % ((after - before) / before * 100)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    args = parser.parse_args(argv)
+
+    with open(args.before) as before_file, open(args.after) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+
+    print(f"{before['meta']['commit']} -> {after['meta']['commit']}")
+    print(f"{'route':48}" + "".join(f"{column:>24}" for column in COLUMNS))
+    for name, result in after["routes"].items():
+        if name not in before["routes"]:
+            continue
+        old = before["routes"][name]
+        print(
+            f"{name:48}"
+            + "".join(
+                # Older result files have no time to first byte
+                f"{'%s (%s)' % (result.get(column), change(old.get(column), result.get(column))):>24}"
+                for column in COLUMNS
+            )
+        )
+        if result["errors"] or old["errors"]:
+            print(f"{'':48}errors: {old['errors']} -> {result['errors']}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,807 @@
+"""
+Drives every route of app.py with concurrent requests and records throughput and
+latency percentiles per route.
+
+    python benchmarks/run.py --db clinic_bench --output benchmarks/results/baseline.json
+
+The app is started with gunicorn against the benchmark database (seed it first with
+benchmarks/seed.py), unless --url points at a server that is already running.
+Write routes work on throwaway rows created before the run and deleted after it,
+so the seeded data is left as it was. /reset restores the snapshot seed.py took of
+the seeded data, so it runs last.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import seed  # noqa: E402
+
+ROOT = seed.ROOT
+
+# Marks the rows the write routes create, so they can be cleaned up after the run
+BENCH_CITY = "Benchville"
+BENCH_LAST_NAME = "Benchmark"
+BENCH_TEST = "Bench Test"
+
+
+# ########################################
+# ########## ROUTES
+
+
+def form(method, path, fields=None):
+    # fields: a dict of form fields, or a str sent as a JSON body
+    return method, path, fields
+
+
+def import_file(ctx, n):
+    rows = "\n".join(
+        f"Import{n}x{i},{BENCH_LAST_NAME},5550000000,import{n}x{i}@example.com,01/01/1990,Unknown,"
+        for i in range(10)
+    )
+    header = (
+        "First Name,Last Name,Phone Number,Email,Date Of Birth,Gender,Primary Clinic"
+    )
+    return {"sheet": "Patients", "file": ("patients.csv", f"{header}\n{rows}\n")}
+
+
+def bench_slot(year, n):
+    # A slot of its own for each request, inside the default clinic hours (8 AM to 6 PM)
+    start = datetime(year, 1, 1, 8) + timedelta(days=n // 40, minutes=15 * (n % 40))
+    return start.strftime("%Y-%m-%dT%H:%M")
+
+
+def chart_range(ctx):
+    return {
+        "clinicId": ctx["clinic_ids"][0],
+        "start": ctx["chart_start"],
+        "end": ctx["chart_end"],
+    }
+
+
+# name -> (function(ctx, n, rng) returning (method, path, form fields), share of --requests)
+ROUTES = {
+    "GET /": (lambda ctx, n, rng: form("GET", "/"), 1),
+    "GET /clinics": (lambda ctx, n, rng: form("GET", "/clinics"), 1),
+    "GET /clinics?id": (
+        lambda ctx, n, rng: form("GET", f"/clinics?id={rng.choice(ctx['clinic_ids'])}"),
+        1,
+    ),
+    "GET /appointments": (lambda ctx, n, rng: form("GET", "/appointments"), 1),
+    "GET /appointments?after": (
+        lambda ctx, n, rng: form(
+            "GET", f"/appointments?after={rng.randint(1, ctx['max_appointment'])}"
+        ),
+        1,
+    ),
+    "GET /appointments?q": (
+        lambda ctx, n, rng: form(
+            "GET", "/appointments?" + urlencode({"q": rng.choice(seed.LAST_NAMES)})
+        ),
+        1,
+    ),
+    "GET /appointments?id": (
+        lambda ctx, n, rng: form(
+            "GET", f"/appointments?id={rng.randint(1, ctx['max_appointment'])}"
+        ),
+        1,
+    ),
+    "GET /patients": (lambda ctx, n, rng: form("GET", "/patients"), 1),
+    "GET /patients?q": (
+        lambda ctx, n, rng: form(
+            "GET",
+            "/patients?"
+            + urlencode(
+                {"q": f"{rng.choice(seed.FIRST_NAMES)} {rng.choice(seed.LAST_NAMES)}"}
+            ),
+        ),
+        1,
+    ),
+    "GET /patients?id": (
+        lambda ctx, n, rng: form(
+            "GET", f"/patients?id={rng.randint(1, ctx['max_patient'])}"
+        ),
+        1,
+    ),
+    "GET /statuses": (lambda ctx, n, rng: form("GET", "/statuses"), 1),
+    "GET /statuses?id": (
+        lambda ctx, n, rng: form(
+            "GET", f"/statuses?id={rng.choice(ctx['statuses'])[0]}"
+        ),
+        1,
+    ),
+    "GET /tests": (lambda ctx, n, rng: form("GET", "/tests"), 1),
+    "GET /tests?id": (
+        lambda ctx, n, rng: form("GET", f"/tests?id={rng.choice(ctx['test_ids'])}"),
+        1,
+    ),
+    "GET /results": (lambda ctx, n, rng: form("GET", "/results"), 1),
+    "GET /results?id": (
+        lambda ctx, n, rng: form("GET", f"/results?id={rng.choice(ctx['results'])[0]}"),
+        1,
+    ),
+    "GET /scheduledtests": (lambda ctx, n, rng: form("GET", "/scheduledtests"), 1),
+    "GET /scheduledtests?q&test": (
+        lambda ctx, n, rng: form(
+            "GET",
+            "/scheduledtests?"
+            + urlencode(
+                {"q": rng.choice(seed.LAST_NAMES), "test": ctx["test_ids"][:2]},
+                doseq=True,
+            ),
+        ),
+        1,
+    ),
+    "GET /scheduledtests?id": (
+        lambda ctx, n, rng: form(
+            "GET", f"/scheduledtests?id={rng.randint(1, ctx['max_appointment_test'])}"
+        ),
+        1,
+    ),
+    "GET /scheduledtests/chart": (
+        lambda ctx, n, rng: form("GET", "/scheduledtests/chart"),
+        1,
+    ),
+    "GET /scheduledtests/chart?clinicId&start&end": (
+        lambda ctx, n, rng: form(
+            "GET", "/scheduledtests/chart?" + urlencode(chart_range(ctx))
+        ),
+        1,
+    ),
+    "GET /api/availability": (
+        lambda ctx, n, rng: form(
+            "GET",
+            "/api/availability?"
+            + urlencode({"clinicId": rng.choice(ctx["clinic_ids"]), "count": 10}),
+        ),
+        1,
+    ),
+    "GET /busyness": (lambda ctx, n, rng: form("GET", "/busyness"), 1),
+    "GET /busyness?start&end": (
+        lambda ctx, n, rng: form(
+            "GET",
+            "/busyness?"
+            + urlencode({k: v for k, v in chart_range(ctx).items() if k != "clinicId"}),
+        ),
+        1,
+    ),
+    "GET /export": (lambda ctx, n, rng: form("GET", "/export"), 0.02),
+    "GET /export?format=zip": (
+        lambda ctx, n, rng: form("GET", "/export?format=zip"),
+        0.02,
+    ),
+    "POST /import": (
+        lambda ctx, n, rng: form("POST", "/import", import_file(ctx, n)),
+        0.2,
+    ),
+    "POST /clinics/create": (
+        lambda ctx, n, rng: form(
+            "POST",
+            "/clinics/create",
+            {
+                "address": f"{ctx['run_id']} Create {n} Street",
+                "city": BENCH_CITY,
+                "state": "WA",
+                "postalCode": "00000",
+                "phoneNumber": "5550000000",
+            },
+        ),
+        1,
+    ),
+    "POST /clinics/update": (
+        lambda ctx, n, rng: form(
+            "POST",
+            "/clinics/update",
+            {
+                "clinicId": ctx["update_clinics"][n % len(ctx["update_clinics"])],
+                "address": f"{ctx['run_id']} Update {n} Street",
+                "city": BENCH_CITY,
+                "state": "WA",
+                "postalCode": "00000",
+                "phoneNumber": "5550000000",
+            },
+        ),
+        1,
+    ),
+    "POST /clinics/delete": (
+        lambda ctx, n, rng: form(
+            "POST", "/clinics/delete", {"id_to_delete": ctx["delete_clinics"][n]}
+        ),
+        1,
+    ),
+    "POST /appointments/create": (
+        lambda ctx, n, rng: form(
+            "POST",
+            "/appointments/create",
+            {
+                "dateTime": bench_slot(2031, n),
+                "clinicId": rng.choice(ctx["clinic_ids"]),
+                "patientId": ctx["bench_patient"],
+                "statusId": ctx["statuses"][0][0],
+            },
+        ),
+        1,
+    ),
+    "POST /appointments/update": (
+        lambda ctx, n, rng: form(
+            "POST",
+            "/appointments/update",
+            {
+                "appointmentId": ctx["update_appointments"][
+                    n % len(ctx["update_appointments"])
+                ],
+                "dateTime": bench_slot(2033, n),
+                "clinicId": rng.choice(ctx["clinic_ids"]),
+                "patientId": ctx["bench_patient"],
+                "statusId": rng.choice(ctx["statuses"])[0],
+            },
+        ),
+        1,
+    ),
+    "POST /appointments/delete": (
+        lambda ctx, n, rng: form(
+            "POST",
+            "/appointments/delete",
+            {"id_to_delete": ctx["delete_appointments"][n]},
+        ),
+        1,
+    ),
+    "POST /patients/create": (
+        lambda ctx, n, rng: form(
+            "POST",
+            "/patients/create",
+            {
+                "firstName": f"Create{n}",
+                "lastName": BENCH_LAST_NAME,
+                "phoneNumber": "5550000000",
+                "email": f"create{n}@example.com",
+                "dateOfBirth": "1990-01-01",
+                "gender": "Unknown",
+                "clinic": rng.choice(ctx["clinic_ids"]),
+            },
+        ),
+        1,
+    ),
+    "POST /patients/update": (
+        lambda ctx, n, rng: form(
+            "POST",
+            "/patients/update",
+            {
+                "patientId": ctx["update_patients"][n % len(ctx["update_patients"])],
+                "firstName": f"Update{n}",
+                "lastName": BENCH_LAST_NAME,
+                "phoneNumber": "5550000000",
+                "email": f"update{n}@example.com",
+                "dateOfBirth": "1990-01-01",
+                "gender": "Unknown",
+                "clinic": rng.choice(ctx["clinic_ids"]),
+            },
+        ),
+        1,
+    ),
+    "POST /statuses/update": (
+        lambda ctx, n, rng: form(
+            "POST",
+            "/statuses/update",
+            dict(zip(("statusId", "status"), rng.choice(ctx["statuses"]))),
+        ),
+        1,
+    ),
+    "POST /tests/create": (
+        lambda ctx, n, rng: form(
+            "POST", "/tests/create", {"name": f"{BENCH_TEST} {ctx['run_id']}c{n}"}
+        ),
+        1,
+    ),
+    "POST /tests/update": (
+        lambda ctx, n, rng: form(
+            "POST",
+            "/tests/update",
+            {
+                "testId": ctx["update_tests"][n % len(ctx["update_tests"])],
+                "name": f"{BENCH_TEST} {ctx['run_id']}u{n}",
+            },
+        ),
+        1,
+    ),
+    "POST /tests/delete": (
+        lambda ctx, n, rng: form(
+            "POST", "/tests/delete", {"id_to_delete": ctx["delete_tests"][n]}
+        ),
+        1,
+    ),
+    "POST /results/update": (
+        lambda ctx, n, rng: form(
+            "POST",
+            "/results/update",
+            dict(zip(("testResultId", "result"), rng.choice(ctx["results"]))),
+        ),
+        1,
+    ),
+    "POST /scheduledtests/create": (
+        lambda ctx, n, rng: form(
+            "POST",
+            "/scheduledtests/create",
+            {
+                "appointmentId": rng.choice(ctx["update_appointments"]),
+                "testId": rng.choice(ctx["test_ids"]),
+                "testResultId": rng.choice(ctx["results"])[0],
+            },
+        ),
+        1,
+    ),
+    "POST /api/appointments": (
+        lambda ctx, n, rng: form(
+            "POST",
+            "/api/appointments",
+            json.dumps(
+                {
+                    "dateTime": bench_slot(2032, n),
+                    "clinicId": rng.choice(ctx["clinic_ids"]),
+                    "patientId": ctx["bench_patient"],
+                    "statusId": ctx["statuses"][0][0],
+                    "tests": rng.sample(ctx["test_ids"], 3),
+                }
+            ),
+        ),
+        1,
+    ),
+    "POST /api/scheduledtests": (
+        lambda ctx, n, rng: form(
+            "POST",
+            "/api/scheduledtests",
+            json.dumps(
+                [
+                    {
+                        "appointmentId": rng.choice(ctx["update_appointments"]),
+                        "testId": test_id,
+                        "testResultId": rng.choice(ctx["results"])[0],
+                    }
+                    for test_id in rng.sample(ctx["test_ids"], 3)
+                ]
+            ),
+        ),
+        1,
+    ),
+    "POST /scheduledtests/update": (
+        lambda ctx, n, rng: form(
+            "POST",
+            "/scheduledtests/update",
+            {
+                "appointmentTestId": ctx["update_appointment_tests"][
+                    n % len(ctx["update_appointment_tests"])
+                ],
+                "appointmentId": rng.choice(ctx["update_appointments"]),
+                "testId": rng.choice(ctx["test_ids"]),
+                "testResultId": rng.choice(ctx["results"])[0],
+            },
+        ),
+        1,
+    ),
+    "GET /reset": (lambda ctx, n, rng: form("GET", "/reset"), 0.02),
+}
+
+# Routes that replace every table, and so run after all the others
+RUN_LAST = {"GET /reset"}
+
+
+# ########################################
+# ########## THROWAWAY ROWS
+
+
+def fetch_column(cursor, query, params=()):
+    cursor.execute(query, params)
+    return [row[0] for row in cursor.fetchall()]
+
+
+def prepare(dbConnection, count, run_id):
+    """
+    reads the ids the routes pick from and creates the throwaway rows the write routes change
+    count: most requests any route makes, so every delete has a row of its own
+    returns: the context passed to the route functions
+    """
+    cursor = dbConnection.cursor()
+    ctx = {"run_id": run_id}
+
+    ctx["clinic_ids"] = fetch_column(
+        cursor, "SELECT clinicId FROM Clinics WHERE city <> %s;", (BENCH_CITY,)
+    )
+    ctx["test_ids"] = fetch_column(
+        cursor, "SELECT testId FROM Tests WHERE name NOT LIKE %s;", (BENCH_TEST + "%",)
+    )
+    cursor.execute("SELECT statusId, status FROM Statuses ORDER BY statusId;")
+    ctx["statuses"] = cursor.fetchall()
+    cursor.execute("SELECT testResultId, result FROM Results ORDER BY testResultId;")
+    ctx["results"] = cursor.fetchall()
+    cursor.execute(
+        "SELECT MAX(appointmentId), DATE(MIN(dateTime)), DATE(MAX(dateTime)) FROM Appointments;"
+    )
+    ctx["max_appointment"], first_day, last_day = cursor.fetchone()
+    ctx["chart_start"] = str(max(first_day, last_day - timedelta(days=365)))
+    ctx["chart_end"] = str(last_day)
+    ctx["max_patient"] = fetch_column(cursor, "SELECT MAX(patientId) FROM Patients;")[0]
+    ctx["max_appointment_test"] = fetch_column(
+        cursor, "SELECT MAX(appointmentTestId) FROM AppointmentsTests;"
+    )[0]
+
+    cursor.executemany(
+        "INSERT INTO Clinics (address, city, state, postalCode, phoneNumber) \
+        VALUES (%s, %s, 'WA', '00000', '555-000-0000')",
+        [(f"{run_id} Throwaway {i} Street", BENCH_CITY) for i in range(2 * count)],
+    )
+    clinics = fetch_column(
+        cursor,
+        "SELECT clinicId FROM Clinics WHERE address LIKE %s ORDER BY clinicId;",
+        (f"{run_id} Throwaway %",),
+    )
+    ctx["delete_clinics"], ctx["update_clinics"] = clinics[:count], clinics[count:]
+
+    cursor.executemany(
+        "INSERT INTO Tests (name) VALUES (%s)",
+        [(f"{BENCH_TEST} {run_id}t{i}",) for i in range(2 * count)],
+    )
+    tests = fetch_column(
+        cursor,
+        "SELECT testId FROM Tests WHERE name LIKE %s ORDER BY testId;",
+        (f"{BENCH_TEST} {run_id}t%",),
+    )
+    ctx["delete_tests"], ctx["update_tests"] = tests[:count], tests[count:]
+
+    cursor.executemany(
+        "INSERT INTO Patients (firstName, lastName, phoneNumber, email, dateOfBirth, gender) \
+        VALUES (%s, %s, '555-000-0000', %s, '1990-01-01', 'Unknown')",
+        [
+            (f"Throwaway{i}", BENCH_LAST_NAME, f"{run_id}.{i}@example.com")
+            for i in range(count + 1)
+        ],
+    )
+    patients = fetch_column(
+        cursor,
+        "SELECT patientId FROM Patients WHERE email LIKE %s ORDER BY patientId;",
+        (f"{run_id}.%",),
+    )
+    ctx["bench_patient"], ctx["update_patients"] = patients[0], patients[1:]
+
+    cursor.executemany(
+        "INSERT INTO Appointments (dateTime, clinicId, patientId, statusId) \
+        VALUES ('2030-01-01 09:00:00', %s, %s, %s)",
+        [
+            (ctx["clinic_ids"][0], ctx["bench_patient"], ctx["statuses"][0][0])
+            for _ in range(2 * count)
+        ],
+    )
+    appointments = fetch_column(
+        cursor,
+        "SELECT appointmentId FROM Appointments WHERE patientId = %s ORDER BY appointmentId;",
+        (ctx["bench_patient"],),
+    )
+    ctx["delete_appointments"] = appointments[:count]
+    ctx["update_appointments"] = appointments[count:]
+
+    cursor.executemany(
+        "INSERT INTO AppointmentsTests (appointmentId, testId) VALUES (%s, %s)",
+        [(appointment, ctx["test_ids"][0]) for appointment in appointments[count:]],
+    )
+    ctx["update_appointment_tests"] = fetch_column(
+        cursor,
+        "SELECT appointmentTestId FROM AppointmentsTests \
+        JOIN Appointments ON AppointmentsTests.appointmentId = Appointments.appointmentId \
+        WHERE patientId = %s;",
+        (ctx["bench_patient"],),
+    )
+
+    cursor.execute("UPDATE TableVersions SET version = version + 1;")
+    return ctx
+
+
+def clean_up(dbConnection):
+    """
+    deletes every row created by prepare() and by the write routes
+    """
+    cursor = dbConnection.cursor()
+    bench_patients = "SELECT patientId FROM Patients WHERE lastName = %s"
+    cursor.execute(
+        f"DELETE AppointmentsTests FROM AppointmentsTests \
+        JOIN Appointments ON AppointmentsTests.appointmentId = Appointments.appointmentId \
+        WHERE Appointments.patientId IN ({bench_patients});",
+        (BENCH_LAST_NAME,),
+    )
+    cursor.execute(
+        f"DELETE FROM Appointments WHERE patientId IN ({bench_patients});",
+        (BENCH_LAST_NAME,),
+    )
+    cursor.execute("DELETE FROM Patients WHERE lastName = %s;", (BENCH_LAST_NAME,))
+    cursor.execute("DELETE FROM Clinics WHERE city = %s;", (BENCH_CITY,))
+    cursor.execute("DELETE FROM Tests WHERE name LIKE %s;", (BENCH_TEST + "%",))
+    # The deletes above bypass the stored procedures that keep the rollup counted
+    cursor.execute("CALL sp_rebuild_busyness();")
+    cursor.execute("UPDATE TableVersions SET version = version + 1;")
+
+
+# ########################################
+# ########## LOAD GENERATOR
+
+
+def encode_multipart(fields):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        if isinstance(value, tuple):
+            file_name, content = value
+            parts.append(
+                f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; '
+                f'filename="{file_name}"\r\nContent-Type: text/csv\r\n\r\n{content}\r\n'
+            )
+        else:
+            parts.append(
+                f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+            )
+    parts.append(f"--{boundary}--\r\n")
+    return "".join(parts).encode(), f"multipart/form-data; boundary={boundary}"
+
+
+class Client(threading.local):
+    """
+    one keep-alive HTTP connection per load generator thread
+    """
+
+    def __init__(self, url):
+        self.address = urlsplit(url)
+        self.connection = None
+
+    def send(self, method, path, fields):
+        body, headers = None, {}
+        if isinstance(fields, str):
+            body = fields.encode()
+            headers["Content-Type"] = "application/json"
+        elif fields is not None:
+            if any(isinstance(value, tuple) for value in fields.values()):
+                body, content_type = encode_multipart(fields)
+            else:
+                body = urlencode(fields).encode()
+                content_type = "application/x-www-form-urlencoded"
+            headers["Content-Type"] = content_type
+
+        for attempt in (1, 2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(
+                    self.address.hostname, self.address.port, timeout=120
+                )
+            try:
+                self.connection.request(method, path, body=body, headers=headers)
+                response = self.connection.getresponse()
+                # The headers arrive with the first chunk of a streamed page
+                self.first_byte_at = time.perf_counter()
+                response.read()
+                return response
+            except (http.client.HTTPException, ConnectionError):
+                # The server closed the kept-alive connection; retry once on a new one
+                self.connection.close()
+                self.connection = None
+                if attempt == 2:
+                    raise
+
+
+def failed(method, path, response):
+    # Handlers report errors with a flash() message, which sets the session cookie,
+    # and the pages that fail without one redirect instead. /export and /reset redirect
+    # to the page of the job they started, so only starting the job is measured.
+    if response.status >= 400:
+        return True
+    if (
+        method == "GET"
+        and response.status >= 300
+        and not urlsplit(response.getheader("Location") or "").path.startswith("/jobs/")
+    ):
+        return True
+    return "session=" in (response.getheader("Set-Cookie") or "")
+
+
+def run_route(url, name, ctx, requests, warmup, concurrency, seed_value):
+    build = ROUTES[name][0]
+    client = Client(url)
+    latencies = []
+    first_bytes = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def one(n):
+        rng = random.Random(f"{seed_value}:{name}:{n}")
+        method, path, fields = build(ctx, n, rng)
+        started = time.perf_counter()
+        first_byte = None
+        try:
+            response = client.send(method, path, fields)
+            first_byte = client.first_byte_at - started
+            error = failed(method, path, response)
+        except Exception:
+            error = True
+        elapsed = time.perf_counter() - started
+        if n >= warmup:
+            with lock:
+                latencies.append(elapsed)
+                first_bytes.append(elapsed if first_byte is None else first_byte)
+                errors[0] += error
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(warmup)))
+        started = time.perf_counter()
+        list(executor.map(one, range(warmup, warmup + requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    first_byte_percentiles = statistics.quantiles(
+        first_bytes, n=100, method="inclusive"
+    )
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 2),
+        "p50_ms": round(percentiles[49] * 1000, 2),
+        "p95_ms": round(percentiles[94] * 1000, 2),
+        "p99_ms": round(percentiles[98] * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2),
+        "ttfb_p50_ms": round(first_byte_percentiles[49] * 1000, 2),
+        "ttfb_p95_ms": round(first_byte_percentiles[94] * 1000, 2),
+    }
+
+
+# ########################################
+# ########## SERVER
+
+
+def start_server(args):
+    env = dict(
+        os.environ,
+        HOST=args.host,
+        PORT=str(args.port),
+        USER=args.user,
+        PASSWORD=args.password,
+        DB=args.db,
+        SECRET_KEY=os.environ.get("SECRET_KEY", "benchmark"),
+    )
+    command = [
+        sys.executable,
+        "-m",
+        "gunicorn",
+        "app:app",
+        "--bind",
+        f"127.0.0.1:{args.app_port}",
+        "--workers",
+        str(args.workers),
+        "--threads",
+        str(args.threads),
+        "--log-level",
+        "warning",
+    ]
+    log = open(args.server_log, "w") if args.server_log else subprocess.DEVNULL
+    server = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=log)
+
+    url = f"http://127.0.0.1:{args.app_port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("gunicorn exited before it was ready")
+        try:
+            Client(url).send("GET", "/", None)
+            return server, url
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("gunicorn did not start within 30s")
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    seed.add_connection_args(parser)
+    parser.add_argument("--url", help="benchmark a server that is already running")
+    parser.add_argument("--app-port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--threads", type=int, default=4, help="threads per worker")
+    parser.add_argument("--server-log", help="file for the app's output")
+    parser.add_argument(
+        "--requests", type=int, default=200, help="measured requests per route"
+    )
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--routes", nargs="*", help="route names to run (default: all)")
+    parser.add_argument("--output", help="JSON file for the results")
+    args = parser.parse_args(argv)
+
+    names = args.routes or list(ROUTES)
+    unknown = set(names) - set(ROUTES)
+    if unknown:
+        parser.error(f"unknown routes: {', '.join(sorted(unknown))}")
+    names.sort(key=lambda name: name in RUN_LAST)
+
+    counts = {name: max(2, int(args.requests * ROUTES[name][1])) for name in names}
+    dbConnection = seed.connect(args, args.db)
+    clean_up(dbConnection)
+    ctx = prepare(
+        dbConnection, max(counts.values()) + args.warmup, uuid.uuid4().hex[:8]
+    )
+
+    server = None
+    try:
+        if args.url:
+            url = args.url
+        else:
+            server, url = start_server(args)
+
+        routes = {}
+        for name in names:
+            routes[name] = run_route(
+                url,
+                name,
+                ctx,
+                counts[name],
+                args.warmup,
+                args.concurrency,
+                args.seed,
+            )
+            result = routes[name]
+            print(
+                f"{name:48} {result['throughput_rps']:>8} req/s  "
+                f"p50 {result['p50_ms']:>8} ms  p95 {result['p95_ms']:>8} ms  "
+                f"p99 {result['p99_ms']:>8} ms  "
+                f"first byte p95 {result['ttfb_p95_ms']:>8} ms  errors {result['errors']}"
+            )
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        clean_up(dbConnection)
+        dbConnection.close()
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "server": args.url or f"gunicorn {args.workers}x{args.threads}",
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "concurrency": args.concurrency,
+        },
+        "routes": routes,
+    }
+    output = args.output or os.path.join(
+        ROOT, "benchmarks", "results", f"{report['meta']['commit']}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as results_file:
+        json.dump(report, results_file, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
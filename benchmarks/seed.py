@@ -0,0 +1,304 @@
+"""
+Loads the schema, the stored procedures and a realistic amount of data into a
+benchmark database.
+
+    python benchmarks/seed.py --db clinic_bench --years 3
+
+The database is rebuilt from DDL.sql and PL.sql (sp_load_clinicdb() drops every
+table), so --db must name a database that is only used for benchmarks. The seeded
+rows are snapshotted with sp_snapshot_clinicdb(), so /reset restores them.
+Data is generated from a fixed random seed, so runs on the same day produce the
+same rows (appointment dates are relative to today).
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+from datetime import date, datetime, timedelta
+import pymysql
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Clinics and tests added to the three of each that sp_load_clinicdb() creates
+CLINICS = [
+    ("1200 Pine Street", "Spokane", "WA", "99201", "888-456-7890"),
+    ("55 Harbor Way", "Everett", "WA", "98201", "888-567-8901"),
+    ("910 Cactus Road", "Tucson", "AZ", "85701", "888-678-9012"),
+    ("31 Canyon Drive", "Flagstaff", "AZ", "86001", "888-789-0123"),
+    ("400 Rose Avenue", "Portland", "OR", "97201", "888-890-1234"),
+    ("77 River Road", "Eugene", "OR", "97401", "888-901-2345"),
+    ("2020 Capitol Way", "Olympia", "WA", "98501", "888-012-3456"),
+]
+TESTS = [
+    "Strep Throat Test",
+    "Urinalysis",
+    "Blood Glucose Test",
+    "Cholesterol Panel",
+    "Pregnancy Test",
+    "Hemoglobin A1C",
+    "RSV Testing",
+]
+FIRST_NAMES = (
+    "James Mary Robert Patricia John Jennifer Michael Linda David Elizabeth William "
+    "Barbara Richard Susan Joseph Jessica Thomas Sarah Charles Karen Daniel Lisa "
+    "Matthew Nancy Anthony Betty Mark Sandra Donald Ashley Steven Kimberly Andrew "
+    "Emily Paul Donna Joshua Michelle Kenneth Carol Kevin Amanda Brian Melissa "
+    "George Deborah Timothy Stephanie Ronald Rebecca Jason Sharon Edward Laura "
+    "Jeffrey Cynthia Ryan Amy Jacob Kathleen Gary Angela Nicholas Shirley Eric "
+    "Brenda Jonathan Emma Stephen Anna Larry Pamela Justin Nicole Scott Samantha"
+).split()
+LAST_NAMES = (
+    "Smith Johnson Williams Brown Jones Garcia Miller Davis Rodriguez Martinez "
+    "Hernandez Lopez Gonzalez Wilson Anderson Thomas Taylor Moore Jackson Martin "
+    "Lee Perez Thompson White Harris Sanchez Clark Ramirez Lewis Robinson Walker "
+    "Young Allen King Wright Scott Torres Nguyen Hill Flores Green Adams Nelson "
+    "Baker Hall Rivera Campbell Mitchell Carter Roberts Gomez Phillips Evans "
+    "Turner Diaz Parker Cruz Edwards Collins Reyes Stewart Morris Morales Murphy "
+    "Cook Rogers Gutierrez Ortiz Morgan Cooper Peterson Bailey Reed Kelly Howard"
+).split()
+GENDERS = ("Male", "Female", "Unknown")
+
+# statusIds created by sp_load_clinicdb()
+SCHEDULED, WALK_IN, NO_SHOW, CANCELLED, COMPLETED = 1, 2, 3, 4, 5
+# testResultIds created by sp_load_clinicdb()
+POSITIVE, NEGATIVE, INVALID = 1, 2, 3
+
+BATCH_SIZE = 5000
+
+_comments = re.compile(r"/\*.*?\*/|--[^\n]*", re.S)
+
+
+def connect(args, db=None):
+    return pymysql.connect(
+        host=args.host,
+        port=args.port,
+        user=args.user,
+        password=args.password,
+        db=db,
+        autocommit=True,
+    )
+
+
+def split_sql(text):
+    """
+    splits a SQL script into statements the way the mysql client does, following
+    DELIMITER lines (DDL.sql and PL.sql define their procedures between them)
+    """
+    delimiter = ";"
+    statement = []
+    for line in text.splitlines():
+        if line.strip().upper().startswith("DELIMITER "):
+            delimiter = line.split()[1]
+            continue
+
+        statement.append(line)
+        if line.rstrip().endswith(delimiter):
+            sql = "\n".join(statement).rstrip()
+            while sql.endswith(delimiter):
+                sql = sql[: -len(delimiter)].rstrip()
+            statement = []
+            # The server rejects statements that are only comments
+            if _comments.sub("", sql).strip():
+                yield sql
+
+
+def run_sql_file(cursor, file_name):
+    with open(os.path.join(ROOT, file_name)) as sql_file:
+        for statement in split_sql(sql_file.read()):
+            cursor.execute(statement)
+            while cursor.nextset():
+                pass
+
+
+def insert_rows(cursor, insert_query, rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        cursor.executemany(insert_query, rows[start : start + BATCH_SIZE])
+
+
+def generate_patients(rng, count, clinic_ids):
+    patients = []
+    for patient_id in range(1, count + 1):
+        first_name = rng.choice(FIRST_NAMES)
+        last_name = rng.choice(LAST_NAMES)
+        patients.append(
+            (
+                patient_id,
+                first_name,
+                last_name,
+                "%03d-%03d-%04d"
+                % (rng.randint(200, 999), rng.randint(200, 999), rng.randint(0, 9999)),
+                f"{first_name}.{last_name}{patient_id}@example.com".lower(),
+                date(1940, 1, 1) + timedelta(days=rng.randint(0, 365 * 80)),
+                rng.choices(GENDERS, weights=(48, 48, 4))[0],
+                rng.choice(clinic_ids) if rng.random() < 0.9 else None,
+            )
+        )
+    return patients
+
+
+def generate_appointments(rng, clinic_ids, patient_count, test_ids, args):
+    """
+    returns: (appointments, appointment tests), with args.per_day appointments per
+    clinic per day in 15 minute slots from 8 AM, from args.years ago until
+    args.future_days from today
+    """
+    appointments = []
+    appointment_tests = []
+    today = date.today()
+    first_day = today - timedelta(days=365 * args.years)
+    day_count = (today - first_day).days + args.future_days
+    appointment_id = 0
+
+    for day_number in range(day_count):
+        day = first_day + timedelta(days=day_number)
+        opens_at = datetime(day.year, day.month, day.day, 8)
+        past = day < today
+
+        for clinic_id in clinic_ids:
+            for slot in range(args.per_day):
+                appointment_id += 1
+                if past:
+                    status_id = rng.choices(
+                        (COMPLETED, NO_SHOW, CANCELLED, WALK_IN), weights=(80, 8, 7, 5)
+                    )[0]
+                else:
+                    status_id = SCHEDULED
+                appointments.append(
+                    (
+                        appointment_id,
+                        opens_at + timedelta(minutes=15 * slot),
+                        clinic_id,
+                        rng.randint(1, patient_count),
+                        status_id,
+                    )
+                )
+
+                # Most appointments have one test, some have two
+                test_count = rng.choices((0, 1, 2), weights=(25, 60, 15))[0]
+                for test_id in rng.sample(test_ids, test_count):
+                    result_id = None
+                    if status_id in (COMPLETED, WALK_IN):
+                        result_id = rng.choices(
+                            (NEGATIVE, POSITIVE, INVALID), weights=(93, 5, 2)
+                        )[0]
+                    appointment_tests.append((appointment_id, test_id, result_id))
+
+    return appointments, appointment_tests
+
+
+def seed(args):
+    rng = random.Random(args.seed)
+
+    with connect(args) as server:
+        server.cursor().execute(f"CREATE DATABASE IF NOT EXISTS `{args.db}`")
+
+    dbConnection = connect(args, args.db)
+    cursor = dbConnection.cursor()
+
+    print("Creating schema and stored procedures")
+    run_sql_file(cursor, "DDL.sql")
+    run_sql_file(cursor, "PL.sql")
+    cursor.execute("CALL sp_load_clinicdb();")
+
+    # Replace the example rows with generated ones, keeping the lookup tables
+    cursor.execute("SET FOREIGN_KEY_CHECKS = 0;")
+    for table in ("AppointmentsTests", "Appointments", "Patients"):
+        cursor.execute(f"DELETE FROM `{table}`;")
+
+    insert_rows(
+        cursor,
+        "INSERT INTO Clinics (address, city, state, postalCode, phoneNumber) \
+        VALUES (%s, %s, %s, %s, %s)",
+        CLINICS[: max(0, args.clinics - 3)],
+    )
+    insert_rows(cursor, "INSERT INTO Tests (name) VALUES (%s)", [(t,) for t in TESTS])
+    cursor.execute("SELECT clinicId FROM Clinics ORDER BY clinicId;")
+    clinic_ids = [row[0] for row in cursor.fetchall()][: args.clinics]
+    cursor.execute("SELECT testId FROM Tests ORDER BY testId;")
+    test_ids = [row[0] for row in cursor.fetchall()]
+
+    started = time.perf_counter()
+    patients = generate_patients(rng, args.patients, clinic_ids)
+    insert_rows(
+        cursor,
+        "INSERT INTO Patients (patientId, firstName, lastName, phoneNumber, email, dateOfBirth, gender, clinicId) \
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
+        patients,
+    )
+    print(f"Inserted {len(patients)} patients")
+
+    appointments, appointment_tests = generate_appointments(
+        rng, clinic_ids, args.patients, test_ids, args
+    )
+    insert_rows(
+        cursor,
+        "INSERT INTO Appointments (appointmentId, dateTime, clinicId, patientId, statusId) \
+        VALUES (%s, %s, %s, %s, %s)",
+        appointments,
+    )
+    print(f"Inserted {len(appointments)} appointments")
+
+    insert_rows(
+        cursor,
+        "INSERT INTO AppointmentsTests (appointmentId, testId, testResultId) \
+        VALUES (%s, %s, %s)",
+        appointment_tests,
+    )
+    print(f"Inserted {len(appointment_tests)} scheduled tests")
+
+    cursor.execute("SET FOREIGN_KEY_CHECKS = 1;")
+    # The rows above bypassed the stored procedures that keep the rollup counted
+    # and give new clinics their opening hours
+    cursor.execute("CALL sp_rebuild_busyness();")
+    cursor.execute("CALL sp_default_clinic_hours();")
+    cursor.execute("UPDATE TableVersions SET version = version + 1;")
+    # Readers of /api/changes copy the generated tables again
+    cursor.execute("CALL sp_log_reset();")
+    cursor.execute(
+        "ANALYZE TABLE Clinics, Patients, Appointments, Tests, AppointmentsTests, ClinicDailyBusyness;"
+    )
+    cursor.fetchall()
+
+    # /reset restores this snapshot instead of the example data
+    cursor.execute("CALL sp_snapshot_clinicdb();")
+    dbConnection.close()
+
+    print(f"Seeded {args.db} in {time.perf_counter() - started:.1f}s")
+
+
+def add_connection_args(parser):
+    parser.add_argument("--host", default=os.environ.get("BENCH_HOST", "127.0.0.1"))
+    parser.add_argument(
+        "--port", type=int, default=int(os.environ.get("BENCH_PORT", 3306))
+    )
+    parser.add_argument("--user", default=os.environ.get("BENCH_USER", "root"))
+    parser.add_argument("--password", default=os.environ.get("BENCH_PASSWORD", ""))
+    parser.add_argument(
+        "--db",
+        default=os.environ.get("BENCH_DB"),
+        required="BENCH_DB" not in os.environ,
+        help="benchmark database (rebuilt from scratch)",
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    add_connection_args(parser)
+    parser.add_argument("--clinics", type=int, default=10, choices=range(1, 11))
+    parser.add_argument(
+        "--per-day", type=int, default=40, help="appointments per clinic per day"
+    )
+    parser.add_argument("--years", type=int, default=3, help="years of history")
+    parser.add_argument(
+        "--future-days", type=int, default=30, help="days of scheduled appointments"
+    )
+    parser.add_argument("--patients", type=int, default=25000)
+    parser.add_argument("--seed", type=int, default=1)
+    seed(parser.parse_args(argv))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,222 @@
+import os
+from datetime import date, datetime, timedelta
+import pymysql
+from database.rows import RowCursor
+
+# Changes returned by one request to /api/changes, unless ?limit= asks for fewer or more
+CHANGES_PAGE_SIZE = int(os.environ.get("CHANGES_PAGE_SIZE", 500))
+MAX_CHANGES_PAGE_SIZE = 5000
+
+# Changes younger than this are held back when the open transactions cannot be read
+# (the database user lacks the PROCESS privilege); see _cutoff()
+CHANGES_SETTLE_SECONDS = int(os.environ.get("CHANGES_SETTLE_SECONDS", 5))
+
+# Days of changes kept by flask prune-changes
+CHANGES_RETENTION_DAYS = int(os.environ.get("CHANGES_RETENTION_DAYS", 30))
+
+# Tables whose changes are logged: (id column, query of their stored columns)
+CHANGE_TABLES = {
+    "Clinics": (
+        "clinicId",
+        "SELECT clinicId, address, city, state, postalCode, phoneNumber FROM Clinics",
+    ),
+    "Patients": (
+        "patientId",
+        "SELECT patientId, firstName, lastName, phoneNumber, email, dateOfBirth, gender, clinicId \
+        FROM Patients",
+    ),
+    "Statuses": ("statusId", "SELECT statusId, status FROM Statuses"),
+    "Appointments": (
+        "appointmentId",
+        "SELECT appointmentId, dateTime, clinicId, patientId, statusId FROM Appointments",
+    ),
+    "Tests": ("testId", "SELECT testId, name FROM Tests"),
+    "Results": ("testResultId", "SELECT testResultId, result FROM Results"),
+    "AppointmentsTests": (
+        "appointmentTestId",
+        "SELECT appointmentTestId, appointmentId, testId, testResultId FROM AppointmentsTests",
+    ),
+}
+
+
+class ExpiredTokenError(Exception):
+    """
+    raised when the changes after a token have already been pruned from the ChangeLog
+    """
+
+
+# ########################################
+# ########## LOGGING CHANGES
+
+
+def inserted_ids(cursor, count):
+    """
+    returns: the ids of the rows of the multi-row INSERT just run on cursor, in the order
+    of its VALUES. The ids of one multi-row INSERT are consecutive, starting at the
+    reported id.
+    """
+    first_id = cursor.lastrowid
+    cursor.execute("SELECT @@auto_increment_increment;")
+    step = cursor.fetchone()[0]
+    return [first_id + i * step for i in range(count)]
+
+
+def log_changes(cursor, table, ids, operation):
+    """
+    adds a change of each row to the ChangeLog with one multi-row INSERT, as
+    sp_log_change() does for one row. For writes made without the stored procedures.
+    table: a key of CHANGE_TABLES
+    operation: "insert", "update" or "delete"
+    """
+    if not ids:
+        return
+    cursor.execute(
+        "INSERT INTO ChangeLog (tableName, rowId, operation) VALUES "
+        + ", ".join(["(%s, %s, %s)"] * len(ids)),
+        [value for row_id in ids for value in (table, row_id, operation)],
+    )
+
+
+# ########################################
+# ########## READING CHANGES
+
+
+def _json_value(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return value
+
+
+def _cutoff(cursor):
+    """
+    a transaction is given its changeIds when it inserts its changes, not when it commits,
+    so a long transaction (an import, a reset) can commit changes with lower changeIds than
+    changes committed before it. A reader that had already moved past those would skip them.
+    Each change's changedAt is the time of the statement that inserted it, so every change
+    an open transaction will commit is at least as recent as the transaction's start.
+    returns: the time before which every change is committed: when the oldest open
+    transaction that has written started, or now when there is none
+    """
+    try:
+        cursor.execute(
+            "SELECT LEAST(NOW(), COALESCE(MIN(trx_started), NOW())) AS cutoff \
+            FROM information_schema.INNODB_TRX \
+            WHERE trx_mysql_thread_id <> CONNECTION_ID() AND trx_rows_modified > 0;"
+        )
+    except pymysql.err.MySQLError as e:
+        print(f"Open transactions unavailable, holding back recent changes: {e}")
+        cursor.execute(
+            "SELECT NOW() - INTERVAL %s SECOND AS cutoff;", (CHANGES_SETTLE_SECONDS,)
+        )
+    return cursor.fetchone()["cutoff"]
+
+
+def _current_rows(cursor, changes):
+    """
+    reads the current columns of every row inserted or updated by the changes,
+    with one query per table
+    returns: {(table, row id): {column: value}}
+    """
+    ids = {}
+    for change in changes:
+        if change["operation"] in ("insert", "update"):
+            ids.setdefault(change["tableName"], set()).add(change["rowId"])
+
+    rows = {}
+    for table, row_ids in ids.items():
+        id_column, select_query = CHANGE_TABLES[table]
+        query = (
+            f"{select_query} WHERE {id_column} IN ({', '.join(['%s'] * len(row_ids))});"
+        )
+        cursor.execute(query, tuple(row_ids))
+        for row in cursor.fetchall():
+            rows[(table, row[id_column])] = {
+                column: _json_value(value) for column, value in row.items()
+            }
+    return rows
+
+
+def read_changes(dbConnection, since, limit):
+    """
+    reads the changes logged after a token, oldest first. Each change comes with the
+    current columns of its row, or None when the row was deleted (since), so a reader
+    that applies the changes in order ends up with the current rows. A "reset" change
+    means the table was reloaded and should be copied again (e.g. from /export).
+    since: token (changeId) of the last change already read, 0 for all of them
+    limit: most changes returned
+    returns: {"changes": [...], "next": token to pass as since next time, "more": whether
+    more changes may be waiting}
+    """
+    # Read on the primary, where the open transactions are, and in one snapshot taken
+    # after the cutoff, so the rows match their changes. db.query() would commit after
+    # each query and could read from a replica.
+    cursor = dbConnection.cursor(RowCursor)
+    cutoff = _cutoff(cursor)
+
+    # Changes after since were pruned when since is below the last pruned one. Gaps in
+    # the changeIds (rolled back inserts, auto_increment_increment) are not pruned changes.
+    cursor.execute("SELECT prunedThrough FROM ChangeLogPruned;")
+    row = cursor.fetchone()
+    pruned_through = row["prunedThrough"] if row else 0
+    if since and since < pruned_through:
+        raise ExpiredTokenError(
+            f"Changes after {since} were pruned; copy the tables again and read the changes after {pruned_through}"
+        )
+
+    # Stops before the first change at or after the cutoff, found on the changedAt index,
+    # since an open transaction's changes may yet be given lower changeIds than it
+    cursor.execute(
+        "SELECT changeId, tableName, rowId, operation, changedAt FROM ChangeLog \
+        WHERE changeId > %s AND changeId < COALESCE( \
+            (SELECT MIN(changeId) FROM ChangeLog WHERE changedAt >= %s), \
+            18446744073709551615) \
+        ORDER BY changeId \
+        LIMIT %s;",
+        (since, cutoff, limit),
+    )
+    changes = cursor.fetchall()
+    rows = _current_rows(cursor, changes)
+
+    return {
+        "changes": [
+            {
+                "token": change["changeId"],
+                "table": change["tableName"],
+                "id": change["rowId"],
+                "operation": change["operation"],
+                "changedAt": _json_value(change["changedAt"]),
+                "row": rows.get((change["tableName"], change["rowId"])),
+            }
+            for change in changes
+        ],
+        "next": changes[-1]["changeId"] if changes else since,
+        "more": len(changes) == limit,
+    }
+
+
+def prune_changes(dbConnection, days=CHANGES_RETENTION_DAYS):
+    """
+    deletes the changes older than the given number of days, in the caller's transaction,
+    and records the highest changeId deleted for read_changes()
+    returns: the number of changes deleted
+    """
+    cursor = dbConnection.cursor()
+    cursor.execute(
+        "SELECT MAX(changeId) FROM ChangeLog WHERE changedAt < NOW() - INTERVAL %s DAY;",
+        (days,),
+    )
+    pruned_through = cursor.fetchone()[0]
+    if pruned_through is None:
+        return 0
+
+    # Every change up to the newest old one goes, so the pruned changes are the ones
+    # up to prunedThrough and nothing after it
+    cursor.execute("DELETE FROM ChangeLog WHERE changeId <= %s;", (pruned_through,))
+    deleted = cursor.rowcount
+    cursor.execute(
+        "UPDATE ChangeLogPruned SET prunedThrough = GREATEST(prunedThrough, %s);",
+        (pruned_through,),
+    )
+    return deleted
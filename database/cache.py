@@ -0,0 +1,159 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+import pymysql
+from jinja2 import FileSystemBytecodeCache
+import database.db_connector as db
+
+# Seconds a cached reference table may be served before it is re-queried regardless of its version
+reference_cache_ttl = float(os.environ.get("REFERENCE_CACHE_TTL", 300))
+
+
+def fetch_versions(dbConnection):
+    """
+    looks up the current version of every table tracked in TableVersions
+    returns: a dict of {tableName: version}, empty if the TableVersions table does not exist yet
+    """
+    try:
+        rows = db.query(
+            dbConnection, "SELECT tableName, version FROM TableVersions;"
+        ).fetchall()
+    except pymysql.err.ProgrammingError as e:
+        print(f"Table versions unavailable, caching disabled: {e}")
+        return {}
+
+    return {row["tableName"]: row["version"] for row in rows}
+
+
+class ReferenceCache:
+    """
+    in-process cache for small, rarely changing tables (Statuses, Results, Tests, Clinics).
+    Each entry remembers the table version it was loaded at; an entry is only reused while
+    that version still matches the database and it is younger than ttl seconds. The stored
+    procedures bump a table's version on every write, so entries cached by other workers
+    go stale as soon as the write commits.
+    """
+
+    def __init__(self, ttl=reference_cache_ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}  # (table, query) -> (version, loaded_at, rows)
+
+    def get(self, dbConnection, table, query, versions):
+        """
+        returns the rows of query, from the cache when the cached copy is still current
+        table: the table the query reads, whose version decides if the cached rows are current
+        versions: the table versions from fetch_versions()
+        """
+        key = (table, query)
+        version = versions.get(table)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+        if (
+            entry is not None
+            and version is not None
+            and entry[0] == version
+            and now - entry[1] < self.ttl
+        ):
+            return entry[2]
+
+        rows = tuple(db.query(dbConnection, query).fetchall())
+
+        # Rows read after looking up the version are at least as new as that version
+        if version is not None:
+            with self._lock:
+                self._entries[key] = (version, now, rows)
+
+        return rows
+
+    def invalidate(self, table):
+        """
+        drops every cached query of the given table in this process.
+        Called by the write handlers of that table; other processes notice the change
+        through the version the stored procedure bumped.
+        """
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == table]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Most bytes of rendered HTML kept by each worker's fragment cache
+fragment_cache_bytes = int(os.environ.get("FRAGMENT_CACHE_BYTES", 16 * 1024 * 1024))
+
+
+class FragmentCache:
+    """
+    in-process LRU cache of rendered HTML fragments, bounded by their total size in bytes.
+    Keys include the versions of the tables a fragment was rendered from, so a fragment is
+    never invalidated; once a table changes, its old fragments are no longer looked up and
+    are evicted as newer ones are added.
+    """
+
+    def __init__(self, max_bytes=fragment_cache_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (html, size), least recently used first
+
+    def get(self, key):
+        """
+        returns the fragment stored under key, or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, html):
+        size = len(html.encode("utf-8"))
+        # A fragment larger than the whole budget would only evict everything else
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (html, size)
+            self.size += size
+
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+    """
+    Jinja bytecode cache kept in a directory, so a new worker loads its templates already
+    compiled instead of parsing them on its first requests. Fill it before deploying with
+    flask compile-templates. A directory that cannot be written to (e.g. a read-only
+    serverless bundle) is still read from; newly compiled templates are then only kept in
+    memory.
+    """
+
+    def get_cache_key(self, name, filename=None):
+        # Jinja also hashes the template's absolute path, which differs between the
+        # machine that compiles the templates and the one that serves them
+        return super().get_cache_key(name)
+
+    def dump_bytecode(self, bucket):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            super().dump_bytecode(bucket)
+        except OSError:
+            pass
@@ -0,0 +1,171 @@
+import contextvars
+import functools
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+import pymysql
+
+# Statements slower than this many milliseconds are written to the slow query log
+slow_query_ms = float(os.environ.get("SLOW_QUERY_MS", 200))
+
+# File the slow query log is appended to; without it slow queries go to stderr
+slow_query_log = os.environ.get("SLOW_QUERY_LOG")
+
+slow_log = logging.getLogger("clinic.slow_queries")
+slow_log.setLevel(logging.WARNING)
+if slow_query_log:
+    handler = logging.FileHandler(slow_query_log)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    slow_log.addHandler(handler)
+    slow_log.propagate = False
+
+
+# ########################################
+# ########## STATEMENT DIGESTS
+
+_comments = re.compile(r"/\*.*?\*/|--[^\n]*", re.S)
+_strings = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.)*\"")
+_numbers = re.compile(r"(?<![\w`])-?\d+(?:\.\d+)?(?![\w`])")
+_placeholders = re.compile(r"%s|%\(\w+\)s")
+_lists = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_spaces = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize(statement):
+    """
+    returns a statement with its literals and placeholders replaced by ?, so every
+    run of the same query has the same text whatever its values
+    e.g. "SELECT * FROM Tests WHERE testId IN (1, 2)" -> "SELECT * FROM Tests WHERE testId IN (...)"
+    """
+    statement = _comments.sub(" ", statement)
+    statement = _strings.sub("?", statement)
+    statement = _placeholders.sub("?", statement)
+    statement = _numbers.sub("?", statement)
+    statement = _lists.sub("(...)", statement)
+    return _spaces.sub(" ", statement).strip().rstrip(";")
+
+
+@functools.lru_cache(maxsize=1024)
+def digest(statement):
+    """
+    returns a short hash of the normalized statement, to group runs of the same query
+    """
+    return hashlib.md5(normalize(statement).encode()).hexdigest()[:12]
+
+
+# ########################################
+# ########## PER-REQUEST PROFILES
+
+
+class QueryProfile:
+    """
+    the statements run while handling one request
+    label: what the statements belong to, e.g. "GET /appointments"
+    """
+
+    def __init__(self, label=""):
+        self.label = label
+        self.count = 0
+        self.total = 0.0  # seconds
+        self.statements = []  # list of (digest, seconds, rows)
+        self._lock = threading.Lock()  # db.gather() records from several threads
+
+    def add(self, statement_digest, duration, rows):
+        with self._lock:
+            self.count += 1
+            self.total += duration
+            self.statements.append((statement_digest, duration, rows))
+
+    def server_timing(self):
+        """
+        returns the profile as a Server-Timing header value, shown by browser dev tools
+        """
+        return 'db;dur=%.1f;desc="%d queries"' % (self.total * 1000, self.count)
+
+
+_profile = contextvars.ContextVar("query_profile", default=None)
+
+
+def start(label=""):
+    """
+    starts a profile that collects the statements run in the current context
+    returns: the new QueryProfile
+    """
+    profile = QueryProfile(label)
+    _profile.set(profile)
+    return profile
+
+
+def resume(profile):
+    """
+    collects the statements run in the current context into a profile that was
+    stopped, e.g. in the generator of a response that is sent after its request
+    """
+    _profile.set(profile)
+
+
+def stop():
+    """
+    stops collecting statements and returns the profile that was collecting them (or None)
+    """
+    profile = _profile.get()
+    _profile.set(None)
+    return profile
+
+
+def record(statement, duration, rows):
+    """
+    records one executed statement in the current profile and, if it was slow,
+    in the slow query log
+    duration: seconds the statement took
+    rows: rows returned (or affected), None when not known yet
+    """
+    statement_digest = digest(statement)
+    profile = _profile.get()
+    if profile is not None:
+        profile.add(statement_digest, duration, rows)
+
+    if duration * 1000 >= slow_query_ms:
+        slow_log.warning(
+            "%.1f ms rows=%s digest=%s request=%s: %s",
+            duration * 1000,
+            rows,
+            statement_digest,
+            profile.label if profile is not None else "-",
+            normalize(statement),
+        )
+
+
+# ########################################
+# ########## CURSORS
+
+
+class ProfiledCursorMixin:
+    """
+    times every statement run through execute(), including the CALLs of the write
+    handlers and each multi-row INSERT sent by executemany()
+    """
+
+    def execute(self, query, args=None):
+        start_time = time.perf_counter()
+        try:
+            return super().execute(query, args)
+        finally:
+            # Unbuffered cursors only know their row count once they have been read
+            unbuffered = isinstance(self, pymysql.cursors.SSCursor)
+            rows = None if unbuffered or self.rowcount < 0 else self.rowcount
+            record(query, time.perf_counter() - start_time, rows)
+
+
+@functools.lru_cache(maxsize=None)
+def profiled(cursorclass):
+    """
+    returns a subclass of the given pymysql cursor class that records its statements
+    """
+    return type(
+        "Profiled" + cursorclass.__name__, (ProfiledCursorMixin, cursorclass), {}
+    )
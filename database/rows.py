@@ -0,0 +1,88 @@
+import functools
+import pymysql
+
+
+class Row(tuple):
+    """
+    row of a query result: a tuple of its values that can also be read by column name,
+    like the dicts of a DictCursor (row["Patient Name"], row.keys(), row.get(...)),
+    or by attribute (row.name). The column names are stored once, on the class that
+    row_class() makes for each set of columns, so a row costs no more than a tuple.
+    Column names shadowed by tuple methods (count, index) can only be read as row["count"].
+    """
+
+    __slots__ = ()
+
+    _columns = {}  # {column name: position}, set by row_class()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return tuple.__getitem__(self, self._columns[key])
+        return tuple.__getitem__(self, key)
+
+    def __getattr__(self, column):
+        # Only called for names that are not attributes of Row (so not keys, get, ...)
+        try:
+            return tuple.__getitem__(self, self._columns[column])
+        except KeyError:
+            raise AttributeError(column) from None
+
+    def get(self, column, default=None):
+        index = self._columns.get(column)
+        return default if index is None else tuple.__getitem__(self, index)
+
+    def keys(self):
+        return self._columns.keys()
+
+    def values(self):
+        return tuple(self)
+
+    def items(self):
+        return zip(self._columns, self)
+
+    def __repr__(self):
+        return f"Row({dict(self.items())!r})"
+
+
+@functools.lru_cache(maxsize=256)
+def row_class(columns):
+    """
+    returns the Row subclass for rows with the given column names, made once per set of
+    columns (e.g. once per query) and shared by every row read with them
+    columns: tuple of column names, in the order of the values
+    """
+    return type(
+        "Row",
+        (Row,),
+        {"__slots__": (), "_columns": {name: i for i, name in enumerate(columns)}},
+    )
+
+
+class RowCursorMixin(pymysql.cursors.DictCursorMixin):
+    """
+    turns each row of a result into a Row. Column names are resolved the way DictCursor
+    does, so the same names can be looked up in a Row as in a DictCursor's dict.
+    """
+
+    def _do_get_result(self):
+        self._row_class = None
+        super()._do_get_result()
+
+    def _conv_row(self, row):
+        if row is None:
+            return None
+        if self._row_class is None:
+            self._row_class = row_class(tuple(self._fields))
+        return self._row_class(row)
+
+
+class RowCursor(RowCursorMixin, pymysql.cursors.Cursor):
+    """
+    buffered cursor that returns Rows
+    """
+
+
+class SSRowCursor(RowCursorMixin, pymysql.cursors.SSCursor):
+    """
+    unbuffered cursor that returns Rows
+    """
@@ -0,0 +1,132 @@
+import csv
+import io
+import zipfile
+import database.db_connector as db
+
+# Queries for each sheet of the data export, in the order the sheets are written
+EXPORT_SHEETS = {
+    "Clinics": "SELECT clinicId AS 'Clinic ID', \
+                address AS 'Address', \
+                city AS `City`, \
+                state AS `State`, \
+                postalCode AS `Postal Code`, \
+                phoneNumber AS `Phone Number` \
+                FROM Clinics \
+                ORDER BY clinicId;",
+    "Patients": "SELECT patientId AS `Patient ID`, \
+                firstName AS `First Name`, \
+                lastName AS `Last Name`, \
+                Patients.phoneNumber AS `Phone Number`, \
+                email AS `Email`, \
+                DATE_FORMAT(dateOfBirth, '%%m/%%d/%%Y') AS `Date Of Birth`, \
+                gender AS `Gender`, \
+                Clinics.displayName AS `Primary Clinic` \
+                FROM Patients \
+                LEFT JOIN Clinics ON Patients.clinicId = Clinics.clinicId \
+                ORDER BY patientId;",
+    "Appointments": "SELECT appointmentId AS `Appointment ID`, \
+                DATE_FORMAT(dateTime, '%%m/%%d/%%Y %%h:%%i %%p') AS `Appointment Date Time`, \
+                Clinics.displayName AS `Clinic`, \
+                Patients.fullName AS `Patient Name`, \
+                Statuses.status AS `Appointment Status` \
+                FROM Appointments \
+                JOIN Patients ON Appointments.patientId = Patients.patientId \
+                JOIN Statuses ON Appointments.statusId = Statuses.statusId \
+                JOIN Clinics ON Appointments.clinicId = Clinics.clinicId \
+                ORDER BY appointmentId;",
+    "Scheduled Tests": "SELECT AppointmentsTests.appointmentTestId AS `Scheduled Test ID`, \
+                Patients.fullName AS `Patient Name`, \
+                Clinics.displayName AS `Clinic`,\
+                DATE_FORMAT(Appointments.dateTime, '%%m/%%d/%%Y %%h:%%i %%p') AS `Appointment Date Time`, \
+                Tests.name AS `Test Name`, \
+                Results.result AS `Test Result` \
+                FROM AppointmentsTests \
+                LEFT JOIN Appointments on AppointmentsTests.appointmentId = Appointments.appointmentId \
+                LEFT JOIN Patients on Appointments.patientId = Patients.patientId \
+                JOIN Tests on AppointmentsTests.testId = Tests.testId \
+                LEFT JOIN Results on AppointmentsTests.testResultId = Results.testResultId \
+                LEFT JOIN Clinics ON Appointments.clinicId = Clinics.clinicId \
+                ORDER BY appointmentTestId;",
+}
+
+# Bytes collected before a chunk of the zip file is handed to the response
+CHUNK_SIZE = 64 * 1024
+
+
+class _ChunkWriter:
+    """
+    write-only file object that collects what zipfile writes until it is drained.
+    It has no tell() or seek(), so zipfile writes the archive in streaming mode.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        self.size = 0
+        return data
+
+
+def sheet_rows(dbConnection, sheet, progress=None):
+    """
+    generator that yields the header row and then the rows of a sheet of the workbook
+    export. The rows are read with an unbuffered cursor as the workbook writer asks for
+    them, so the writer has to finish each sheet before it starts the next.
+    progress: optional function called with the name of the sheet before it is read
+    """
+    if progress:
+        progress(sheet)
+    cursor = db.stream(dbConnection, EXPORT_SHEETS[sheet])
+    try:
+        yield [column[0] for column in cursor.description]
+        yield from cursor
+    finally:
+        cursor.close()
+
+
+def stream_csv_zip(dbConnection, progress=None):
+    """
+    generator that yields a zip archive holding one CSV file per export sheet.
+    Each sheet is read with an unbuffered cursor and its rows are compressed and
+    yielded as they arrive, so memory use does not grow with the size of the tables.
+    progress: optional function called with the name of each sheet before it is read
+    """
+    out = _ChunkWriter()
+    archive = zipfile.ZipFile(out, mode="w", compression=zipfile.ZIP_DEFLATED)
+
+    for sheet, sheet_query in EXPORT_SHEETS.items():
+        if progress:
+            progress(sheet)
+        cursor = db.stream(dbConnection, sheet_query)
+        try:
+            with archive.open(f"{sheet}.csv", mode="w", force_zip64=True) as entry:
+                text = io.TextIOWrapper(entry, encoding="utf-8", newline="")
+                writer = csv.writer(text)
+                writer.writerow([column[0] for column in cursor.description])
+
+                for row in cursor:
+                    writer.writerow(row)
+                    if out.size >= CHUNK_SIZE:
+                        yield out.drain()
+
+                # Flush the text buffer into the zip entry before it is closed
+                text.flush()
+                text.detach()
+        finally:
+            cursor.close()
+
+        yield out.drain()
+
+    archive.close()
+    yield out.drain()
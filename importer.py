@@ -0,0 +1,391 @@
+import csv
+import io
+import os
+import zipfile
+from collections import Counter
+from datetime import date, datetime
+import changes
+from database.rows import RowCursor
+
+# Rows sent to the database in each multi-row INSERT
+IMPORT_BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", 500))
+
+# Most row errors listed in an import report
+MAX_REPORTED_ERRORS = 100
+
+# Sheets that can be imported, in the order they are imported (appointments refer to patients)
+IMPORT_SHEETS = ("Patients", "Appointments")
+
+GENDERS = ("Male", "Female", "Unknown")
+
+CLINIC_PREFIX = "Capital Family Clinic at "
+
+
+class ImportFileError(Exception):
+    """
+    raised when an uploaded file cannot be read as an import
+    """
+
+
+# ########################################
+# ########## READING FILES
+
+
+def _rows_from_arrays(arrays):
+    """
+    turns a header row followed by value rows into (row number, {header: value}) pairs
+    """
+    header = None
+    for row_number, values in enumerate(arrays, start=1):
+        if header is None:
+            header = [str(name).strip() for name in values]
+            continue
+        if not any(str(value).strip() for value in values if value is not None):
+            continue  # Skip blank lines
+        yield row_number, dict(zip(header, values))
+
+
+def _csv_rows(stream):
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    try:
+        yield from _rows_from_arrays(csv.reader(text))
+    finally:
+        text.detach()
+
+
+def open_sheets(file_name, stream, sheet=None):
+    """
+    finds the importable sheets in an uploaded file, in the layouts that /export produces
+    file_name: name of the uploaded file, whose extension picks the reader
+    stream: binary, seekable file object of the upload
+    sheet: for a single .csv file, which sheet it holds (Patients or Appointments)
+    returns: a dict of {sheet name: function returning an iterator of (row number, row)}
+    Rows are read lazily, one at a time, when the returned functions are called.
+    """
+    extension = os.path.splitext(file_name or "")[1].lower()
+
+    if extension == ".csv":
+        if sheet not in IMPORT_SHEETS:
+            raise ImportFileError(
+                "Choose whether the CSV file holds Patients or Appointments"
+            )
+        return {sheet: lambda: _csv_rows(stream)}
+
+    if extension == ".zip":
+        # A zip of per-sheet CSV files, as written by /export?format=zip
+        try:
+            archive = zipfile.ZipFile(stream)
+        except zipfile.BadZipFile:
+            raise ImportFileError("The zip file could not be read")
+
+        def zip_rows(entry_name):
+            with archive.open(entry_name) as entry:
+                yield from _csv_rows(entry)
+
+        names = {
+            os.path.splitext(os.path.basename(name))[0]: name
+            for name in archive.namelist()
+        }
+        return {
+            name: (lambda entry_name=names[name]: zip_rows(entry_name))
+            for name in IMPORT_SHEETS
+            if name in names
+        }
+
+    if extension == ".xlsx":
+        import pyexcel
+
+        content = stream.read()
+
+        def xlsx_rows(sheet_name):
+            try:
+                yield from _rows_from_arrays(
+                    pyexcel.iget_array(
+                        file_type="xlsx", file_content=content, sheet_name=sheet_name
+                    )
+                )
+            finally:
+                pyexcel.free_resources()
+
+        try:
+            book = pyexcel.iget_book(file_type="xlsx", file_content=content)
+            sheet_names = book.sheet_names()
+        except Exception as e:
+            raise ImportFileError(f"The xlsx file could not be read: {e}")
+        finally:
+            pyexcel.free_resources()
+
+        return {
+            name: (lambda sheet_name=name: xlsx_rows(sheet_name))
+            for name in IMPORT_SHEETS
+            if name in sheet_names
+        }
+
+    raise ImportFileError("Upload an .xlsx, .csv or .zip file")
+
+
+# ########################################
+# ########## VALIDATING ROWS
+
+
+def _text(row, column, required=True, max_length=None):
+    value = row.get(column)
+    value = "" if value is None else str(value).strip()
+    if required and not value:
+        raise ValueError(f"{column} is required")
+    if max_length and len(value) > max_length:
+        raise ValueError(f"{column} is longer than {max_length} characters")
+    return value
+
+
+def _datetime(row, column, formats):
+    value = row.get(column)
+    # Spreadsheet readers may already give dates rather than text
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+
+    value = _text(row, column)
+    for date_format in formats:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ValueError(f"{column} '{value}' is not a valid date")
+
+
+def _phone_number(value):
+    # Same formatting as the add and update forms
+    if len(value) == 10 and value.isdigit():
+        value = value[:3] + "-" + value[3:6] + "-" + value[6:]
+    if len(value) > 12:
+        raise ValueError(f"Phone Number '{value}' is too long")
+    return value
+
+
+def _clinic_id(label, lookups):
+    if not label:
+        return None
+    key = label[len(CLINIC_PREFIX) :] if label.startswith(CLINIC_PREFIX) else label
+    if key not in lookups["clinics"]:
+        raise ValueError(f"Clinic '{label}' does not exist")
+    return lookups["clinics"][key]
+
+
+def patient_values(row, lookups):
+    """
+    validates one row of the Patients sheet
+    returns: the values for an INSERT into Patients
+    """
+    date_of_birth = _datetime(row, "Date Of Birth", ("%m/%d/%Y", "%Y-%m-%d"))
+    gender = _text(row, "Gender").capitalize()
+    if gender not in GENDERS:
+        raise ValueError(f"Gender must be one of {', '.join(GENDERS)}")
+
+    return (
+        _text(row, "First Name", max_length=45),
+        _text(row, "Last Name", max_length=45),
+        _phone_number(_text(row, "Phone Number")),
+        _text(row, "Email", max_length=150),
+        date_of_birth.date(),
+        gender,
+        _clinic_id(_text(row, "Primary Clinic", required=False), lookups),
+    )
+
+
+def appointment_values(row, lookups):
+    """
+    validates one row of the Appointments sheet
+    The patient is found by Patient ID when the sheet has that column, otherwise by name.
+    returns: the values for an INSERT into Appointments
+    """
+    date_time = _datetime(
+        row,
+        "Appointment Date Time",
+        ("%m/%d/%Y %I:%M %p", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M"),
+    )
+
+    clinic_id = _clinic_id(_text(row, "Clinic"), lookups)
+
+    status = _text(row, "Appointment Status")
+    if status.lower() not in lookups["statuses"]:
+        raise ValueError(f"Appointment Status '{status}' does not exist")
+
+    if _text(row, "Patient ID", required=False):
+        try:
+            patient_id = int(float(_text(row, "Patient ID")))
+        except ValueError:
+            raise ValueError("Patient ID must be a number")
+        if patient_id not in lookups["patient_ids"]:
+            raise ValueError(f"Patient ID {patient_id} does not exist")
+    else:
+        name = " ".join(_text(row, "Patient Name").split()).lower()
+        matches = lookups["patients"].get(name, [])
+        if len(matches) != 1:
+            raise ValueError(
+                f"Patient Name '{_text(row, 'Patient Name')}' matches {len(matches)} patients; "
+                "add a Patient ID column to pick one"
+            )
+        patient_id = matches[0]
+
+    return (date_time, clinic_id, patient_id, lookups["statuses"][status.lower()])
+
+
+# Adds imported appointments to the busyness rollup, as sp_count_busyness() does for one
+COUNT_BUSYNESS_QUERY = (
+    "INSERT INTO ClinicDailyBusyness (clinicId, day, statusId, appointments) \
+    VALUES (%s, %s, %s, %s) \
+    ON DUPLICATE KEY UPDATE appointments = appointments + VALUES(appointments)"
+)
+
+IMPORTS = {
+    "Patients": (
+        "INSERT INTO Patients (firstName, lastName, phoneNumber, email, dateOfBirth, gender, clinicId) \
+        VALUES (%s, %s, %s, %s, %s, %s, %s)",
+        patient_values,
+    ),
+    "Appointments": (
+        "INSERT INTO Appointments (dateTime, clinicId, patientId, statusId) \
+        VALUES (%s, %s, %s, %s)",
+        appointment_values,
+    ),
+}
+
+
+# ########################################
+# ########## IMPORTING
+
+
+def _read(dbConnection, query):
+    """
+    runs a SELECT inside the import's transaction. db.query() is not used, since it
+    commits (ending the transaction) and may read from a replica that has not seen the
+    rows inserted so far.
+    returns: the rows, as Rows
+    """
+    cursor = dbConnection.cursor(RowCursor)
+    cursor.execute(query)
+    return cursor.fetchall()
+
+
+def _load_lookups(dbConnection):
+    clinics = _read(dbConnection, "SELECT clinicId, location FROM Clinics;")
+    statuses = _read(dbConnection, "SELECT statusId, status FROM Statuses;")
+    return {
+        "clinics": {row["location"]: row["clinicId"] for row in clinics},
+        "statuses": {row["status"].lower(): row["statusId"] for row in statuses},
+    }
+
+
+def _load_patients(dbConnection):
+    """
+    returns: ({normalized full name: [patient ids]}, set of patient ids)
+    """
+    names = {}
+    ids = set()
+    for row in _read(dbConnection, "SELECT patientId, fullName FROM Patients;"):
+        name = " ".join(row["fullName"].split()).lower()
+        names.setdefault(name, []).append(row["patientId"])
+        ids.add(row["patientId"])
+    return names, ids
+
+
+def _insert_batch(cursor, sheet, insert_query, batch):
+    """
+    inserts a batch of rows with one multi-row INSERT and logs them in the ChangeLog,
+    as the stored procedures do for each row they insert
+    """
+    values, placeholders = insert_query.split("VALUES")
+    cursor.execute(
+        f"{values} VALUES " + ", ".join([placeholders.strip()] * len(batch)),
+        [value for row in batch for value in row],
+    )
+    changes.log_changes(
+        cursor, sheet, changes.inserted_ids(cursor, len(batch)), "insert"
+    )
+
+
+def import_sheets(dbConnection, sheets, progress=None):
+    """
+    validates and inserts the rows of each sheet inside one transaction.
+    Rows are validated as they are read and inserted in batches of multi-row INSERTs.
+    The transaction is only committed when every row is valid, so a file can be fixed
+    and uploaded again without creating duplicates.
+    sheets: the dict returned by open_sheets()
+    progress: optional function called with (sheet, rows inserted so far) after each batch
+    returns: a report dict with the rows imported per sheet and the errors found
+    """
+    report = {"imported": {}, "errors": [], "error_count": 0, "committed": False}
+    if not sheets:
+        raise ImportFileError("The file has no Patients or Appointments sheet")
+
+    cursor = dbConnection.cursor()
+    dbConnection.begin()
+    try:
+        lookups = _load_lookups(dbConnection)
+
+        for sheet in IMPORT_SHEETS:
+            if sheet not in sheets:
+                continue
+            insert_query, validate = IMPORTS[sheet]
+
+            if sheet == "Appointments":
+                # Includes the patients inserted earlier in this transaction
+                lookups["patients"], lookups["patient_ids"] = _load_patients(
+                    dbConnection
+                )
+
+            batch = []
+            imported = 0
+            busyness = Counter()
+            for row_number, row in sheets[sheet]():
+                try:
+                    batch.append(validate(row, lookups))
+                except ValueError as e:
+                    report["error_count"] += 1
+                    if len(report["errors"]) < MAX_REPORTED_ERRORS:
+                        report["errors"].append(
+                            {"sheet": sheet, "row": row_number, "error": str(e)}
+                        )
+                    continue
+
+                if sheet == "Appointments":
+                    date_time, clinic_id, _, status_id = batch[-1]
+                    busyness[(clinic_id, date_time.date(), status_id)] += 1
+
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    _insert_batch(cursor, sheet, insert_query, batch)
+                    imported += len(batch)
+                    batch = []
+                    if progress:
+                        progress(sheet, imported)
+
+            if batch:
+                _insert_batch(cursor, sheet, insert_query, batch)
+                imported += len(batch)
+
+            report["imported"][sheet] = imported
+
+            # Count the imported appointments into the busyness rollup
+            counts = [key + (count,) for key, count in busyness.items()]
+            for start in range(0, len(counts), IMPORT_BATCH_SIZE):
+                cursor.executemany(
+                    COUNT_BUSYNESS_QUERY, counts[start : start + IMPORT_BATCH_SIZE]
+                )
+
+        if report["error_count"]:
+            dbConnection.rollback()
+        else:
+            # Same version bumps as the stored procedures, so cached pages are refreshed
+            for sheet, imported in report["imported"].items():
+                if imported:
+                    cursor.execute("CALL sp_bump_table_version(%s);", (sheet,))
+            dbConnection.commit()
+            report["committed"] = True
+
+        return report
+
+    except Exception:
+        dbConnection.rollback()
+        raise
@@ -0,0 +1,524 @@
+import collections
+import functools
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import pymysql
+from pymysql.constants import ER
+import database.db_connector as db
+import admission
+import exporter
+import importer
+
+# Directory of the job table, the uploads waiting to be imported and the finished exports.
+# Every worker on the host shares it, so a job can be polled from any of them.
+JOBS_DIR = os.environ.get(
+    "JOBS_DIR", os.path.join(tempfile.gettempdir(), "capital-family-clinic-jobs")
+)
+
+# Processes that run jobs in each web worker. 0 runs a job inside the request that starts
+# it, for serverless deployments where nothing keeps running after the response, and is
+# the default on Vercel.
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 0 if os.environ.get("VERCEL") else 2))
+
+# Seconds between the heartbeats a worker writes for the jobs it started, and seconds
+# without one after which a queued or running job is taken to have died with its worker
+JOB_HEARTBEAT_SECONDS = float(os.environ.get("JOB_HEARTBEAT_SECONDS", 10))
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", 60))
+
+# Jobs that may be queued or running on the host at once; any more are turned away with
+# admission.Overloaded rather than waiting behind them
+JOB_QUEUE_LIMIT = int(os.environ.get("JOB_QUEUE_LIMIT", 10))
+
+# Hours a job, its upload and its export file are kept after it last changed
+JOB_RETENTION_HOURS = float(os.environ.get("JOB_RETENTION_HOURS", 24))
+
+# File name each export format is downloaded as
+EXPORT_FILES = {"xlsx": "exported_data.xlsx", "zip": "exported_data.zip"}
+
+# Shown when a job fails for any other reason than a bad import file
+ERROR_MESSAGES = {
+    "export": "Error exporting data",
+    "reset": "Error resetting database",
+    "import": "Error importing data",
+}
+
+# Shown for a job whose worker stopped before it finished
+STOPPED_MESSAGE = "The job stopped before it finished; start it again"
+
+# Statuses of a job that has not finished
+ACTIVE = ("queued", "running")
+
+
+# ########################################
+# ########## JOB TABLE
+
+
+@functools.lru_cache(maxsize=None)
+def _create_table(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    connection = sqlite3.connect(path, timeout=30)
+    try:
+        # Readers polling a job never wait for the worker writing its progress
+        connection.execute("PRAGMA journal_mode=WAL;")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ( \
+                id TEXT PRIMARY KEY, \
+                kind TEXT NOT NULL, \
+                key TEXT, \
+                status TEXT NOT NULL, \
+                progress REAL, \
+                message TEXT, \
+                result TEXT, \
+                file TEXT, \
+                createdAt REAL NOT NULL, \
+                updatedAt REAL NOT NULL \
+            );"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_kind_key ON jobs (kind, key);"
+        )
+    finally:
+        connection.close()
+
+
+def _connect():
+    """
+    returns: a connection to the job table, which commits every statement on its own
+    """
+    path = os.path.join(JOBS_DIR, "jobs.sqlite3")
+    _create_table(path)
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    return connection
+
+
+def _job(row):
+    if row is None:
+        return None
+    job = dict(row)
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    return job
+
+
+def _expire(connection):
+    """
+    marks the queued and running jobs that have had no heartbeat for JOB_LEASE_SECONDS as
+    failed, since the worker or job process running them has died
+    """
+    now = time.time()
+    connection.execute(
+        f"UPDATE jobs SET status = 'failed', message = ?, updatedAt = ? \
+        WHERE status IN ({', '.join('?' * len(ACTIVE))}) AND updatedAt < ?;",
+        (STOPPED_MESSAGE, now, *ACTIVE, now - JOB_LEASE_SECONDS),
+    )
+
+
+def get(job_id):
+    """
+    returns: the job as a dict of its columns, with its result decoded, or None
+    """
+    connection = _connect()
+    try:
+        select_query = "SELECT * FROM jobs WHERE id = ?;"
+        row = connection.execute(select_query, (job_id,)).fetchone()
+        if (
+            row is not None
+            and row["status"] in ACTIVE
+            and row["updatedAt"] < time.time() - JOB_LEASE_SECONDS
+        ):
+            _expire(connection)
+            row = connection.execute(select_query, (job_id,)).fetchone()
+        return _job(row)
+    finally:
+        connection.close()
+
+
+def _update(job_id, **columns):
+    columns["updatedAt"] = time.time()
+    if "result" in columns:
+        columns["result"] = json.dumps(columns["result"])
+    connection = _connect()
+    try:
+        connection.execute(
+            f"UPDATE jobs SET {', '.join(f'{name} = ?' for name in columns)} WHERE id = ?;",
+            (*columns.values(), job_id),
+        )
+    finally:
+        connection.close()
+
+
+def _prune(connection):
+    """
+    deletes the jobs that have not changed for JOB_RETENTION_HOURS, with their files
+    """
+    cutoff = time.time() - JOB_RETENTION_HOURS * 3600
+    rows = connection.execute(
+        "SELECT id, file FROM jobs WHERE updatedAt < ?;", (cutoff,)
+    ).fetchall()
+    for row in rows:
+        if row["file"]:
+            try:
+                os.remove(row["file"])
+            except OSError:
+                pass  # Already gone
+    connection.executemany(
+        "DELETE FROM jobs WHERE id = ?;", [(row["id"],) for row in rows]
+    )
+
+
+# ########################################
+# ########## HEARTBEATS
+
+_owned = set()  # Ids of the unfinished jobs this worker started
+_owned_pid = None
+_owned_lock = threading.Lock()
+
+
+def _own(job_id):
+    global _owned_pid
+    with _owned_lock:
+        if _owned_pid != os.getpid():
+            # Threads do not survive a fork, so each worker starts its own
+            _owned.clear()
+            threading.Thread(target=_heartbeat, daemon=True).start()
+            _owned_pid = os.getpid()
+        _owned.add(job_id)
+
+
+def _disown(job_id):
+    with _owned_lock:
+        _owned.discard(job_id)
+
+
+def _heartbeat():
+    # Keeps the jobs this worker started from being taken for dead while they are
+    # waiting for a job process or running in one
+    while True:
+        time.sleep(JOB_HEARTBEAT_SECONDS)
+        with _owned_lock:
+            job_ids = list(_owned)
+        if not job_ids:
+            continue
+        try:
+            connection = _connect()
+            try:
+                connection.execute(
+                    f"UPDATE jobs SET updatedAt = ? \
+                    WHERE id IN ({', '.join('?' * len(job_ids))}) \
+                    AND status IN ({', '.join('?' * len(ACTIVE))});",
+                    (time.time(), *job_ids, *ACTIVE),
+                )
+            finally:
+                connection.close()
+        except sqlite3.Error as e:
+            print(f"Error recording job heartbeats: {e}")
+
+
+# ########################################
+# ########## RUNNING JOBS
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _discard_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def _get_pool():
+    # Processes do not survive a fork, so each gunicorn worker starts its own pool.
+    # They are spawned rather than forked, so they do not inherit the worker's threads,
+    # locks or database connections.
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(
+                max_workers=JOB_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def submit(kind, run, *args, key=None, reuse_finished=False):
+    """
+    adds a job to the job table and starts it in the job processes
+    kind: "export", "reset" or "import"
+    run: module-level function run(job_id, *args) returning (result, file), which does the
+    work in a job process. result is saved as JSON; file is the path of its output, if any.
+    key: jobs of the same kind and key give the same result, so while one is queued or
+    running (or, with reuse_finished, has finished and still has its file) no new job is
+    started and its id is returned instead
+    returns: the id of the job
+    raises: admission.Overloaded when JOB_QUEUE_LIMIT jobs are already queued or running
+    """
+    connection = _connect()
+    try:
+        _prune(connection)
+
+        # Looked up and added in one write transaction, so two requests for the same
+        # result cannot both start a job
+        connection.execute("BEGIN IMMEDIATE;")
+        # A dead job is neither joined nor counted against JOB_QUEUE_LIMIT
+        _expire(connection)
+        if key is not None:
+            statuses = ACTIVE + ("done",) if reuse_finished else ACTIVE
+            for row in connection.execute(
+                f"SELECT id, status, file FROM jobs WHERE kind = ? AND key = ? \
+                AND status IN ({', '.join('?' * len(statuses))}) \
+                ORDER BY createdAt DESC;",
+                (kind, key, *statuses),
+            ).fetchall():
+                if row["status"] != "done" or (
+                    row["file"] and os.path.exists(row["file"])
+                ):
+                    connection.execute("COMMIT;")
+                    return row["id"]
+
+        active = connection.execute(
+            f"SELECT COUNT(*) FROM jobs WHERE status IN ({', '.join('?' * len(ACTIVE))});",
+            ACTIVE,
+        ).fetchone()[0]
+        if JOB_QUEUE_LIMIT and active >= JOB_QUEUE_LIMIT:
+            connection.execute("COMMIT;")
+            raise admission.Overloaded(
+                f"{active} jobs are already queued or running",
+                _retry_after(connection, kind),
+            )
+
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        connection.execute(
+            "INSERT INTO jobs (id, kind, key, status, createdAt, updatedAt) \
+            VALUES (?, ?, ?, 'queued', ?, ?);",
+            (job_id, kind, key, now, now),
+        )
+        connection.execute("COMMIT;")
+    finally:
+        connection.close()
+
+    _own(job_id)
+    if JOB_WORKERS > 0:
+        _start(job_id, kind, run, args)
+    else:
+        try:
+            _run(job_id, kind, run, args)
+        finally:
+            _disown(job_id)
+    return job_id
+
+
+def _start(job_id, kind, run, args):
+    """
+    hands a job added by submit() to this worker's job processes, or marks it failed when
+    they cannot take it
+    """
+    try:
+        pool = _get_pool()
+        try:
+            future = pool.submit(_run, job_id, kind, run, args)
+        except BrokenProcessPool:
+            # A job process died and took the pool with it; start a new one
+            _discard_pool(pool)
+            pool = _get_pool()
+            future = pool.submit(_run, job_id, kind, run, args)
+
+    except Exception as e:
+        print(f"Error starting {kind} job {job_id}: {e}")
+        _disown(job_id)
+        _update(job_id, status="failed", message=ERROR_MESSAGES[kind])
+        raise
+
+    future.add_done_callback(functools.partial(_finished, job_id, kind, pool))
+
+
+def _finished(job_id, kind, pool, future):
+    """
+    called in this worker when a job's process has returned, or died
+    """
+    _disown(job_id)
+    error = future.exception()
+    if error is None:
+        return
+
+    # _run() records the errors of the job itself, so its process died or the job
+    # could not be sent to it
+    print(f"Error running {kind} job {job_id}: {error!r}")
+    if isinstance(error, BrokenProcessPool):
+        _discard_pool(pool)
+    _update(job_id, status="failed", message=ERROR_MESSAGES[kind])
+
+
+def _retry_after(connection, kind):
+    # About as long as the jobs of this kind took lately, queueing included
+    took = connection.execute(
+        "SELECT AVG(updatedAt - createdAt) FROM jobs WHERE kind = ? AND status = 'done';",
+        (kind,),
+    ).fetchone()[0]
+    return min(admission.MAX_RETRY_AFTER, max(1, math.ceil(took or 30)))
+
+
+def _run(job_id, kind, run, args):
+    """
+    runs a job in a job process, recording its status, result and any error
+    """
+    _update(job_id, status="running")
+    try:
+        result, file = run(job_id, *args)
+        _update(
+            job_id, status="done", progress=1, message=None, result=result, file=file
+        )
+        print(f"{kind.upper()} job {job_id} done")
+
+    except Exception as e:
+        print(f"Error running {kind} job {job_id}: {e}")
+        message = (
+            str(e) if isinstance(e, importer.ImportFileError) else ERROR_MESSAGES[kind]
+        )
+        _update(job_id, status="failed", message=message)
+
+
+def report(job_id, progress=None, message=None):
+    """
+    records how far a running job has come
+    progress: fraction done, from 0 to 1, or None when it cannot be told
+    """
+    _update(job_id, progress=progress, message=message)
+
+
+# ########################################
+# ########## JOBS
+
+
+def export_key(file_format, versions):
+    """
+    returns: the key of an export of the data at the given table versions, which stays
+    the same until a table changes, so its file is reused until then
+    versions: {table name: version}, from TableVersions
+    """
+    tables = ",".join(
+        f"{table}={version}" for table, version in sorted(versions.items())
+    )
+    return f"{file_format}:{hashlib.sha1(tables.encode()).hexdigest()}"
+
+
+def export(job_id, file_format):
+    """
+    writes every export sheet to a workbook or a zip of CSV files in JOBS_DIR
+    returns: ({"fileName": name to download it as}, path of the file)
+    """
+    directory = os.path.join(JOBS_DIR, "exports")
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{job_id}.{file_format}")
+    # Written under another name first, so a half-written file is never downloaded
+    partial = os.path.join(directory, f".{job_id}.partial.{file_format}")
+    sheets = list(exporter.EXPORT_SHEETS)
+
+    def sheet_progress(sheet):
+        report(job_id, sheets.index(sheet) / len(sheets), f"Exporting {sheet}")
+
+    dbConnection = db.connectDB()
+    try:
+        if file_format == "zip":
+            with open(partial, "wb") as out:
+                for chunk in exporter.stream_csv_zip(dbConnection, sheet_progress):
+                    out.write(chunk)
+        else:
+            # Only workbook exports need pyexcel, so it is imported here rather than
+            # by every web worker at startup
+            import pyexcel
+
+            # isave_book_as() writes each sheet's rows as they are read, rather than
+            # building the workbook in memory first. pyexcel sorts the sheets of a plain
+            # dict by name, so an OrderedDict keeps them in the order of EXPORT_SHEETS.
+            book = collections.OrderedDict(
+                (sheet, exporter.sheet_rows(dbConnection, sheet, sheet_progress))
+                for sheet in exporter.EXPORT_SHEETS
+            )
+            pyexcel.isave_book_as(bookdict=book, dest_file_name=partial)
+            pyexcel.free_resources()
+
+        os.replace(partial, path)
+        return {"fileName": EXPORT_FILES[file_format]}, path
+
+    except Exception:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+    finally:
+        dbConnection.close()
+
+
+def reset(job_id):
+    """
+    restores every table from the snapshot in the Seed tables, in one transaction
+    returns: ({}, None)
+    """
+    report(job_id, None, "Resetting the database")
+    dbConnection = db.connectDB()
+    try:
+        cursor = dbConnection.cursor()
+        try:
+            cursor.execute("CALL sp_reset_clinicdb();")
+        except pymysql.err.MySQLError as e:
+            if e.args[0] != ER.SP_DOES_NOT_EXIST:
+                raise
+            # Databases set up before sp_reset_clinicdb existed are reloaded from scratch
+            print(f"Reset procedure unavailable, loading default data: {e}")
+            cursor.execute("CALL sp_load_clinicdb();")
+        return {}, None
+
+    finally:
+        dbConnection.close()
+
+
+def save_upload(upload):
+    """
+    saves an uploaded file for an import job to read
+    returns: the path of the saved file
+    """
+    directory = os.path.join(JOBS_DIR, "uploads")
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, uuid.uuid4().hex)
+    upload.save(path)
+    return path
+
+
+def import_file(job_id, path, file_name, sheet):
+    """
+    validates and imports a saved upload (see importer.import_sheets()), then deletes it
+    returns: ({"fileName": file_name, "report": the import report}, None)
+    """
+
+    def batch_progress(sheet, imported):
+        report(job_id, None, f"Checked and inserted {imported} {sheet.lower()}")
+
+    dbConnection = None
+    try:
+        with open(path, "rb") as stream:
+            sheets = importer.open_sheets(file_name, stream, sheet)
+            dbConnection = db.connectDB()
+            result = importer.import_sheets(dbConnection, sheets, batch_progress)
+
+        print(f"IMPORT {file_name}: {result['imported']}")
+        return {"fileName": file_name, "report": result}, None
+
+    finally:
+        if dbConnection:
+            dbConnection.close()
+        os.remove(path)
@@ -1,6 +1,12 @@
 document.addEventListener("DOMContentLoaded", function () {
     // Show the add form when the add button is clicked
     document.querySelector("button.add")?.addEventListener("click", (event) => {
+        // After an update saved in the background the popup still holds the update form,
+        // so load the page's add form instead
+        if (document.querySelector(".add-form-popup form")?.action.endsWith("/update")) {
+            window.location.assign(listUrl());
+            return;
+        }
         document.querySelector(".add-form-popup").classList.add("active");
     });
 
@@ -23,13 +29,133 @@ document.addEventListener("DOMContentLoaded", function () {
         document.querySelector(".alert").classList.add("hide");
     });
 
-    // Show delete popup when delete button is clicked
-    document.querySelectorAll('.delete-trigger').forEach(button => {
-        button.addEventListener('click', function(e) {
-            // Use data attributes to determine which item to delete
-            const dataId = this.getAttribute('data-id');
-            document.getElementById('deleteId').value = dataId;
-            document.querySelector('.delete-form-popup').classList.add('active');
+    // Show delete popup when delete button is clicked (listening on the document, so rows
+    // added to the table after the page loaded have working delete buttons too)
+    document.addEventListener('click', function(e) {
+        const trigger = e.target.closest('.delete-trigger');
+        if (!trigger) {
+            return;
+        }
+        // Use data attributes to determine which item to delete
+        document.getElementById('deleteId').value = trigger.getAttribute('data-id');
+        document.querySelector('.delete-form-popup').classList.add('active');
+    });
+
+    // The list page's URL without the ?id= of the update form
+    function listUrl() {
+        const url = new URL(window.location.href);
+        url.searchParams.delete('id');
+        return url.toString();
+    }
+
+    // Whether a row added now belongs on this page: the lists are in order of id and a
+    // new row has the highest, so only the last page of the unfiltered list shows it
+    function showsNewRows() {
+        const params = new URL(window.location.href).searchParams;
+        const filtered = [...params].some(([key, value]) => value && !['id', 'after', 'before', 'limit'].includes(key));
+        return !filtered && !document.querySelector('.pagination a[rel="next"]');
+    }
+
+    // Send the add, update and delete forms in the background. The server answers with
+    // only the changed row (or a data-deleted marker), which replaces, removes or is added
+    // to the row with the same data-id, instead of redirecting and reloading the page.
+    // A new row that may belong on another page, or outside the list's filters, reloads
+    // the page instead.
+    // Without a table to patch, or when the write fails, the page is reloaded as before,
+    // showing the error message. A write turned away while the server is busy keeps its
+    // form open, to be sent again.
+    document.querySelectorAll('.add-form-popup form, .delete-form-popup form').forEach(form => {
+        form.addEventListener('submit', function(e) {
+            const tbody = document.querySelector('.table-container tbody');
+            if (!tbody) {
+                return;
+            }
+            e.preventDefault();
+
+            fetch(form.action, {
+                method: 'POST',
+                body: new FormData(form),
+                headers: {'X-Fragment': 'row'},
+            })
+                .then(response => {
+                    if (response.status === 503) {
+                        return response.text().then(message => {
+                            window.alert(message);
+                            return null;
+                        });
+                    }
+                    if (!response.ok || response.redirected) {
+                        throw new Error(`Status ${response.status}`);
+                    }
+                    return response.text();
+                })
+                .then(html => {
+                    if (html === null) {
+                        return;
+                    }
+                    const template = document.createElement('template');
+                    template.innerHTML = `<table><tbody>${html.trim()}</tbody></table>`;
+                    const row = template.content.querySelector('tr');
+                    const existing = tbody.querySelector(`tr[data-id="${CSS.escape(row.dataset.id)}"]`);
+                    if (row.hasAttribute('data-deleted')) {
+                        existing?.remove();
+                    } else if (existing) {
+                        existing.replaceWith(row);
+                    } else if (showsNewRows()) {
+                        tbody.append(row);
+                    } else {
+                        window.location.assign(listUrl());
+                        return;
+                    }
+
+                    form.closest('.add-form-popup, .delete-form-popup').classList.remove('active');
+                    if (form.closest('.add-form-popup') && !form.action.endsWith('/update')) {
+                        form.reset();
+                    }
+                    window.history.replaceState(null, '', listUrl());
+                })
+                .catch(error => {
+                    console.error('Error saving the form', error);
+                    window.location.assign(listUrl());
+                });
+        });
+    });
+
+    // Fill the patient and appointment fields of the add/update forms with the matches of
+    // what is typed in the search box next to them, rather than listing every row. The
+    // options the page rendered (the prompt and the current choice) are kept.
+    document.querySelectorAll('.option-search').forEach(input => {
+        const select = document.getElementById(input.dataset.select);
+        let timer = null;
+        let latest = 0;
+        input.addEventListener('input', () => {
+            clearTimeout(timer);
+            timer = setTimeout(() => {
+                const search = ++latest;
+                const url = new URL(input.dataset.options, window.location.href);
+                url.searchParams.set('q', input.value);
+                fetch(url)
+                    .then(response => {
+                        if (!response.ok) {
+                            throw new Error(`Status ${response.status}`);
+                        }
+                        return response.json();
+                    })
+                    .then(data => {
+                        // Answers to earlier searches that arrive late are dropped
+                        if (search !== latest) {
+                            return;
+                        }
+                        select.querySelectorAll('option[data-found]').forEach(option => option.remove());
+                        const shown = new Set([...select.options].map(option => option.value));
+                        data.options.filter(found => !shown.has(String(found.id))).forEach(found => {
+                            const option = new Option(found.label, found.id);
+                            option.dataset.found = '';
+                            select.add(option);
+                        });
+                    })
+                    .catch(error => console.error('Error searching the options', error));
+            }, 250);
         });
     });
 
@@ -53,42 +179,120 @@ document.addEventListener("DOMContentLoaded", function () {
         document.querySelector('.filters-dropdown-content').classList.toggle('hide');
     });
 
-    // Toggle chart
+    // Toggle chart, loading the requested tests data the first time it is opened
+    let myChart = null;
     document.querySelector('.view-chart')?.addEventListener('click', function() {
         document.querySelector('.chart-popup').classList.toggle('active');
+        if (!myChart) {
+            myChart = loadChart(document.getElementById('myChart'));
+        }
     });
 
-    // Filter results using search for name or select test
-    function filterResults() {
-        const search = document.getElementById('searchInput').value.toLowerCase();
-        const selected = Array.from(document.querySelectorAll('.filter input[type="checkbox"]:checked')).map(filter => filter.name);
-
-        // Determine if page has select filter
-        let hasSelectFilter = document.querySelectorAll('.filter input[type="checkbox"]').length;
+    // Fetch the requested tests counts from the server and draw them with Chart.js
+    function loadChart(canvas) {
+        const config = {
+            type: 'bar',
+            data: {
+                labels: [],
+                datasets: [{
+                    label: 'Tests',
+                    backgroundColor: '#4F7BB8',
+                    borderColor: '#4F7BB8',
+                    data: [],
+                }]
+            },
+            options: {
+                maintainAspectRatio: false,
+                animation: false,
+                ticks: {
+                    precision: 0
+                },
+                plugins: {
+                    legend: {
+                        display: false
+                    },
+                    title: {
+                        display: true,
+                        text: 'Number of requested tests by name'
+                    }
+                },
+                scales: {
+                    y: {
+                        title: {
+                            display: true,
+                            text: '# of requested tests'
+                        }
+                    }
+                }
+            }
+        };
 
-        document.querySelectorAll('tbody tr').forEach(row => {
-            const firstName = row.querySelector('.firstName')?.textContent.toLowerCase();
-            const lastName = row.querySelector('.lastName')?.textContent.toLowerCase();
-            const name = row.querySelector('.name')?.textContent.toLowerCase();
-            const fullName = name != undefined ? name : firstName + ' ' + lastName;
-            const test = row.querySelector('.test')?.textContent;
+        const chart = new Chart(canvas, config);
 
-            const matchesText = fullName.includes(search);
-            const matchesFilter = selected.includes(test);
+        fetch(canvas.dataset.url)
+            .then(response => response.json())
+            .then(result => {
+                chart.data.labels = result.labels;
+                chart.data.datasets[0].data = result.data;
+                chart.update();
+            })
+            .catch(error => console.error('Error loading chart data', error));
 
-            if (matchesText && (hasSelectFilter > 0 ? matchesFilter : true)) {
-                row.style.display = '';
-            } else {
-                row.style.display = 'none';
-            }
-        });
+        return chart;
     }
 
-    document.getElementById('searchInput')?.addEventListener('input', filterResults);
+    // Search by patient name on the server, once the user stops typing
+    const searchInput = document.getElementById('searchInput');
+    let searchTimer = null;
+    searchInput?.addEventListener('input', function() {
+        clearTimeout(searchTimer);
+        searchTimer = setTimeout(() => searchInput.form.requestSubmit(), 400);
+    });
+
+    // Keep typing where the user left off after the filtered page loads
+    if (searchInput?.value) {
+        searchInput.focus();
+        searchInput.setSelectionRange(searchInput.value.length, searchInput.value.length);
+    }
 
-    // Add event listener for each checkbox
-    let checkboxes = document.querySelectorAll('.filter input[type="checkbox"]');
-    for (let i = 0; i < checkboxes.length; i++) {
-        checkboxes[i].addEventListener('change', filterResults);
+    // Follow a background job (export, reset or import) until it has finished, then
+    // reload its page to show the result
+    const job = document.querySelector('.job[data-status-url]');
+    if (job && ['queued', 'running'].includes(job.dataset.status)) {
+        const message = job.querySelector('.job-message');
+        const progress = job.querySelector('progress');
+        const poll = () => fetch(job.dataset.statusUrl)
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error(`Status ${response.status}`);
+                }
+                return response.json();
+            })
+            .then(status => {
+                if (!['queued', 'running'].includes(status.status)) {
+                    window.location.reload();
+                    return;
+                }
+                if (status.message) {
+                    message.textContent = status.message;
+                }
+                if (status.progress === null) {
+                    progress.removeAttribute('value');
+                } else {
+                    progress.max = 1;
+                    progress.value = status.progress;
+                }
+                setTimeout(poll, 1000);
+            })
+            .catch(error => {
+                console.error('Error checking the job', error);
+                setTimeout(poll, 5000);
+            });
+        setTimeout(poll, 1000);
     }
+
+    // Filter by the selected tests on the server when a checkbox changes
+    document.querySelectorAll('.filter input[type="checkbox"]').forEach(checkbox => {
+        checkbox.addEventListener('change', () => checkbox.form.requestSubmit());
+    });
 });
\ No newline at end of file